@@ -0,0 +1,153 @@
+"""Scale to zero and on-demand start of idle services.
+
+A service with an idle_timeout is scaled down to zero slots when it has no
+in-flight work during idle_timeout seconds, and started again (with its
+configured number of slots) as soon as some work arrives.
+
+In-flight work is measured on:
+
+- the activation socket: a listening socket (TCP or unix) owned by the daemon
+  and inherited by processes (they accept connections on it). Connections
+  (accepted or still in the listen backlog) are read from /proc/net, so a
+  connection which arrives while there is no slot stays in the backlog until a
+  slot is ready to accept it.
+- the activation spool directory: files waiting inside.
+- the queue of job queue services (see alwaysup.jobs).
+"""
+
+from typing import Optional, Tuple
+import os
+import socket
+import stat
+
+# interval (in seconds) between two in-flight work measures
+IDLE_CHECK_INTERVAL = 1.0
+
+# environment variable with the fd number of the activation socket
+LISTEN_FD_ENV = "ALWAYSUP_LISTEN_FD"
+
+# TCP states of connections which are still in flight (ESTABLISHED, SYN_RECV,
+# CLOSE_WAIT), others are listening or closed on our side
+TCP_IN_FLIGHT_STATES = ("01", "03", "08")
+
+# unix socket states of connections (SS_CONNECTING, SS_CONNECTED)
+UNIX_IN_FLIGHT_STATES = ("02", "03")
+
+# __SO_ACCEPTCON flag (listening unix socket)
+UNIX_ACCEPTCON_FLAG = 0x00010000
+
+
+def parse_address(address: str) -> Tuple[int, str, int]:
+    """Parse an activation socket address (host:port or unix socket path).
+
+    Returns:
+        (family, host or path, port) tuple (port is 0 for unix sockets).
+
+    Raises:
+        ValueError: if the address is invalid.
+    """
+    if "/" in address:
+        return (socket.AF_UNIX, address, 0)
+    host, sep, port = address.rpartition(":")
+    if sep == "" or not port.isdigit():
+        raise ValueError(f"invalid activation socket address: {address}")
+    host = host.strip("[]")
+    family = socket.AF_INET6 if ":" in host else socket.AF_INET
+    return (family, host, int(port))
+
+
+def open_listen_socket(address: str, backlog: int = socket.SOMAXCONN):
+    """Open (bind and listen) an activation socket.
+
+    A stale unix socket file is removed first.
+
+    Raises:
+        OSError: if the socket can't be opened.
+        ValueError: if the address is invalid.
+    """
+    family, host, port = parse_address(address)
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    try:
+        if family == socket.AF_UNIX:
+            try:
+                if stat.S_ISSOCK(os.stat(host).st_mode):
+                    os.unlink(host)
+            except FileNotFoundError:
+                pass
+            sock.bind(host)
+        else:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.bind((host, port))
+        sock.listen(backlog)
+    except Exception:
+        sock.close()
+        raise
+    # (left blocking: the file description is shared with processes)
+    return sock
+
+
+def close_listen_socket(sock: socket.socket):
+    """Close an activation socket (and remove its unix socket file)."""
+    path: Optional[str] = None
+    if sock.family == socket.AF_UNIX:
+        path = sock.getsockname()
+    sock.close()
+    if path:
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+
+def count_connections(sock: socket.socket) -> int:
+    """Return the number of in-flight connections of a listening socket.
+
+    Connections still in the listen backlog are counted.
+    """
+    if sock.family == socket.AF_UNIX:
+        return _count_unix_connections(sock.getsockname())
+    port = sock.getsockname()[1]
+    return _count_tcp_connections("/proc/net/tcp", port) + _count_tcp_connections(
+        "/proc/net/tcp6", port
+    )
+
+
+def _read_lines(path: str):
+    try:
+        with open(path, "r") as f:
+            return f.readlines()[1:]
+    except OSError:
+        return []
+
+
+def _count_tcp_connections(path: str, port: int) -> int:
+    suffix = ":%04X" % port
+    res = 0
+    for line in _read_lines(path):
+        fields = line.split()
+        if len(fields) < 4:
+            continue
+        if fields[1].endswith(suffix) and fields[3] in TCP_IN_FLIGHT_STATES:
+            res += 1
+    return res
+
+
+def _count_unix_connections(path: str) -> int:
+    res = 0
+    for line in _read_lines("/proc/net/unix"):
+        fields = line.split()
+        if len(fields) < 8 or fields[7] != path:
+            continue
+        if int(fields[3], 16) & UNIX_ACCEPTCON_FLAG:
+            continue
+        if fields[5] in UNIX_IN_FLIGHT_STATES:
+            res += 1
+    return res
+
+
+def count_files(path: str) -> int:
+    """Return the number of (not hidden) files in a spool directory."""
+    try:
+        return len([x for x in os.listdir(path) if not x.startswith(".")])
+    except OSError:
+        return 0
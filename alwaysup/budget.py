@@ -0,0 +1,196 @@
+"""Host wide worker budget (see WorkerBudget).
+
+The budget is a capacity in units (slots or weighted CPU/memory units, each
+service declares the weight of one of its slots). Slots are granted to
+services:
+
+- minimum guarantees first (budget_min_slots), by priority
+- then the rest of their wanted slots, by priority (then in registration order)
+
+A service which wants more than it is granted keeps its pending slots (queued
+scale request) and gets them as soon as some capacity is released. A service
+whose grant becomes lower than its number of slots (a higher priority service
+scaled up) is scaled down (preempted). New slots are only started when there
+is some room left, so the budget is not exceeded while preempted slots are
+stopping.
+"""
+
+from typing import Any, Dict, List, Optional, Set, TYPE_CHECKING
+import asyncio
+from dataclasses import dataclass
+import mflog
+from alwaysup.utils import log_exceptions
+
+if TYPE_CHECKING:
+    from alwaysup.service import Service
+
+# interval (in seconds) between two room checks of a waiting scale up
+ROOM_CHECK_INTERVAL = 1.0
+
+# (float rounding tolerance for weighted units)
+EPSILON = 1e-9
+
+
+@dataclass
+class Demand:
+    """Slots wanted by a service.
+
+    Attributes:
+        name: name of the service.
+        wanted: number of slots wanted.
+        priority: priority of the service (higher first).
+        min_slots: guaranteed number of slots.
+        weight: units used by one slot.
+    """
+
+    name: str
+    wanted: int
+    priority: int = 0
+    min_slots: int = 0
+    weight: float = 1.0
+
+
+def allocate(capacity: float, demands: List[Demand]) -> Dict[str, int]:
+    """Return the number of slots granted to each demand.
+
+    Guarantees are granted first, then wanted slots, both by priority (demands
+    with the same priority are served in list order).
+    """
+    order = sorted(demands, key=lambda x: -x.priority)
+    res = {x.name: 0 for x in demands}
+    remaining = capacity
+    for guarantees in (True, False):
+        for demand in order:
+            wanted = (
+                min(demand.wanted, demand.min_slots) if guarantees else demand.wanted
+            )
+            n = wanted - res[demand.name]
+            if n <= 0:
+                continue
+            if demand.weight > 0:
+                n = min(n, int((remaining + EPSILON) // demand.weight))
+            res[demand.name] += n
+            remaining -= n * demand.weight
+    return res
+
+
+class WorkerBudget:
+    """Host wide worker budget with priorities and minimum guarantees.
+
+    Attributes:
+        capacity: budget in units (0 => no limit).
+        preemptions: number of slots taken back from services (for higher
+            priority ones).
+    """
+
+    def __init__(self, capacity: float = 0.0):
+        self.capacity: float = capacity
+        self.preemptions: int = 0
+        self.logger = mflog.get_logger("alwaysup.budget")
+        self._services: Dict[str, "Service"] = {}
+        self._granted: Dict[str, int] = {}
+        self._room: Optional[asyncio.Event] = None
+        self._tasks: Set[asyncio.Task] = set()
+
+    @property
+    def enabled(self) -> bool:
+        return self.capacity > 0
+
+    def register(self, service: "Service"):
+        self._services[service.name] = service
+
+    def forget(self, name: str):
+        self._services.pop(name, None)
+        self._granted.pop(name, None)
+        self.update()
+
+    def granted(self, service: "Service") -> int:
+        """Return the number of slots granted to a service."""
+        if not self.enabled or service.name not in self._services:
+            return service.wanted_slot_number()
+        return self._granted.get(service.name, 0)
+
+    def used(self) -> float:
+        """Return the units used by existing slots (stopping ones included)."""
+        return sum(
+            x.number_of_slots_in_use() * max(x.cmd.budget_weight, 0.0)
+            for x in self._services.values()
+        )
+
+    def has_room(self, service: "Service") -> bool:
+        """Return True if a new slot of the service fits in the budget."""
+        if not self.enabled or service.cmd.budget_weight <= 0:
+            return True
+        return self.used() + service.cmd.budget_weight <= self.capacity + EPSILON
+
+    async def wait_for_room(self):
+        """Wait for some released capacity (or ROOM_CHECK_INTERVAL)."""
+        if self._room is None:
+            self._room = asyncio.Event()
+        try:
+            await asyncio.wait_for(self._room.wait(), ROOM_CHECK_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+
+    def notify(self):
+        """Wake up scale ups waiting for room (some slots were removed)."""
+        if self._room is not None:
+            self._room.set()
+            self._room = None
+
+    def update(self, caller: Optional["Service"] = None):
+        """Recompute grants (after a change of wanted slots).
+
+        Other services whose grant changed are reconciled in background (the
+        caller is reconciling itself).
+        """
+        if not self.enabled:
+            return
+        demands = [
+            Demand(
+                name=x.name,
+                wanted=x.wanted_slot_number(),
+                priority=x.cmd.budget_priority,
+                min_slots=x.cmd.budget_min_slots,
+                weight=x.cmd.budget_weight,
+            )
+            for x in self._services.values()
+        ]
+        for name, granted in allocate(self.capacity, demands).items():
+            old = self._granted.get(name, 0)
+            self._granted[name] = granted
+            service = self._services[name]
+            if granted == old or service is caller:
+                continue
+            in_use = service.number_of_slots_in_use()
+            if granted < in_use:
+                preempted = in_use - granted
+                self.preemptions += preempted
+                self.logger.info(f"{preempted} slot(s) of {name} preempted")
+            task = asyncio.create_task(log_exceptions(service.apply_budget()))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    def as_dict(self) -> Dict[str, Any]:
+        services: Dict[str, Any] = {}
+        for name, service in self._services.items():
+            wanted = service.wanted_slot_number()
+            granted = self.granted(service)
+            services[name] = {
+                "priority": service.cmd.budget_priority,
+                "min_slots": service.cmd.budget_min_slots,
+                "weight": service.cmd.budget_weight,
+                "wanted": wanted,
+                "granted": granted,
+                "pending": max(wanted - granted, 0),
+                "slots": service.number_of_slots_in_use(),
+            }
+        return {
+            "capacity": self.capacity,
+            "used": self.used(),
+            "allocated": sum(
+                x["granted"] * max(x["weight"], 0.0) for x in services.values()
+            ),
+            "preemptions": self.preemptions,
+            "services": services,
+        }
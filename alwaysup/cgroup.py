@@ -0,0 +1,136 @@
+"""Minimal cgroup v2 backend (to kill and account a whole service or slot)."""
+
+from typing import Callable, Dict, List, Optional
+import os
+import signal
+import mflog
+
+DEFAULT_CGROUP_ROOT = "/sys/fs/cgroup/alwaysup"
+
+
+class Cgroup:
+    """A cgroup v2 directory.
+
+    Attributes:
+        path: full path of the cgroup directory.
+    """
+
+    def __init__(self, path: str):
+        self.path: str = path
+        self.logger = mflog.get_logger("alwaysup.cgroup").bind(path=path)
+
+    def child(self, name: str) -> "Cgroup":
+        return Cgroup(os.path.join(self.path, name))
+
+    def _file(self, name: str) -> str:
+        return os.path.join(self.path, name)
+
+    def _read(self, name: str) -> Optional[str]:
+        try:
+            with open(self._file(name), "r") as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def _write(self, name: str, value: str):
+        with open(self._file(name), "w") as f:
+            f.write(value)
+
+    def create(self, enable_controllers: bool = False):
+        """Create the cgroup directory (and its parents).
+
+        Args:
+            enable_controllers: if True, enable cpu and memory controllers for
+                children cgroups (so limits can be set on them).
+
+        Raises:
+            OSError: if the cgroup can't be created (no cgroup v2, no delegation).
+        """
+        parent = os.path.dirname(self.path)
+        if not os.path.isdir(parent):
+            Cgroup(parent).create(enable_controllers=True)
+        os.makedirs(self.path, exist_ok=True)
+        if enable_controllers:
+            for controller in ("cpu", "memory"):
+                try:
+                    self._write("cgroup.subtree_control", f"+{controller}")
+                except OSError:
+                    self.logger.warning(f"can't enable {controller} controller")
+
+    def set_limits(self, memory_max: str = "", cpu_max: str = ""):
+        """Set memory.max and cpu.max limits (empty string => no change)."""
+        for name, value in (("memory.max", memory_max), ("cpu.max", cpu_max)):
+            if not value:
+                continue
+            try:
+                self._write(name, value)
+            except OSError:
+                self.logger.warning(f"can't set {name} to {value}", exc_info=True)
+
+    def add_process(self, pid: int):
+        self._write("cgroup.procs", str(pid))
+
+    def join_function(self) -> Callable[[], None]:
+        """Return a function which moves the calling process to the cgroup.
+
+        It is used as a preexec_fn (run in the child between fork and exec), so
+        the process is in its cgroup before it can fork anything (and nothing
+        escapes). Only raw os calls are done in the child (with arguments
+        encoded in the parent), see alwaysup.spawn.
+        """
+        path = os.fsencode(self._file("cgroup.procs"))
+
+        def _join():
+            try:
+                fd = os.open(path, os.O_WRONLY | os.O_TRUNC)
+                try:
+                    os.write(fd, b"0")
+                finally:
+                    os.close(fd)
+            except OSError:
+                # (the parent adds the process after the spawn and logs a warning)
+                pass
+
+        return _join
+
+    def pids(self) -> List[int]:
+        content = self._read("cgroup.procs") or ""
+        return [int(x) for x in content.split()]
+
+    def kill(self):
+        """SIGKILL all processes of the cgroup (and of its descendants).
+
+        cgroup.kill is used if available (kernel >= 5.14), else we send SIGKILL to
+        each process listed in cgroup.procs.
+
+        """
+        try:
+            self._write("cgroup.kill", "1")
+            return
+        except OSError:
+            pass
+        for pid in self.pids():
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+
+    def stats(self) -> Dict[str, Optional[int]]:
+        """Return resource accounting (without walking /proc)."""
+        cpu_usage_usec: Optional[int] = None
+        for line in (self._read("cpu.stat") or "").splitlines():
+            tmp = line.split()
+            if len(tmp) == 2 and tmp[0] == "usage_usec":
+                cpu_usage_usec = int(tmp[1])
+        memory = (self._read("memory.current") or "").strip()
+        return {
+            "cpu_usage_usec": cpu_usage_usec,
+            "memory_current": int(memory) if memory.isdigit() else None,
+        }
+
+    def remove(self):
+        """Remove the cgroup directory (best effort, it must be empty)."""
+        try:
+            os.rmdir(self.path)
+        except OSError:
+            pass
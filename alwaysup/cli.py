@@ -1,10 +1,11 @@
 from typing import Dict, Any
-import typer
 import json
-import requests
-from alwaysup.daemon import Daemon, set_instance
-from alwaysup.service import Service
-from alwaysup.cmd import Cmd, CmdConfiguration
+import time
+import typer
+from alwaysup.client import Client
+
+# Note: server side modules (alwaysup.daemon...) are imported only in server
+# commands to keep client commands fast to start.
 
 app = typer.Typer()
 
@@ -20,7 +21,12 @@ def run_forever(
     daemonize: bool = False,
     daemonize_stdout: str = "/dev/null",
     daemonize_stderr: str = "/dev/null",
+    loop: str = "auto",
 ):
+    from alwaysup.daemon import Daemon, set_instance
+    from alwaysup.service import Service
+    from alwaysup.cmd import Cmd, CmdConfiguration
+
     if len(ctx.args) == 0:
         raise Exception("you have to provide a program to execute")
     kwargs: Dict[str, Any] = {
@@ -32,7 +38,9 @@ def run_forever(
     config = CmdConfiguration(**kwargs)  # type: ignore
     cmd = Cmd(config)
     service = Service("forever_cmd", workers, cmd)
-    daemon = Daemon(services_to_add=[service], bind_host=bind_host, port=port)
+    daemon = Daemon(
+        services_to_add=[service], bind_host=bind_host, port=port, loop=loop
+    )
     set_instance(daemon)
     daemon.run(
         daemonize=daemonize,
@@ -48,8 +56,60 @@ def start_daemon(
     foreground: bool = False,
     daemonize_stdout: str = "NULL",
     daemonize_stderr: str = "NULL",
+    journal_path: str = "",
+    journal_fsync_interval: float = 0.5,
+    readopt: bool = False,
+    socket_path: str = "",
+    control_socket: bool = True,
+    slow_callback_threshold: float = 0.1,
+    trace_path: str = "",
+    supervisor_thread: bool = True,
+    shards: int = 0,
+    shard_stdout: str = "NULL",
+    loop: str = "auto",
+    status_table_path: str = "",
+    spawn_rate: float = 0.0,
+    spawn_burst: int = 10,
+    admission_psi_cpu: float = 0.0,
+    admission_psi_memory: float = 0.0,
+    admission_min_memory: int = 0,
+    worker_budget: float = 0.0,
+    log_queue_size: int = 10000,
+    log_rate: float = 10.0,
 ):
-    daemon = Daemon(bind_host=bind_host, port=port)
+    from alwaysup.daemon import Daemon, set_instance
+    from alwaysup.scheduler import SpawnScheduler
+    from alwaysup.control import default_socket_path
+
+    # (empty socket path => default socket path of the port)
+    if control_socket and not socket_path:
+        socket_path = default_socket_path(port)
+
+    daemon = Daemon(
+        spawn_scheduler=SpawnScheduler(
+            rate=spawn_rate,
+            burst=spawn_burst,
+            psi_cpu_threshold=admission_psi_cpu,
+            psi_memory_threshold=admission_psi_memory,
+            min_available_memory=admission_min_memory,
+        ),
+        supervisor_thread=supervisor_thread,
+        shards=shards,
+        shard_stdout=shard_stdout,
+        loop=loop,
+        status_table_path=status_table_path if status_table_path else None,
+        bind_host=bind_host,
+        port=port,
+        slow_callback_threshold=slow_callback_threshold,
+        trace_path=trace_path if trace_path else None,
+        journal_path=journal_path if journal_path else None,
+        journal_fsync_interval=journal_fsync_interval,
+        readopt=readopt,
+        socket_path=socket_path if control_socket and socket_path else None,
+        worker_budget=worker_budget,
+        log_queue_size=log_queue_size,
+        log_rate=log_rate,
+    )
     set_instance(daemon)
     daemon.run(
         daemonize=not foreground,
@@ -59,16 +119,30 @@ def start_daemon(
 
 
 @app.command()
-def shutdown_daemon(host: str = "127.0.0.1", port: int = 8000, smart=True):
-    res = requests.post(f"http://{host}:{port}/manager/shutdown")
-    result = res.json()
-    print(result)
+def shutdown_daemon(
+    host: str = "127.0.0.1",
+    port: int = 8000,
+    smart=True,
+    socket_path: str = "",
+):
+    client = Client(host=host, port=port, socket_path=socket_path or None)
+    print(client.request("shutdown"))
+
+
+@app.command()
+def detach_daemon(host: str = "127.0.0.1", port: int = 8000, socket_path: str = ""):
+    client = Client(host=host, port=port, socket_path=socket_path or None)
+    try:
+        client.request("detach")
+    except (ConnectionError, OSError):
+        # the daemon exits immediately (without answering)
+        pass
 
 
 @app.command()
-def status(host: str = "127.0.0.1", port: int = 8000):
-    res = requests.get(f"http://{host}:{port}/manager")
-    result = res.json()
+def status(host: str = "127.0.0.1", port: int = 8000, socket_path: str = ""):
+    client = Client(host=host, port=port, socket_path=socket_path or None)
+    result = client.request("manager")
     print(
         f"Manager state: {result['state']} "
         f"(since {round(result['state_since'])} seconds)"
@@ -90,16 +164,128 @@ def status(host: str = "127.0.0.1", port: int = 8000):
 
 
 @app.command()
-def scale_service(
-    service_name: str, workers: int, host: str = "127.0.0.1", port: int = 8000
+def status_table(path: str):
+    from alwaysup.status_table import read_status_table
+
+    for slot in read_status_table(path):
+        pid = "-" if slot.pid is None else slot.pid
+        print(
+            f"{slot.service}.{slot.slot_number}: {slot.state} "
+            f"(since {round(time.time() - slot.since)} seconds), pid: {pid}, "
+            f"restarts: {slot.restarts}, rss: {slot.rss // 1024} KiB"
+        )
+
+
+@app.command()
+def operation(
+    operation_id: str,
+    host: str = "127.0.0.1",
+    port: int = 8000,
+    socket_path: str = "",
+):
+    client = Client(host=host, port=port, socket_path=socket_path or None)
+    print(json.dumps(client.request("operation", id=operation_id), indent=4))
+
+
+@app.command(
+    context_settings={"allow_extra_args": True, "ignore_unknown_options": True}
+)
+def submit_job(
+    ctx: typer.Context,
+    service_name: str,
+    priority: int = 0,
+    host: str = "127.0.0.1",
+    port: int = 8000,
+    socket_path: str = "",
 ):
-    body = {"workers": workers}
-    res = requests.post(
-        f"http://{host}:{port}/services/{service_name}/scale", data=json.dumps(body)
+    if len(ctx.args) == 0:
+        raise Exception("you have to provide a program to execute")
+    client = Client(host=host, port=port, socket_path=socket_path or None)
+    job = client.request(
+        "submit_job", name=service_name, argv=ctx.args, env={}, priority=priority
     )
-    print(res)
-    print(res.text)
+    print(job["id"])
 
 
-if __name__ == "__main__":
+@app.command()
+def job(
+    service_name: str,
+    job_id: str,
+    host: str = "127.0.0.1",
+    port: int = 8000,
+    socket_path: str = "",
+):
+    client = Client(host=host, port=port, socket_path=socket_path or None)
+    print(json.dumps(client.request("job", name=service_name, id=job_id), indent=4))
+
+
+@app.command()
+def spawn_scheduler(host: str = "127.0.0.1", port: int = 8000, socket_path: str = ""):
+    client = Client(host=host, port=port, socket_path=socket_path or None)
+    print(json.dumps(client.request("spawn_scheduler"), indent=4))
+
+
+@app.command()
+def budget(host: str = "127.0.0.1", port: int = 8000, socket_path: str = ""):
+    client = Client(host=host, port=port, socket_path=socket_path or None)
+    print(json.dumps(client.request("budget"), indent=4))
+
+
+@app.command()
+def scale_service(
+    service_name: str,
+    workers: int,
+    host: str = "127.0.0.1",
+    port: int = 8000,
+    socket_path: str = "",
+):
+    client = Client(host=host, port=port, socket_path=socket_path or None)
+    print(client.request("scale_service", name=service_name, workers=workers))
+
+
+@app.command()
+def debug_tasks(host: str = "127.0.0.1", port: int = 8000, socket_path: str = ""):
+    client = Client(host=host, port=port, socket_path=socket_path or None)
+    result = client.request("debug_tasks")
+    print(f"{result['total']} live tasks")
+    for group in result["coroutines"]:
+        age = "" if group["max_age"] is None else f" (oldest: {group['max_age']:.1f}s)"
+        print(f"- {group['count']} x {group['coroutine']}{age}")
+
+
+@app.command()
+def debug_loop(host: str = "127.0.0.1", port: int = 8000, socket_path: str = ""):
+    client = Client(host=host, port=port, socket_path=socket_path or None)
+    print(json.dumps(client.request("debug_loop"), indent=4))
+
+
+@app.command()
+def debug_log(host: str = "127.0.0.1", port: int = 8000, socket_path: str = ""):
+    client = Client(host=host, port=port, socket_path=socket_path or None)
+    print(json.dumps(client.request("debug_log"), indent=4))
+
+
+@app.command()
+def debug_profile(
+    seconds: float = 10.0,
+    interval: float = 0.005,
+    output: str = "-",
+    host: str = "127.0.0.1",
+    port: int = 8000,
+    socket_path: str = "",
+):
+    client = Client(host=host, port=port, socket_path=socket_path or None)
+    result = client.request("debug_profile", seconds=seconds, interval=interval)
+    if output == "-":
+        print(result, end="")
+    else:
+        with open(output, "w") as f:
+            f.write(result)
+
+
+def main():
     app()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+"""Lightweight client for a running daemon (stdlib only).
+
+The unix socket control API of the daemon (default socket path derived from the
+HTTP port, local hosts only) is used if the daemon listens on it, else the HTTP API
+(with urllib).
+
+This module is imported by the CLI, so don't import server side modules
+(fastapi, uvicorn, alwaysup.daemon...) here.
+"""
+
+from typing import Any, Dict, Tuple, Optional
+import json
+from alwaysup.control import ControlClient, ControlError, default_socket_path
+
+LOCAL_HOSTS = ("127.0.0.1", "localhost", "::1")
+
+# command => (HTTP method, url path template, body parameters)
+HTTP_ROUTES: Dict[str, Tuple[str, str, Tuple[str, ...]]] = {
+    "manager": ("GET", "/manager", ()),
+    "shutdown": ("POST", "/manager/shutdown", ()),
+    "detach": ("POST", "/manager/detach", ()),
+    "stop_all": ("POST", "/manager/stop_all", ()),
+    "spawn_scheduler": ("GET", "/manager/spawn_scheduler", ()),
+    "budget": ("GET", "/manager/budget", ()),
+    "debug_loop": ("GET", "/debug/loop", ()),
+    "debug_tasks": ("GET", "/debug/tasks", ()),
+    "debug_log": ("GET", "/debug/log", ()),
+    "debug_profile": (
+        "GET",
+        "/debug/profile?seconds={seconds}&interval={interval}",
+        (),
+    ),
+    "operations": ("GET", "/operations", ()),
+    "operation": ("GET", "/operations/{id}", ()),
+    "services": ("GET", "/services", ()),
+    "service": ("GET", "/services/{name}", ()),
+    "start_service": ("POST", "/services/{name}/start", ()),
+    "stop_service": ("POST", "/services/{name}/stop", ()),
+    "remove_service": ("DELETE", "/services/{name}", ()),
+    "scale_service": ("POST", "/services/{name}/scale", ("workers",)),
+    "scale_service_up": ("POST", "/services/{name}/scaleup", ()),
+    "scale_service_down": ("POST", "/services/{name}/scaledown", ()),
+    "start_slot": ("POST", "/services/{name}/slots/{slot_number}/start", ()),
+    "stop_slot": ("POST", "/services/{name}/slots/{slot_number}/stop", ()),
+    "kill_slot": ("POST", "/services/{name}/slots/{slot_number}/sigkill", ()),
+    "submit_job": ("POST", "/services/{name}/jobs", ("argv", "env", "priority")),
+    "jobs": ("GET", "/services/{name}/jobs", ()),
+    "job": ("GET", "/services/{name}/jobs/{id}", ()),
+}
+
+
+class Client:
+    """Client for a running daemon.
+
+    Attributes:
+        host: HTTP API host.
+        port: HTTP API port.
+        socket_path: unix socket path (None => default socket path of the port
+            for local hosts, empty => never used).
+        timeout: timeout (in seconds, None => no timeout).
+    """
+
+    def __init__(
+        self,
+        host: str = "127.0.0.1",
+        port: int = 8000,
+        socket_path: Optional[str] = None,
+        timeout: Optional[float] = None,
+    ):
+        self.host: str = host
+        self.port: int = port
+        if socket_path is None:
+            socket_path = default_socket_path(port) if host in LOCAL_HOSTS else ""
+        self.socket_path: str = socket_path
+        self.timeout: Optional[float] = timeout
+
+    def _connect(self) -> Optional[ControlClient]:
+        # (None => nobody listens on the socket, stale file or HTTP only daemon)
+        if self.socket_path == "":
+            return None
+        client = ControlClient(self.socket_path, timeout=self.timeout)
+        try:
+            client.connect()
+        except (FileNotFoundError, ConnectionRefusedError):
+            return None
+        return client
+
+    def request(self, command: str, **params) -> Any:
+        """Execute a command on the daemon and return the result.
+
+        Raises:
+            ControlError: if the daemon returns an error.
+        """
+        client = self._connect()
+        if client is None:
+            return self._http_request(command, params)
+        try:
+            return client.request(command, **params)
+        finally:
+            client.close()
+
+    def _http_request(self, command: str, params: Dict[str, Any]) -> Any:
+        # urllib.request is slow to import (and useless with the unix socket)
+        import urllib.request
+        import urllib.error
+
+        method, path, body_params = HTTP_ROUTES[command]
+        url = f"http://{self.host}:{self.port}" + path.format(**params)
+        data: Optional[bytes] = None
+        if len(body_params) > 0:
+            data = json.dumps({x: params[x] for x in body_params}).encode()
+        req = urllib.request.Request(url, data=data, method=method)
+        req.add_header("Content-Type", "application/json")
+        try:
+            with urllib.request.urlopen(req, timeout=self.timeout) as res:
+                content = res.read()
+                content_type = res.headers.get_content_type()
+        except urllib.error.HTTPError as e:
+            try:
+                detail = json.loads(e.read()).get("detail", e.reason)
+            except ValueError:
+                detail = e.reason
+            raise ControlError(e.code, str(detail))
+        if content_type == "text/plain":
+            return content.decode()
+        return json.loads(content) if content else None
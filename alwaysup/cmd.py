@@ -1,13 +1,21 @@
-from typing import List, Dict, Any, cast
+from typing import List, Dict, Any, Optional, Tuple, Union, cast
 import shlex
 import copy
 import json
 import enum
 import os
+import signal
 import subprocess
 import jinja2
 from pydantic.dataclasses import dataclass
-from dataclasses import field
+from dataclasses import field, fields
+from alwaysup.cgroup import DEFAULT_CGROUP_ROOT
+from alwaysup.activation import LISTEN_FD_ENV
+from alwaysup.logforward import (
+    DEFAULT_BATCH_SIZE,
+    DEFAULT_BATCH_DELAY,
+    DEFAULT_QUEUE_SIZE,
+)
 
 
 DEFAULT_STDXXX_ROTATION_SIZE = 104857600
@@ -16,6 +24,49 @@ DEFAULT_STDOUT = "NULL"
 DEFAULT_STDERR = "STDOUT"
 
 
+def signal_to_int(sig: Union[int, str]) -> int:
+    """Convert a signal name (SIGTERM, TERM) or number to a signal number."""
+    if isinstance(sig, int) or sig.isdigit():
+        return int(sig)
+    name = sig.upper()
+    if not name.startswith("SIG"):
+        name = "SIG" + name
+    return int(signal.Signals[name])
+
+
+def read_env_file(path: str) -> Dict[str, str]:
+    """Read an env file (KEY=VALUE lines).
+
+    Empty lines and lines starting with # are ignored, an optional "export "
+    prefix is allowed and values can be single or double quoted.
+
+    Raises:
+        OSError: if the file can't be read.
+    """
+    res: Dict[str, str] = {}
+    with open(path, "r") as f:
+        lines = f.readlines()
+    for line in lines:
+        line = line.strip()
+        if line == "" or line.startswith("#") or "=" not in line:
+            continue
+        if line.startswith("export "):
+            line = line[7:]
+        key, value = line.split("=", 1)
+        value = value.strip()
+        if len(value) >= 2 and value[0] == value[-1] and value[0] in ("'", '"'):
+            value = value[1:-1]
+        res[key.strip()] = value
+    return res
+
+
+class _EnvCache:
+    """Spawn environment parts shared by all slots of a service."""
+
+    def __init__(self):
+        self.base: Optional[Dict[str, str]] = None
+
+
 class Templating(enum.Enum):
 
     NO = 0
@@ -29,12 +80,36 @@ class StdxxxHandler(enum.Enum):
     AUTO = 2
 
 
+class CgroupMode(enum.Enum):
+
+    NO = 0
+    SERVICE = 1  # one cgroup per service
+    SLOT = 2  # one cgroup per slot (inside the service one)
+
+
+class Placement(enum.Enum):
+
+    NO = 0
+    SPREAD = 1  # slots spread across cores (and NUMA nodes)
+    PACK = 2  # one logical cpu per slot, filling cores (and nodes) first
+    NUMA = 3  # slots split by NUMA node (pinned to all cpus of their node)
+
+
+class ScaleDownPolicy(enum.Enum):
+
+    HIGHEST = 0  # highest slot numbers first
+    YOUNGEST = 1  # most recently started processes first
+    OLDEST = 2  # longest running processes first
+    LEAST_CPU = 3  # processes with the lowest (sampled) CPU usage first
+    MOST_RSS = 4  # processes with the highest RSS first
+
+
 @dataclass(frozen=True)
 class CmdConfiguration:
     """Dataclass which holds execution options for Cmd.
 
     Following attributes can contain some templating placeholders:
-    program, args, stdout, stderr
+    program, args, stdout, stderr, extra_envs values
 
     Attributes:
         program: the program to execute (fullpath).
@@ -43,6 +118,9 @@ class CmdConfiguration:
         smart_stop_signal: signal used to (smart) stop a process.
         smart_stop_timeout: the timeout (seconds) after smart_stop_signal, after that
             send SIGKILL.
+        smart_stop_steps: list of (signal, timeout) steps for smart stopping a
+            process (escalation ladder), SIGKILL is sent after the last step. If
+            empty, the ladder is [(smart_stop_signal, smart_stop_timeout)].
         waiting_for_restart_delay: wait this delay (in seconds) before an automatic
             restart.
         autorespawn: if True, autorestart a crashed process.
@@ -52,7 +130,10 @@ class CmdConfiguration:
         templating: templating system to use for args and options.
         clean_env: if True, launch process with a clean env (and do not inherit from
             the parent process).
-        extra_envs: extra environment variables to add before the process launch.
+        env_files: env files (KEY=VALUE lines) to load (in this order) before the
+            process launch.
+        extra_envs: extra environment variables to add before the process launch
+            (after env files), values can contain templating placeholders.
         stdout: full path to redirect stdout (special values: NULL => ignore stdout)
         stderr: full path to redirect stderr (special values: NULL => ignore stderr,
             STDOUT => redirect to the same destination than stdout).
@@ -61,6 +142,49 @@ class CmdConfiguration:
             (for LOG_PROXY_WRAPPER stdxxx_handler only).
         stdxxx_rotation_time: maximum size (in seconds) of a stdxxx file before rotation
             (for LOG_PROXY_WRAPPER stdxxx_handler only).
+        cgroup: cgroup v2 mode (NO => no cgroup, SERVICE => one cgroup per service,
+            SLOT => one cgroup per slot, so a slot SIGKILL is a cgroup.kill).
+        cgroup_root: full path of the (delegated) cgroup v2 directory under which
+            services cgroups are created.
+        memory_max: memory.max value (empty => no limit), per service in SERVICE
+            mode, per slot in SLOT mode.
+        cpu_max: cpu.max value (empty => no limit), per service in SERVICE mode,
+            per slot in SLOT mode.
+        rlimit_nofile: RLIMIT_NOFILE (soft and hard) value (0 => inherited).
+        nice: niceness of processes (0 => inherited).
+        ionice_class: io scheduling class (realtime, best-effort, idle or empty
+            => inherited).
+        ionice_level: io scheduling level (0-7, for realtime and best-effort).
+        oom_score_adj: oom_score_adj value of processes (None => inherited).
+        cpu_affinity: CPUs processes are allowed to run on (empty => inherited).
+        placement: CPU placement policy of slots (NO => no pinning), slots are
+            pinned inside cpu_affinity (if set).
+        spawn_priority: priority of spawns in the spawn scheduler (higher first).
+        scale_down_policy: which slots are removed when the service is scaled
+            down (remaining slots keep their numbers).
+        idle_timeout: scale the service down to zero slots after this delay (in
+            seconds) without in-flight work, it is started again when some work
+            arrives (0 => never, see alwaysup.activation).
+        activation_socket: address (host:port or unix socket path) of a
+            listening socket owned by the daemon and inherited by processes
+            (fd number in ALWAYSUP_LISTEN_FD env var and LISTEN_FD template
+            variable), empty => no socket.
+        activation_spool_dir: directory of files waiting for the service (in-
+            flight work for idle_timeout), empty => no spool directory.
+        budget_priority: priority of the service in the worker budget (higher
+            first, can preempt slots of lower priority services).
+        budget_min_slots: number of slots guaranteed by the worker budget.
+        budget_weight: units of the worker budget used by one slot.
+        log_forward: sink (unix:/path, unixgram:/path or gzip:/path) of the
+            output of processes, parsed as JSON log lines, enriched and
+            forwarded in batches (see alwaysup.logforward), empty => no
+            forwarding. If set, stdout (and stderr if STDOUT) is captured by the
+            daemon (so stdout and stdxxx_handler are ignored).
+        log_forward_batch_size: maximum number of records in a forwarded batch.
+        log_forward_batch_delay: maximum delay (in seconds) before a record is
+            forwarded.
+        log_forward_queue_size: maximum number of records waiting for the sink
+            (records are dropped above).
 
     """
 
@@ -69,6 +193,7 @@ class CmdConfiguration:
     smart_stop: bool = True
     smart_stop_signal: int = 15
     smart_stop_timeout: float = 5.0
+    smart_stop_steps: List[Tuple[int, float]] = field(default_factory=lambda: [])
     waiting_for_restart_delay: float = 1.0
     autorespawn: bool = True
     autostart: bool = True
@@ -81,19 +206,75 @@ class CmdConfiguration:
     jinja2: bool = True
     clean_env: bool = False
     extra_envs: Dict[str, str] = field(default_factory=lambda: {})
+    env_files: List[str] = field(default_factory=lambda: [])
     templating: Templating = Templating.JINJA2
+    cgroup: CgroupMode = CgroupMode.NO
+    cgroup_root: str = DEFAULT_CGROUP_ROOT
+    memory_max: str = ""
+    cpu_max: str = ""
+    rlimit_nofile: int = 0
+    nice: int = 0
+    ionice_class: str = ""
+    ionice_level: int = 4
+    oom_score_adj: Optional[int] = None
+    cpu_affinity: List[int] = field(default_factory=lambda: [])
+    placement: Placement = Placement.NO
+    spawn_priority: int = 0
+    scale_down_policy: ScaleDownPolicy = ScaleDownPolicy.HIGHEST
+    idle_timeout: float = 0.0
+    activation_socket: str = ""
+    activation_spool_dir: str = ""
+    budget_priority: int = 0
+    budget_min_slots: int = 0
+    budget_weight: float = 1.0
+    log_forward: str = ""
+    log_forward_batch_size: int = DEFAULT_BATCH_SIZE
+    log_forward_batch_delay: float = DEFAULT_BATCH_DELAY
+    log_forward_queue_size: int = DEFAULT_QUEUE_SIZE
 
     @classmethod
     def from_json(cls, path: str) -> "CmdConfiguration":
         with open(path, "r") as f:
             c = f.read()
-        kwargs: Dict[str, Any] = json.loads(c)
+        return cls.from_dict(json.loads(c))
+
+    @classmethod
+    def from_dict(cls, d: Dict[str, Any]) -> "CmdConfiguration":
+        kwargs: Dict[str, Any] = dict(d)
         if "templating" in kwargs:
             kwargs["templating"] = Templating[kwargs["templating"].upper()]
         if "stdxxx_handler" in kwargs:
             kwargs["stdxxx_handler"] = StdxxxHandler[kwargs["stdxxx_handler"].upper()]
+        if "cgroup" in kwargs:
+            kwargs["cgroup"] = CgroupMode[kwargs["cgroup"].upper()]
+        if "placement" in kwargs:
+            kwargs["placement"] = Placement[kwargs["placement"].upper()]
+        if "scale_down_policy" in kwargs:
+            kwargs["scale_down_policy"] = ScaleDownPolicy[
+                kwargs["scale_down_policy"].upper()
+            ]
+        if "smart_stop_signal" in kwargs:
+            kwargs["smart_stop_signal"] = signal_to_int(kwargs["smart_stop_signal"])
+        if "smart_stop_steps" in kwargs:
+            kwargs["smart_stop_steps"] = [
+                (signal_to_int(x), float(y)) for x, y in kwargs["smart_stop_steps"]
+            ]
         return cls(**kwargs)  # type: ignore
 
+    def to_dict(self) -> Dict[str, Any]:
+        """Serialize the configuration as a json compatible dict.
+
+        Only CmdConfiguration fields are serialized (not subclasses ones).
+
+        """
+        res: Dict[str, Any] = {}
+        for f in fields(CmdConfiguration):
+            value = getattr(self, f.name)
+            if isinstance(value, enum.Enum):
+                value = value.name
+            res[f.name] = value
+        return res
+
     @classmethod
     def from_shell(cls, shell_cmd: str) -> "CmdConfiguration":
         tmp = shlex.split(shell_cmd)
@@ -109,6 +290,7 @@ class Cmd:
     Attributes:
         config: the configuration
         context: the context to use for templating evaluation
+        listen_fd: fd of the activation socket to pass to processes (or None)
 
     """
 
@@ -120,6 +302,9 @@ class Cmd:
         self.context = dict(os.environ)
         self.context.update(extra_context)
         self.config = config
+        self._env_cache: _EnvCache = _EnvCache()
+        self._env: Optional[Dict[str, str]] = None
+        self.listen_fd: Optional[int] = None
 
     @property
     def stdxxx_handler(self) -> StdxxxHandler:
@@ -128,6 +313,9 @@ class Cmd:
         AUTO value is resolved here, so it can't be returned by this method.
 
         """
+        if self.config.log_forward != "":
+            # (output captured by the daemon)
+            return StdxxxHandler.NULL
         if self.config.stdxxx_handler != StdxxxHandler.AUTO:
             return self.config.stdxxx_handler
         if self.config.stdout.lower() in (
@@ -143,6 +331,8 @@ class Cmd:
 
     @property
     def stdoutsubprocess(self) -> int:
+        if self.config.log_forward != "":
+            return subprocess.PIPE
         return self._stdxxxsubprocesss(self.config.stdout)
 
     @property
@@ -184,6 +374,92 @@ class Cmd:
     def smart_stop(self) -> bool:
         return self.config.smart_stop
 
+    @property
+    def smart_stop_steps(self) -> List[Tuple[int, float]]:
+        if len(self.config.smart_stop_steps) > 0:
+            return list(self.config.smart_stop_steps)
+        return [(self.config.smart_stop_signal, self.config.smart_stop_timeout)]
+
+    @property
+    def cgroup(self) -> CgroupMode:
+        return self.config.cgroup
+
+    @property
+    def cgroup_root(self) -> str:
+        return self.config.cgroup_root
+
+    @property
+    def memory_max(self) -> str:
+        return self.config.memory_max
+
+    @property
+    def cpu_max(self) -> str:
+        return self.config.cpu_max
+
+    @property
+    def placement(self) -> Placement:
+        return self.config.placement
+
+    @property
+    def spawn_priority(self) -> int:
+        return self.config.spawn_priority
+
+    @property
+    def scale_down_policy(self) -> ScaleDownPolicy:
+        return self.config.scale_down_policy
+
+    @property
+    def idle_timeout(self) -> float:
+        return self.config.idle_timeout
+
+    @property
+    def activation_socket(self) -> str:
+        return self.config.activation_socket
+
+    @property
+    def activation_spool_dir(self) -> str:
+        return self.config.activation_spool_dir
+
+    @property
+    def budget_priority(self) -> int:
+        return self.config.budget_priority
+
+    @property
+    def budget_min_slots(self) -> int:
+        return self.config.budget_min_slots
+
+    @property
+    def budget_weight(self) -> float:
+        return self.config.budget_weight
+
+    @property
+    def log_forward(self) -> str:
+        return self.config.log_forward
+
+    @property
+    def log_forward_batch_size(self) -> int:
+        return self.config.log_forward_batch_size
+
+    @property
+    def log_forward_batch_delay(self) -> float:
+        return self.config.log_forward_batch_delay
+
+    @property
+    def log_forward_queue_size(self) -> int:
+        return self.config.log_forward_queue_size
+
+    @property
+    def process_settings(self) -> Dict[str, Any]:
+        """Get settings to apply after spawn (kwargs of spawn.tune_process())."""
+        return {
+            "rlimit_nofile": self.config.rlimit_nofile,
+            "nice": self.config.nice,
+            "ionice_class": self.config.ionice_class,
+            "ionice_level": self.config.ionice_level,
+            "oom_score_adj": self.config.oom_score_adj,
+            "cpu_affinity": list(self.config.cpu_affinity),
+        }
+
     @property
     def args(self) -> List[str]:
         tmp_args: List[str] = list(self.config.args)
@@ -206,6 +482,52 @@ class Cmd:
             )
         return [self._jinja2(x) for x in tmp_args]
 
+    @property
+    def env(self) -> Optional[Dict[str, str]]:
+        """Get the environment of the process (None => inherit the current one).
+
+        The service part (inherited environment and env files) is built once and
+        shared by all slots (see copy_and_add_to_context()), the slot part
+        (rendered extra_envs) once per slot, so respawns reuse the same block.
+
+        Raises:
+            OSError: if an env file can't be read.
+        """
+        if self._env is not None:
+            return self._env
+        if (
+            not self.config.clean_env
+            and len(self.config.env_files) == 0
+            and len(self.config.extra_envs) == 0
+            and self.listen_fd is None
+        ):
+            return None
+        if self._env_cache.base is None:
+            base: Dict[str, str] = {} if self.config.clean_env else dict(os.environ)
+            for path in self.config.env_files:
+                base.update(read_env_file(path))
+            self._env_cache.base = base
+        env = dict(self._env_cache.base)
+        env.update({x: self._jinja2(y) for x, y in self.config.extra_envs.items()})
+        if self.listen_fd is not None:
+            env[LISTEN_FD_ENV] = str(self.listen_fd)
+        self._env = env
+        return env
+
+    def reset_env(self):
+        """Forget the computed environment (to reload env files at next spawn)."""
+        self._env_cache = _EnvCache()
+        self._env = None
+
+    def set_listen_fd(self, fd: Optional[int]):
+        """Set (or unset) the activation socket fd passed to processes."""
+        self.listen_fd = fd
+        if fd is None:
+            self.context.pop("LISTEN_FD", None)
+        else:
+            self.context["LISTEN_FD"] = str(fd)
+        self._env = None
+
     def _jinja2(self, value: str) -> str:
         if self.config.templating == Templating.JINJA2:
             t = jinja2.Template(value)
@@ -217,6 +539,9 @@ class Cmd:
             return subprocess.DEVNULL
         elif stdxxx.lower() == "pipe":
             return subprocess.PIPE
+        elif stdxxx.lower() == "stdout" and self.stdoutsubprocess == subprocess.PIPE:
+            # (stderr in the same pipe than stdout)
+            return subprocess.STDOUT
         return subprocess.DEVNULL
 
     @classmethod
@@ -227,9 +552,12 @@ class Cmd:
         return cls(CmdConfiguration(**kwargs))  # type: ignore
 
     def copy_and_add_to_context(self, to_add: Dict[str, Any]) -> "Cmd":
-        new = cast("Cmd", copy.deepcopy(self))
+        # (the configuration is immutable and the env cache is shared on purpose)
+        new = cast("Cmd", copy.copy(self))
+        new.context = dict(self.context)
         for key, value in to_add.items():
             new.context[key] = str(value)
+        new._env = None
         return new
 
     def __str__(self):
@@ -0,0 +1,236 @@
+"""Control commands (shared by the HTTP API and the unix socket control API)."""
+
+from typing import Any, Dict, Callable, Awaitable, Tuple
+from alwaysup.manager import Manager
+from alwaysup.service import Service
+from alwaysup.slot import ProcessSlot
+from alwaysup.cmd import Cmd, CmdConfiguration
+from alwaysup.jobs import JobQueueService, JobQueueSettings, JobQueueFull
+
+
+class CommandError(Exception):
+    """Error during a command execution.
+
+    Attributes:
+        status_code: HTTP like status code (404 for not found...).
+        detail: error message.
+    """
+
+    def __init__(self, status_code: int, detail: str):
+        super().__init__(detail)
+        self.status_code: int = status_code
+        self.detail: str = detail
+
+
+def get_service(manager: Manager, name: str) -> Service:
+    if name not in manager.services:
+        raise CommandError(404, "service not found")
+    return manager.services[name]
+
+
+def get_job_queue_service(manager: Manager, name: str) -> JobQueueService:
+    service = get_service(manager, name)
+    if not isinstance(service, JobQueueService):
+        raise CommandError(400, "not a job queue service")
+    return service
+
+
+def get_slot(manager: Manager, name: str, slot_number: int) -> ProcessSlot:
+    service = get_service(manager, name)
+    if slot_number not in service.slots:
+        raise CommandError(404, "slot not found")
+    return service.slots[slot_number]
+
+
+async def manager_as_dict(manager: Manager, params: Dict[str, Any]) -> Any:
+    return manager.as_dict()
+
+
+async def spawn_scheduler_as_dict(manager: Manager, params: Dict[str, Any]) -> Any:
+    return manager.spawn_scheduler.as_dict()
+
+
+async def budget_as_dict(manager: Manager, params: Dict[str, Any]) -> Any:
+    return manager.budget.as_dict()
+
+
+async def stop_all(manager: Manager, params: Dict[str, Any]) -> Any:
+    await manager.stop_all()
+
+
+async def shutdown(manager: Manager, params: Dict[str, Any]) -> Any:
+    await manager.shutdown()
+
+
+async def services_as_list(manager: Manager, params: Dict[str, Any]) -> Any:
+    return [x.as_dict() for x in manager.services.values()]
+
+
+async def service_as_dict(manager: Manager, params: Dict[str, Any]) -> Any:
+    return get_service(manager, params["name"]).as_dict()
+
+
+async def add_service(manager: Manager, params: Dict[str, Any]) -> Any:
+    config = dict(params.get("config", {}))
+    name = config.pop("name", params.get("name"))
+    workers = config.pop("workers", params.get("workers", 1))
+    job_queue = params.get("job_queue")
+    if name is None:
+        raise CommandError(400, "missing name property in the body")
+    if job_queue is not None:
+        # (programs come with jobs)
+        config.setdefault("program", "")
+    if config.get("program") is None:
+        raise CommandError(400, "missing program property in the body")
+    if name in manager.services:
+        raise CommandError(409, "service already exist")
+    try:
+        cmd = Cmd(CmdConfiguration.from_dict(config))
+        if job_queue is not None:
+            settings = JobQueueSettings.from_dict(job_queue)
+    except (TypeError, ValueError, KeyError) as e:
+        raise CommandError(400, f"invalid configuration: {e}")
+    if job_queue is not None:
+        service: Service = JobQueueService(name, workers, cmd, settings)
+    else:
+        service = Service(name, workers, cmd)
+    await manager.add_service(service)
+    return {"name": name}
+
+
+async def remove_service(manager: Manager, params: Dict[str, Any]) -> Any:
+    get_service(manager, params["name"])
+    await manager.shutdown_and_remove_service(params["name"])
+
+
+async def start_service(manager: Manager, params: Dict[str, Any]) -> Any:
+    await get_service(manager, params["name"]).start()
+
+
+async def stop_service(manager: Manager, params: Dict[str, Any]) -> Any:
+    await get_service(manager, params["name"]).stop()
+
+
+async def scale_service(manager: Manager, params: Dict[str, Any]) -> Any:
+    service = get_service(manager, params["name"])
+    workers = int(params["workers"])
+    if workers < 0:
+        raise CommandError(400, "workers can't be negative")
+    await service.set_slot_number(workers)
+
+
+async def scale_service_up(manager: Manager, params: Dict[str, Any]) -> Any:
+    service = get_service(manager, params["name"])
+    await service.set_slot_number(service.slot_number + 1)
+
+
+async def scale_service_down(manager: Manager, params: Dict[str, Any]) -> Any:
+    service = get_service(manager, params["name"])
+    await service.set_slot_number(max(service.slot_number - 1, 0))
+
+
+async def start_slot(manager: Manager, params: Dict[str, Any]) -> Any:
+    await get_slot(manager, params["name"], int(params["slot_number"])).start()
+
+
+async def stop_slot(manager: Manager, params: Dict[str, Any]) -> Any:
+    await get_slot(manager, params["name"], int(params["slot_number"])).stop()
+
+
+async def kill_slot(manager: Manager, params: Dict[str, Any]) -> Any:
+    slot = get_slot(manager, params["name"], int(params["slot_number"]))
+    slot.kill(int(params.get("signal", 9)))
+
+
+async def submit_job(manager: Manager, params: Dict[str, Any]) -> Any:
+    service = get_job_queue_service(manager, params["name"])
+    try:
+        job = service.submit(
+            list(params["argv"]),
+            dict(params.get("env", {})),
+            int(params.get("priority", 0)),
+        )
+    except JobQueueFull:
+        raise CommandError(429, "the job queue is full")
+    except ValueError as e:
+        raise CommandError(400, str(e))
+    return job.as_dict()
+
+
+async def jobs_as_list(manager: Manager, params: Dict[str, Any]) -> Any:
+    service = get_job_queue_service(manager, params["name"])
+    return [x.as_dict() for x in service.queue.jobs.values()]
+
+
+async def job_as_dict(manager: Manager, params: Dict[str, Any]) -> Any:
+    service = get_job_queue_service(manager, params["name"])
+    job = service.queue.jobs.get(params["id"])
+    if job is None:
+        raise CommandError(404, "job not found")
+    return job.as_dict()
+
+
+COMMANDS: Dict[str, Callable[[Manager, Dict[str, Any]], Awaitable[Any]]] = {
+    "manager": manager_as_dict,
+    "spawn_scheduler": spawn_scheduler_as_dict,
+    "budget": budget_as_dict,
+    "stop_all": stop_all,
+    "shutdown": shutdown,
+    "services": services_as_list,
+    "service": service_as_dict,
+    "add_service": add_service,
+    "remove_service": remove_service,
+    "start_service": start_service,
+    "stop_service": stop_service,
+    "scale_service": scale_service,
+    "scale_service_up": scale_service_up,
+    "scale_service_down": scale_service_down,
+    "start_slot": start_slot,
+    "stop_slot": stop_slot,
+    "kill_slot": kill_slot,
+    "submit_job": submit_job,
+    "jobs": jobs_as_list,
+    "job": job_as_dict,
+}
+
+
+# command => required parameters
+REQUIRED_PARAMS: Dict[str, Tuple[str, ...]] = {
+    "service": ("name",),
+    "remove_service": ("name",),
+    "start_service": ("name",),
+    "stop_service": ("name",),
+    "scale_service": ("name", "workers"),
+    "scale_service_up": ("name",),
+    "scale_service_down": ("name",),
+    "start_slot": ("name", "slot_number"),
+    "stop_slot": ("name", "slot_number"),
+    "kill_slot": ("name", "slot_number"),
+    "submit_job": ("name", "argv"),
+    "jobs": ("name",),
+    "job": ("name", "id"),
+    "operation": ("id",),
+}
+
+
+def check_params(command: str, params: Dict[str, Any]):
+    """Check that required parameters of a command are there.
+
+    Raises:
+        CommandError: if a parameter is missing.
+    """
+    for param in REQUIRED_PARAMS.get(command, ()):
+        if param not in params:
+            raise CommandError(400, f"missing parameter: {param}")
+
+
+async def execute(manager: Manager, command: str, params: Dict[str, Any]) -> Any:
+    """Execute a control command on the manager.
+
+    Raises:
+        CommandError: if the command fails (unknown command, service not found...).
+    """
+    if command not in COMMANDS:
+        raise CommandError(400, f"unknown command: {command}")
+    check_params(command, params)
+    return await COMMANDS[command](manager, params)
@@ -0,0 +1,383 @@
+"""Unix domain socket control API (newline-delimited json).
+
+Each request is a json object on a single line:
+
+    {"id": 1, "command": "scale_service", "params": {"name": "foo", "workers": 3}}
+
+Each response is a json object on a single line with the same id:
+
+    {"id": 1, "result": null}
+    {"id": 2, "error": {"status_code": 404, "detail": "service not found"}}
+
+Requests are pipelined: several requests can be sent without waiting for
+responses (responses can come in a different order, use ids).
+
+The special "subscribe" command (params: interval, default 1.0, minimum 0.1) pushes
+{"id": ..., "event": <manager as dict>} lines each time the manager changes (until
+an "unsubscribe" command with the same id or the connection end).
+
+Authentication relies on filesystem permissions (the socket is created with 0600
+mode).
+
+This module is imported by the CLI client, so keep top-level imports light.
+"""
+
+from typing import (
+    Any,
+    Dict,
+    Optional,
+    Callable,
+    Awaitable,
+    Iterator,
+    Set,
+    TYPE_CHECKING,
+)
+import json
+import os
+import socket
+import tempfile
+
+# minimum interval (in seconds) between two subscription events
+MIN_SUBSCRIPTION_INTERVAL = 0.1
+
+# default HTTP API port (of the CLI)
+DEFAULT_PORT = 8000
+
+
+def default_socket_path(port: int = DEFAULT_PORT) -> str:
+    """Return the default control socket path of the daemon on a HTTP port.
+
+    (keyed by uid and port, so several daemons can run side by side)
+    """
+    return os.path.join(tempfile.gettempdir(), f"alwaysup-{os.getuid()}-{port}.sock")
+
+
+DEFAULT_SOCKET_PATH = default_socket_path()
+
+if TYPE_CHECKING:
+    import asyncio
+
+Executor = Callable[[str, Dict[str, Any]], Awaitable[Any]]
+
+
+def _dumps(obj: Any) -> bytes:
+    return (json.dumps(obj, default=str) + "\n").encode()
+
+
+_BAD_REQUEST = _dumps({"error": {"status_code": 400, "detail": "bad request"}})
+
+
+class ControlServer:
+    """Unix socket control server.
+
+    Attributes:
+        path: full path of the unix socket.
+        execute: coroutine function (command, params) => result which raises
+            CommandError on errors.
+        snapshot: function which returns the manager as a dict (for subscriptions).
+    """
+
+    def __init__(
+        self, path: str, execute: Executor, snapshot: Callable[[], Dict[str, Any]]
+    ):
+        import mflog
+
+        self.path: str = path
+        self.execute: Executor = execute
+        self.snapshot = snapshot
+        self.logger = mflog.get_logger("alwaysup.control").bind(path=path)
+        self._server: Optional["asyncio.AbstractServer"] = None
+        self._connections: Set["asyncio.Task"] = set()
+        self._requests: Set["asyncio.Task"] = set()
+        # (concurrent drain() calls are not supported before python 3.10)
+        self._write_locks: Dict[Any, "asyncio.Lock"] = {}
+
+    def is_used(self) -> bool:
+        """Return True if another process is listening on the socket."""
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+            try:
+                s.connect(self.path)
+            except OSError:
+                return False
+        return True
+
+    async def start(self):
+        """Start listening (a stale socket file is removed).
+
+        Raises:
+            Exception: if the socket is used by another process.
+        """
+        import asyncio
+
+        if os.path.exists(self.path):
+            if self.is_used():
+                raise Exception(f"the control socket: {self.path} is already used")
+            os.unlink(self.path)
+        old_umask = os.umask(0o177)
+        try:
+            self._server = await asyncio.start_unix_server(
+                self._handle_connection, path=self.path
+            )
+        finally:
+            os.umask(old_umask)
+        self.logger.info("Control socket listening")
+
+    async def stop(self, timeout: float = 1.0):
+        """Stop listening and close opened connections.
+
+        In flight requests are given timeout seconds to send their responses.
+        """
+        import asyncio
+
+        if self._server is None:
+            return
+        self._server.close()
+        await self._server.wait_closed()
+        self._server = None
+        # (wait_closed() doesn't wait for opened connections)
+        if self._requests:
+            await asyncio.wait(list(self._requests), timeout=timeout)
+        connections = list(self._connections)
+        for task in connections:
+            task.cancel()
+        await asyncio.gather(*connections, return_exceptions=True)
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+    async def _handle_connection(
+        self, reader: "asyncio.StreamReader", writer: "asyncio.StreamWriter"
+    ):
+        import asyncio
+
+        current = asyncio.current_task()
+        assert current is not None
+        self._connections.add(current)
+        tasks: Dict[Any, asyncio.Task] = {}
+        subscriptions: Dict[Any, asyncio.Task] = {}
+        self._write_locks[writer] = asyncio.Lock()
+        try:
+            while True:
+                try:
+                    line = await reader.readline()
+                except ValueError:
+                    # (line too long, the buffer is discarded)
+                    await self._write(writer, _BAD_REQUEST)
+                    continue
+                if not line:
+                    break
+                try:
+                    request = json.loads(line)
+                    rid = request.get("id")
+                    command = request["command"]
+                    params = request.get("params", {})
+                    if command == "subscribe":
+                        interval = max(
+                            float(params.get("interval", 1.0)),
+                            MIN_SUBSCRIPTION_INTERVAL,
+                        )
+                except (ValueError, KeyError, AttributeError, TypeError):
+                    await self._write(writer, _BAD_REQUEST)
+                    continue
+                if command == "subscribe":
+                    subscriptions[rid] = asyncio.create_task(
+                        self._subscription(writer, rid, interval)
+                    )
+                elif command == "unsubscribe":
+                    if rid in subscriptions:
+                        subscriptions.pop(rid).cancel()
+                    await self._write(writer, _dumps({"id": rid, "result": None}))
+                else:
+                    task = asyncio.create_task(
+                        self._handle_request(writer, rid, command, params)
+                    )
+                    tasks[id(task)] = task
+                    task.add_done_callback(lambda x: tasks.pop(id(x), None))
+                    self._requests.add(task)
+                    task.add_done_callback(self._requests.discard)
+        except ConnectionError:
+            pass
+        finally:
+            for task in list(subscriptions.values()) + list(tasks.values()):
+                task.cancel()
+            writer.close()
+            self._write_locks.pop(writer, None)
+            self._connections.discard(current)
+
+    async def _handle_request(
+        self, writer: "asyncio.StreamWriter", rid: Any, command: str, params: Dict
+    ):
+        from alwaysup.commands import CommandError
+
+        try:
+            result = await self.execute(command, params)
+            response = {"id": rid, "result": result}
+        except CommandError as e:
+            response = {
+                "id": rid,
+                "error": {"status_code": e.status_code, "detail": e.detail},
+            }
+        except Exception as e:
+            self.logger.warning("exception during command", exc_info=True)
+            response = {"id": rid, "error": {"status_code": 500, "detail": str(e)}}
+        try:
+            await self._write(writer, _dumps(response))
+        except ConnectionError:
+            pass
+
+    async def _write(self, writer: "asyncio.StreamWriter", data: bytes):
+        # (drain() blocks a client which doesn't read, so its buffer is bounded)
+        lock = self._write_locks.get(writer)
+        if lock is None or writer.is_closing():
+            return
+        async with lock:
+            writer.write(data)
+            await writer.drain()
+
+    async def _subscription(
+        self, writer: "asyncio.StreamWriter", rid: Any, interval: float
+    ):
+        import asyncio
+
+        latest: Optional[bytes] = None
+        while not writer.is_closing():
+            event = _dumps({"id": rid, "event": self.snapshot()})
+            if event != latest:
+                try:
+                    await self._write(writer, event)
+                except ConnectionError:
+                    return
+                latest = event
+            await asyncio.sleep(interval)
+
+
+class ControlClient:
+    """Synchronous (stdlib only) client for the unix socket control API.
+
+    Attributes:
+        path: full path of the unix socket.
+        timeout: socket timeout (in seconds, None => no timeout).
+    """
+
+    def __init__(
+        self, path: str = DEFAULT_SOCKET_PATH, timeout: Optional[float] = None
+    ):
+        self.path: str = path
+        self.timeout: Optional[float] = timeout
+        self._socket: Optional[socket.socket] = None
+        self._file: Any = None
+        self._next_id: int = 0
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.path)
+        except Exception:
+            sock.close()
+            raise
+        self._socket = sock
+        self._file = sock.makefile("rb")
+
+    def close(self):
+        if self._socket is not None:
+            self._file.close()
+            self._socket.close()
+            self._socket = None
+
+    def __enter__(self):
+        self.connect()
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def send(self, command: str, **params) -> int:
+        """Send a request (without waiting for the response) and return its id."""
+        if self._socket is None:
+            self.connect()
+        assert self._socket is not None
+        self._next_id += 1
+        request = {"id": self._next_id, "command": command, "params": params}
+        self._socket.sendall(_dumps(request))
+        return self._next_id
+
+    def receive(self) -> Dict[str, Any]:
+        """Receive the next response (or event) as a dict."""
+        line = self._file.readline()
+        if not line:
+            raise ConnectionError("connection closed by the daemon")
+        return json.loads(line)
+
+    def request(self, command: str, **params) -> Any:
+        """Send a request, wait for the response and return the result.
+
+        Raises:
+            ControlError: if the daemon returns an error.
+        """
+        rid = self.send(command, **params)
+        while True:
+            response = self.receive()
+            if response.get("id") == rid:
+                break
+        if "error" in response:
+            raise ControlError(
+                response["error"]["status_code"], response["error"]["detail"]
+            )
+        return response["result"]
+
+    def subscribe(self, interval: float = 1.0) -> Iterator[Dict[str, Any]]:
+        """Yield the manager (as a dict) each time it changes."""
+        rid = self.send("subscribe", interval=interval)
+        while True:
+            response = self.receive()
+            if response.get("id") == rid and "event" in response:
+                yield response["event"]
+
+
+async def async_request(
+    path: str, command: str, params: Dict[str, Any] = {}, timeout: float = 10.0
+) -> Any:
+    """Send a single request (on a new connection) from an event loop.
+
+    Raises:
+        ControlError: if the daemon returns an error.
+        ConnectionError: if the daemon is not reachable.
+        asyncio.TimeoutError: in case of timeout.
+    """
+    import asyncio
+
+    async def _request():
+        reader, writer = await asyncio.open_unix_connection(path)
+        try:
+            writer.write(_dumps({"id": 1, "command": command, "params": params}))
+            await writer.drain()
+            while True:
+                line = await reader.readline()
+                if not line:
+                    raise ConnectionError("connection closed by the daemon")
+                response = json.loads(line)
+                if response.get("id") == 1:
+                    return response
+        finally:
+            writer.close()
+
+    try:
+        response = await asyncio.wait_for(_request(), timeout)
+    except FileNotFoundError:
+        raise ConnectionError(f"no control socket: {path}")
+    if "error" in response:
+        raise ControlError(
+            response["error"]["status_code"], response["error"]["detail"]
+        )
+    return response["result"]
+
+
+class ControlError(Exception):
+    """Error returned by the daemon (through the control socket)."""
+
+    def __init__(self, status_code: int, detail: str):
+        super().__init__(f"{status_code}: {detail}")
+        self.status_code: int = status_code
+        self.detail: str = detail
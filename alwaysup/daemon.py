@@ -1,13 +1,14 @@
-from typing import Optional, List, cast
+from typing import Optional, List, Dict, Any, Set
 import mflog
 import asyncio
+import json
 import signal
 import os
 import sys
-import daemonocle
 from pydantic import BaseModel  # pylint: disable=E0611
 from pydantic.dataclasses import dataclass
-from fastapi import FastAPI, HTTPException, Body, Request
+from fastapi import FastAPI, HTTPException, Body, Request, Response
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from fastapi.templating import Jinja2Templates
 from fastapi.staticfiles import StaticFiles
 import uvicorn
@@ -15,7 +16,26 @@ from mfutil.net import ping_tcp_port
 from alwaysup.manager import Manager
 from alwaysup.cmd import Cmd, CmdConfiguration
 from alwaysup.service import Service
+from alwaysup.jobs import JobQueueService, JobQueueSettings
 from alwaysup.utils import log_exceptions
+from alwaysup.journal import Journal, ServiceRecord, DEFAULT_FSYNC_INTERVAL
+from alwaysup.commands import CommandError, check_params, execute as execute_command
+from alwaysup.control import ControlServer, default_socket_path
+from alwaysup.shard import ShardCoordinator
+from alwaysup.status_table import StatusTable
+from alwaysup.scheduler import SpawnScheduler
+from alwaysup.budget import WorkerBudget
+from alwaysup.logqueue import LogPipeline, DEFAULT_QUEUE_SIZE, DEFAULT_RATE
+from alwaysup.loop import LoopBackend, install_loop_policy, resolve_loop_backend
+from alwaysup.tracing import TRACER
+from alwaysup.supervisor import Supervisor
+from alwaysup.debug import LoopMonitor, tasks_as_dict, profile_loop
+from alwaysup.operations import (
+    OPERATION_COMMANDS,
+    Operation,
+    Operations,
+    set_current_operation,
+)
 
 dir_path = os.path.dirname(os.path.realpath(__file__))
 app = FastAPI()
@@ -23,6 +43,11 @@ app.mount(
     "/static", StaticFiles(directory=os.path.join(dir_path, "static")), name="static"
 )
 __daemon: Optional["Daemon"] = None
+MAX_PROFILE_SECONDS = 300
+# commands served from the published snapshot (with a supervision thread)
+SNAPSHOT_COMMANDS = ("manager", "services", "service")
+# polling interval (in seconds) of operation streams
+OPERATION_STREAM_INTERVAL = 0.2
 templates = Jinja2Templates(directory=os.path.join(dir_path, "templates"))
 
 
@@ -51,78 +76,141 @@ async def shutdown_event():
 
 @app.get("/")
 async def home(request: Request):
-    manager = get_instance().manager
     return templates.TemplateResponse(
-        "home.html", {"request": request, "manager": manager.as_dict()}
+        "home.html", {"request": request, "manager": get_instance().snapshot()}
     )
 
 
 @app.get("/__content")
 async def content(request: Request):
-    manager = get_instance().manager
     return templates.TemplateResponse(
-        "__content.html", {"request": request, "manager": manager.as_dict()}
+        "__content.html", {"request": request, "manager": get_instance().snapshot()}
     )
 
 
+async def execute(command: str, params: Dict[str, Any] = {}) -> Any:
+    try:
+        return await get_instance().execute(command, params)
+    except CommandError as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail)
+
+
 @app.get("/manager")
 async def get_manager():
-    manager = get_instance().manager
-    return manager.as_dict()
+    return await execute("manager")
+
+
+@app.get("/manager/spawn_scheduler")
+async def get_spawn_scheduler():
+    return await execute("spawn_scheduler")
+
+
+@app.get("/manager/budget")
+async def get_budget():
+    return await execute("budget")
 
 
 @app.post("/manager/shutdown")
 async def manager_shutdown():
-    manager = get_instance().manager
-    await manager.shutdown()
-    os.kill(os.getpid(), 15)
+    await execute("shutdown")
+
+
+@app.post("/manager/detach")
+async def manager_detach():
+    await execute("detach")
 
 
 @app.post("/manager/stop_all")
 async def stop_all_services():
-    manager = get_instance().manager
-    await manager.stop_all()
+    await execute("stop_all")
 
 
 @app.get("/services")
 async def get_services():
-    manager = get_instance().manager
-    return [x.as_dict() for x in manager.services.values()]
+    return await execute("services")
 
 
 @app.get("/services/{service_name}")
 async def get_service(service_name: str):
-    manager = get_instance().manager
-    if service_name not in manager.services:
-        raise HTTPException(status_code=404, detail="service not found")
-    return manager.services[service_name].as_dict()
+    return await execute("service", {"name": service_name})
+
+
+async def execute_maybe_as_operation(
+    command: str, params: Dict[str, Any], wait: bool, response: Response
+) -> Any:
+    res = await execute(command, dict(params, wait=wait))
+    if not wait:
+        response.status_code = 202
+    return res
 
 
 @app.post("/services/{service_name}/stop")
-async def stop_service(service_name: str):
-    manager = get_instance().manager
-    if service_name not in manager.services:
-        raise HTTPException(status_code=404, detail="service not found")
-    await manager.services[service_name].stop()
+async def stop_service(service_name: str, response: Response, wait: bool = True):
+    params = {"name": service_name}
+    return await execute_maybe_as_operation("stop_service", params, wait, response)
 
 
 @app.post("/services/{service_name}/start")
-async def start_service(service_name: str):
-    manager = get_instance().manager
-    if service_name not in manager.services:
-        raise HTTPException(status_code=404, detail="service not found")
-    await manager.services[service_name].start()
+async def start_service(service_name: str, response: Response, wait: bool = True):
+    params = {"name": service_name}
+    return await execute_maybe_as_operation("start_service", params, wait, response)
+
+
+@app.get("/operations")
+async def get_operations():
+    return await execute("operations")
+
+
+@app.get("/operations/{operation_id}")
+async def get_operation(operation_id: str):
+    return await execute("operation", {"id": operation_id})
+
+
+@app.get("/operations/{operation_id}/stream")
+async def stream_operation(operation_id: str):
+    operation = get_instance().get_operation(operation_id)
+    if operation is None:
+        raise HTTPException(status_code=404, detail="operation not found")
+
+    async def _stream():
+        # (one json line per progress change, until the end of the operation)
+        latest = None
+        while True:
+            d = operation.as_dict()
+            current = (d["state"], d["total"], d["done"], len(d["errors"]))
+            if current != latest:
+                latest = current
+                yield json.dumps(d, default=str) + "\n"
+            if operation.is_finished():
+                return
+            await asyncio.sleep(OPERATION_STREAM_INTERVAL)
+
+    return StreamingResponse(_stream(), media_type="application/x-ndjson")
 
 
 @app.post("/services/{service_name}/slots/{slot_number}/sigkill")
 async def kill_slot(service_name: str, slot_number: int):
-    manager = get_instance().manager
-    if service_name not in manager.services:
-        raise HTTPException(status_code=404, detail="service not found")
-    if slot_number not in manager.services[service_name].slots:
-        raise HTTPException(status_code=404, detail="slot not found")
-    slot = manager.services[service_name].slots[slot_number]
-    slot.kill(9)
+    await execute("kill_slot", {"name": service_name, "slot_number": slot_number})
+
+
+@app.get("/debug/loop")
+async def debug_loop():
+    return await execute("debug_loop")
+
+
+@app.get("/debug/log")
+async def debug_log():
+    return await execute("debug_log")
+
+
+@app.get("/debug/tasks")
+async def debug_tasks():
+    return await execute("debug_tasks")
+
+
+@app.get("/debug/profile", response_class=PlainTextResponse)
+async def debug_profile(seconds: float = 10.0, interval: float = 0.005):
+    return await execute("debug_profile", {"seconds": seconds, "interval": interval})
 
 
 class ScaleBody(BaseModel):
@@ -133,80 +221,77 @@ class ScaleBody(BaseModel):
 class ServiceBody(CmdConfiguration):
     name: Optional[str] = None
     workers: int = 1
+    job_queue: Optional[Dict[str, Any]] = None
+
+
+class JobBody(BaseModel):
+    argv: List[str]
+    env: Dict[str, str] = {}
+    priority: int = 0
 
 
 @app.post("/services/add", status_code=201)
 async def add_service(service_body: ServiceBody = Body(...)):
-    if service_body.name is None:
-        raise HTTPException(status_code=400, detail="missing name property in the body")
-    if service_body.program is None:
-        raise HTTPException(
-            status_code=400, detail="missing program property in the body"
-        )
-    manager = get_instance().manager
-    if service_body.name in manager.services:
-        raise HTTPException(status_code=409, detail="service already exist")
-    config: CmdConfiguration = cast(CmdConfiguration, service_body)
-    cmd = Cmd(config)
-    service = Service(service_body.name, service_body.workers, cmd)
-    await manager.add_service(service)
-    return {"name": service_body.name}
+    params = {
+        "name": service_body.name,
+        "workers": service_body.workers,
+        "config": service_body.to_dict(),
+        "job_queue": service_body.job_queue,
+    }
+    return await execute("add_service", params)
+
+
+@app.post("/services/{service_name}/jobs", status_code=201)
+async def submit_job(service_name: str, job_body: JobBody = Body(...)):
+    params = {"name": service_name, **job_body.dict()}
+    return await execute("submit_job", params)
+
+
+@app.get("/services/{service_name}/jobs")
+async def get_jobs(service_name: str):
+    return await execute("jobs", {"name": service_name})
+
+
+@app.get("/services/{service_name}/jobs/{job_id}")
+async def get_job(service_name: str, job_id: str):
+    return await execute("job", {"name": service_name, "id": job_id})
 
 
 @app.post("/services/{service_name}/scale")
-async def scale_service(service_name: str, scale_body: ScaleBody = Body(...)):
-    manager = get_instance().manager
-    if service_name not in manager.services:
-        raise HTTPException(status_code=404, detail="service not found")
-    await manager.services[service_name].set_slot_number(scale_body.workers)
+async def scale_service(
+    service_name: str,
+    response: Response,
+    scale_body: ScaleBody = Body(...),
+    wait: bool = True,
+):
+    params = {"name": service_name, "workers": scale_body.workers}
+    return await execute_maybe_as_operation("scale_service", params, wait, response)
 
 
 @app.post("/services/{service_name}/scaleup")
 async def scale_service_up(service_name: str):
-    manager = get_instance().manager
-    if service_name not in manager.services:
-        raise HTTPException(status_code=404, detail="service not found")
-    service = manager.services[service_name]
-    await service.set_slot_number(service.slot_number + 1)
+    await execute("scale_service_up", {"name": service_name})
 
 
 @app.post("/services/{service_name}/scaledown")
 async def scale_service_down(service_name: str):
-    manager = get_instance().manager
-    if service_name not in manager.services:
-        raise HTTPException(status_code=404, detail="service not found")
-    service = manager.services[service_name]
-    await service.set_slot_number(max(service.slot_number - 1, 1))
+    await execute("scale_service_down", {"name": service_name})
 
 
 @app.delete("/services/{service_name}")
-async def delete_service(service_name: str):
-    manager = get_instance().manager
-    if service_name not in manager.services:
-        raise HTTPException(status_code=404, detail="service not found")
-    await manager.shutdown_and_remove_service(service_name)
+async def delete_service(service_name: str, response: Response, wait: bool = True):
+    params = {"name": service_name}
+    return await execute_maybe_as_operation("remove_service", params, wait, response)
 
 
 @app.post("/services/{service_name}/slots/{slot_number}/stop")
 async def stop_slot(service_name: str, slot_number: int):
-    manager = get_instance().manager
-    if service_name not in manager.services:
-        raise HTTPException(status_code=404, detail="service not found")
-    service = manager.services[service_name]
-    if slot_number not in service.slots:
-        raise HTTPException(status_code=404, detail="slot not found")
-    await service.slots[slot_number].stop()
+    await execute("stop_slot", {"name": service_name, "slot_number": slot_number})
 
 
 @app.post("/services/{service_name}/slots/{slot_number}/start")
 async def start_slot(service_name: str, slot_number: int):
-    manager = get_instance().manager
-    if service_name not in manager.services:
-        raise HTTPException(status_code=404, detail="service not found")
-    service = manager.services[service_name]
-    if slot_number not in service.slots:
-        raise HTTPException(status_code=404, detail="slot not found")
-    await service.slots[slot_number].start()
+    await execute("start_slot", {"name": service_name, "slot_number": slot_number})
 
 
 class Daemon:
@@ -218,41 +303,335 @@ class Daemon:
         log_configure_logger: bool = True,
         log_minimal_level: str = "INFO",
         log_fancy_output: Optional[bool] = None,
+        journal_path: Optional[str] = None,
+        journal_fsync_interval: float = DEFAULT_FSYNC_INTERVAL,
+        readopt: bool = False,
+        socket_path: Optional[str] = None,
+        slow_callback_threshold: float = 0.1,
+        trace_path: Optional[str] = None,
+        supervisor_thread: bool = True,
+        shards: int = 0,
+        shard_stdout: str = "NULL",
+        loop: str = "auto",
+        status_table_path: Optional[str] = None,
+        spawn_scheduler: Optional[SpawnScheduler] = None,
+        worker_budget: float = 0.0,
+        log_queue_size: int = DEFAULT_QUEUE_SIZE,
+        log_rate: float = DEFAULT_RATE,
     ):
-        self.manager: Manager = Manager()
-        self.__wait_task = None
-        self.services_to_add = services_to_add
-        self.__shutdown_task = None
-        self.port = port
-        self.bind_host = bind_host
         self.log_minimal_level = log_minimal_level
         self.log_fancy_output = log_fancy_output
         self.log_configure_logger = log_configure_logger
+        self.log_pipeline: Optional[LogPipeline] = None
         if self.log_configure_logger:
+            # (before any logger use, see LogPipeline.install())
             mflog.set_config(
                 fancy_output=self.log_fancy_output, minimal_level=self.log_minimal_level
             )
+            if log_queue_size > 0:
+                self.log_pipeline = LogPipeline(
+                    queue_size=log_queue_size, rate=log_rate
+                )
+                self.log_pipeline.install()
+        self.loop_backend: LoopBackend = resolve_loop_backend(LoopBackend[loop.upper()])
+        self.journal: Optional[Journal] = None
+        if journal_path and shards == 0:
+            self.journal = Journal(journal_path, journal_fsync_interval)
+        self.readopt = readopt
+        self.trace_path = trace_path
+        self.supervisor_thread = supervisor_thread
+        self.supervisor: Optional[Supervisor] = None
+        self.status_table: Optional[StatusTable] = None
+        if status_table_path and shards == 0:
+            self.status_table = StatusTable(status_table_path)
+        self.manager: Manager = Manager(
+            journal=self.journal,
+            status_table=self.status_table,
+            spawn_scheduler=spawn_scheduler if shards == 0 else None,
+            budget=WorkerBudget(worker_budget) if shards == 0 else None,
+        )
+        self.coordinator: Optional[ShardCoordinator] = None
+        if shards > 0:
+            # shards have their own journals (and always re-adopt processes)
+            self.coordinator = ShardCoordinator(
+                self.manager,
+                shards,
+                socket_path or default_socket_path(port),
+                journal_path=journal_path,
+                stdout=shard_stdout,
+                loop=self.loop_backend.name.lower(),
+                status_table_path=status_table_path,
+                spawn_scheduler=spawn_scheduler,
+                worker_budget=worker_budget,
+            )
+        self.__wait_task = None
+        self.services_to_add = services_to_add
+        self.__shutdown_task = None
+        self.__profiling = False
+        self.operations: Operations = Operations()
+        self._operation_tasks: Set[asyncio.Task] = set()
+        self.port = port
+        self.bind_host = bind_host
         self.logger = mflog.get_logger("alwaysup.daemon")
+        self.loop_monitor = LoopMonitor(slow_callback_threshold=slow_callback_threshold)
+        self.control: Optional[ControlServer] = None
+        self._api_loop: Optional[asyncio.AbstractEventLoop] = None
+        if socket_path:
+            self.control = ControlServer(socket_path, self.execute, self.snapshot)
 
     @property
     def api(self):
         return self.port > 0
 
+    async def execute(self, command: str, params: Dict[str, Any]) -> Any:
+        """Execute a control command (see alwaysup.commands).
+
+        With a supervision thread, read commands are served from the published
+        snapshot and other commands are executed on the supervision loop.
+
+        Raises:
+            CommandError: if the command fails.
+        """
+        check_params(command, params)
+        if command == "detach":
+            return await self.detach()
+        if command == "operations":
+            return self.operations.as_list()
+        if command == "operation":
+            operation = self.get_operation(params["id"])
+            if operation is None:
+                raise CommandError(404, "operation not found")
+            return operation.as_dict()
+        if command in OPERATION_COMMANDS and not params.get("wait", True):
+            return self._start_operation(command, params)
+        if self.supervisor is None:
+            res = await self._execute(command, params)
+        elif command in SNAPSHOT_COMMANDS and not (
+            self.coordinator is not None and command == "service"
+        ):
+            # (in sharded mode, a single service is read from its shard)
+            return self._read_snapshot(command, params)
+        else:
+            try:
+                res = await self.supervisor.call(self._execute(command, params))
+            except RuntimeError:
+                # the supervision loop is closed
+                raise CommandError(503, "the supervisor is not running")
+        if command == "shutdown" and self.api:
+            # let's stop uvicorn
+            os.kill(os.getpid(), 15)
+        return res
+
+    def get_operation(self, operation_id: str) -> Optional[Operation]:
+        return self.operations.get(operation_id)
+
+    def _start_operation(self, command: str, params: Dict[str, Any]) -> Any:
+        params = {x: y for x, y in params.items() if x != "wait"}
+        operation = self.operations.create(command, params)
+        task = asyncio.create_task(
+            log_exceptions(self._run_operation(operation, command, params))
+        )
+        self._operation_tasks.add(task)
+        task.add_done_callback(self._operation_tasks.discard)
+        return operation.as_dict()
+
+    async def _run_operation(
+        self, operation: Operation, command: str, params: Dict[str, Any]
+    ):
+        # (this task has its own context, see alwaysup.operations)
+        set_current_operation(operation)
+        try:
+            operation.succeed(await self.execute(command, params))
+        except CommandError as e:
+            operation.fail(e.detail)
+        except Exception as e:
+            operation.fail(str(e) or e.__class__.__name__)
+
+    async def _execute(self, command: str, params: Dict[str, Any]) -> Any:
+        if command == "debug_loop":
+            return self.loop_monitor.as_dict()
+        if command == "debug_tasks":
+            return tasks_as_dict()
+        if command == "debug_log":
+            if self.log_pipeline is None:
+                return {"enabled": False}
+            return dict(self.log_pipeline.as_dict(), enabled=True)
+        if command == "debug_profile":
+            return await self.profile(
+                float(params.get("seconds", 10.0)), float(params.get("interval", 0.005))
+            )
+        if self.coordinator is not None:
+            return await self.coordinator.execute(command, params)
+        return await execute_command(self.manager, command, params)
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Return the manager as a dict (the published one with a supervisor).
+
+        In sharded mode, the merged snapshot of all shards is returned.
+        """
+        if self.coordinator is not None:
+            return self.coordinator.snapshot
+        if self.supervisor is None:
+            return self.manager.as_dict()
+        return self.supervisor.snapshot
+
+    def _read_snapshot(self, command: str, params: Dict[str, Any]) -> Any:
+        snapshot = self.snapshot()
+        if command == "manager":
+            return snapshot
+        services = snapshot.get("services", {})
+        if command == "services":
+            return list(services.values())
+        if params.get("name") not in services:
+            raise CommandError(404, "service not found")
+        return services[params["name"]]
+
+    async def profile(self, seconds: float, interval: float = 0.005) -> str:
+        """Profile the event loop thread (see alwaysup.debug.SamplingProfiler).
+
+        Raises:
+            CommandError: if a profiling is already running or if parameters are
+                invalid.
+        """
+        if not 0 < seconds <= MAX_PROFILE_SECONDS or interval < 0.001:
+            raise CommandError(
+                400, f"seconds must be in ]0, {MAX_PROFILE_SECONDS}], interval >= 1ms"
+            )
+        if self.__profiling:
+            raise CommandError(409, "a profiling is already running")
+        self.__profiling = True
+        try:
+            return await profile_loop(seconds, interval)
+        finally:
+            self.__profiling = False
+
     def start_manager_as_a_task(self):
+        if self.supervisor_thread:
+            self._api_loop = asyncio.get_event_loop()
+            self.supervisor = Supervisor(self.manager, self.__start_manager)
+            self.supervisor.start()
+            return
         self.__wait_task = asyncio.create_task(log_exceptions(self.__start_manager()))
 
     async def __start_manager(self):
-        for service in self.services_to_add:
-            await self.manager.add_service(service)
+        services = list(self.services_to_add)
+        self.loop_monitor.start()
+        if self.trace_path:
+            TRACER.set_export_path(self.trace_path)
+        if self.status_table is not None:
+            self.status_table.open()
+            self.status_table.start()
+        if self.journal is not None:
+            # (without readopt, services dropped from the configuration must not
+            # come back with the next readopt start)
+            records = self.journal.open(replay=self.readopt)
+            self.journal.start()
+            if self.readopt:
+                services = self._services_to_readopt(services, records)
+        if self.coordinator is not None:
+            await self.coordinator.start()
+            for service in services:
+                await log_exceptions(self.coordinator.add_service(service))
+        else:
+            for service in services:
+                await self.manager.add_service(service)
+        # (after services, so clients never see a partially re-adopted daemon)
+        if self.control is not None:
+            if self.supervisor is not None:
+                # (control traffic is served by the API loop, see execute())
+                assert self._api_loop is not None
+                future = asyncio.run_coroutine_threadsafe(
+                    self.control.start(), self._api_loop
+                )
+                await asyncio.wrap_future(future)
+            else:
+                await self.control.start()
         await self.manager.wait()
+        if self.coordinator is not None:
+            await self.coordinator.stop()
+        if self.control is not None and self.supervisor is None:
+            await self.control.stop()
+        if self.journal is not None:
+            await self.journal.close()
+        if self.status_table is not None:
+            await self.status_table.close()
+        await self.loop_monitor.stop()
+        TRACER.close()
+
+    def _services_to_readopt(
+        self, services: List[Service], records: Dict[str, ServiceRecord]
+    ) -> List[Service]:
+        res = list(services)
+        names = [x.name for x in services]
+        for record in records.values():
+            if record.name not in names:
+                cmd = Cmd(CmdConfiguration.from_dict(record.config))
+                if record.job_queue is not None:
+                    settings = JobQueueSettings.from_dict(record.job_queue)
+                    res.append(
+                        JobQueueService(record.name, record.slot_number, cmd, settings)
+                    )
+                else:
+                    res.append(Service(record.name, record.slot_number, cmd))
+        for service in res:
+            if service.name in records:
+                service.set_processes_to_adopt(records[service.name].slots)
+        return res
+
+    async def _shutdown_manager_if_running(self):
+        if self.manager.is_running():
+            await self.manager.shutdown()
 
     async def shutdown_manager(self):
-        await self.manager.shutdown()
+        if self.supervisor is not None:
+            if self.supervisor.is_alive():
+                try:
+                    await self.supervisor.call(self._shutdown_manager_if_running())
+                except RuntimeError:
+                    pass
+            loop = asyncio.get_event_loop()
+            await loop.run_in_executor(None, self.supervisor.join)
+            if self.control is not None:
+                await self.control.stop()
+            return
+        await self._shutdown_manager_if_running()
         if self.__wait_task:
             await self.__wait_task
         if self.__shutdown_task:
             await self.__shutdown_task
 
+    async def detach(self):
+        """Exit immediately without stopping managed processes.
+
+        Managed processes will be re-adopted by the next daemon (if it is started
+        with the same journal and with readopt mode). This is useful for upgrading
+        the daemon without restarting workers.
+
+        Raises:
+            CommandError: if there is no journal.
+
+        """
+        if self.journal is None:
+            raise CommandError(400, "can't detach without a journal")
+        if self.supervisor is not None:
+            # (the journal belongs to the supervision loop)
+            try:
+                await self.supervisor.call(self._detach())
+            except RuntimeError:
+                raise CommandError(503, "the supervisor is not running")
+        else:
+            await self._detach()
+
+    async def _detach(self):
+        assert self.journal is not None
+        self.logger.info("Detaching from managed processes and exiting...")
+        # (waits for an in-flight background write)
+        await self.journal.close()
+        if self.log_pipeline is not None:
+            # (queued records, the one above included, are written)
+            self.log_pipeline.stop()
+        os._exit(0)
+
     def _sig_handler(self, *args, **kwargs):
         if self.__shutdown_task is not None:
             self.kill(9)
@@ -262,6 +641,24 @@ class Daemon:
         )
 
     def _run(self):
+        # (started here: threads don't survive the daemonization fork)
+        if self.log_pipeline is not None:
+            self.log_pipeline.start()
+        try:
+            self.__run()
+        finally:
+            if self.log_pipeline is not None:
+                self.log_pipeline.stop()
+
+    def __run(self):
+        # (the same loop backend for all loops: uvicorn, non-API, supervision)
+        install_loop_policy(self.loop_backend)
+        if self.control is not None and self.control.is_used():
+            self.logger.critical(
+                f"the configured control socket: {self.control.path} is already "
+                "used => exit"
+            )
+            sys.exit(1)
         if self.api:
             if ping_tcp_port("127.0.0.1", self.port):
                 self.logger.critical(
@@ -275,7 +672,7 @@ class Daemon:
                 reload=False,
                 port=self.port,
                 host=self.bind_host,
-                loop="auto",
+                loop=self.loop_backend.name.lower(),
                 ws="auto",
                 lifespan="auto",
                 interface="auto",
@@ -283,9 +680,10 @@ class Daemon:
                 access_log=False,
             )
         else:
-            signal.signal(signal.SIGINT, self._sig_handler)
-            signal.signal(signal.SIGTERM, self._sig_handler)
-            loop = asyncio.get_event_loop()
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+            loop.add_signal_handler(signal.SIGINT, self._sig_handler)
+            loop.add_signal_handler(signal.SIGTERM, self._sig_handler)
             loop.run_until_complete(self.__start_manager())
             if self.__shutdown_task is not None:
                 loop.run_until_complete(self.__shutdown_task)
@@ -299,6 +697,9 @@ class Daemon:
 
         if not daemonize:
             return self._run()
+        # (imported here: shards and foreground daemons don't need it)
+        import daemonocle
+
         d = daemonocle.Daemon(
             name="alwaysup/run_forever",
             worker=self._run,
@@ -0,0 +1,300 @@
+"""Event loop introspection (loop lag, slow callbacks, live tasks, profiling).
+
+A blocking callback delays everything running on its event loop: the supervision
+loop (reaping of dead processes, respawns) has its own thread but it is still
+delayed by its own slow callbacks (and by the GIL), and without a supervision
+thread, HTTP handling and template rendering share the same loop.
+"""
+
+from typing import Any, Dict, List, Optional
+import asyncio
+import sys
+import threading
+import time
+import weakref
+import mflog
+
+LOGGER = mflog.get_logger("alwaysup.debug")
+
+# upper bounds (in seconds) of the histogram buckets (the last one is +inf)
+LAG_BUCKETS: List[float] = [0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0]
+
+# task => creation time (monotonic), filled by the task factory
+_TASK_CREATION_TIMES: "weakref.WeakKeyDictionary[asyncio.Task, float]" = (
+    weakref.WeakKeyDictionary()
+)
+
+
+class Histogram:
+    """Simple cumulative histogram with fixed buckets.
+
+    Attributes:
+        buckets: upper bounds of buckets (sorted).
+        counts: number of values per bucket (with an extra +inf bucket).
+        count: total number of values.
+        total: sum of all values.
+        max: maximum value.
+    """
+
+    def __init__(self, buckets: List[float] = LAG_BUCKETS):
+        self.buckets: List[float] = list(buckets)
+        self.counts: List[int] = [0] * (len(self.buckets) + 1)
+        self.count: int = 0
+        self.total: float = 0.0
+        self.max: float = 0.0
+
+    def add(self, value: float):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        else:
+            self.counts[-1] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def as_dict(self) -> Dict[str, Any]:
+        bounds = [str(x) for x in self.buckets] + ["+inf"]
+        return {
+            "buckets": dict(zip(bounds, self.counts)),
+            "count": self.count,
+            "average": self.total / self.count if self.count > 0 else 0.0,
+            "max": self.max,
+        }
+
+
+def _describe_handle(handle: asyncio.Handle) -> str:
+    callback = getattr(handle, "_callback", None)
+    task = getattr(callback, "__self__", None)
+    if isinstance(task, asyncio.Task):
+        return f"task step of {_coro_name(task)}"
+    return repr(handle)
+
+
+def _coro_name(task: asyncio.Task) -> str:
+    coro = task.get_coro()
+    return getattr(coro, "__qualname__", None) or repr(coro)
+
+
+class LoopMonitor:
+    """Event loop lag sampler and slow callback logger.
+
+    The lag is the delay between the expected and the real wake up time of
+    a periodic sleep.
+
+    Attributes:
+        interval: sampling interval (in seconds).
+        slow_callback_threshold: callbacks which run longer (in seconds) are
+            logged (0 => no slow callback logging).
+        lag: lag histogram.
+        slow_callbacks: number of slow callbacks.
+    """
+
+    def __init__(self, interval: float = 0.5, slow_callback_threshold: float = 0.1):
+        self.interval: float = interval
+        self.slow_callback_threshold: float = slow_callback_threshold
+        self.lag: Histogram = Histogram()
+        self.slow_callbacks: int = 0
+        self._task: Optional[asyncio.Task] = None
+        self._original_handle_run = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def start(self):
+        """Start monitoring the running loop."""
+        loop = asyncio.get_running_loop()
+        self._loop = loop
+        install_task_factory(loop)
+        if self.slow_callback_threshold > 0:
+            if isinstance(loop, asyncio.BaseEventLoop):
+                self._install_slow_callback_hook()
+            else:
+                # (uvloop callbacks don't use asyncio.Handle)
+                LOGGER.info("slow callback logging is not available with this loop")
+        self._task = loop.create_task(self._sample())
+
+    async def stop(self):
+        if self._original_handle_run is not None:
+            asyncio.Handle._run = self._original_handle_run  # type: ignore
+            self._original_handle_run = None
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _sample(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            self.lag.add(max(loop.time() - expected, 0.0))
+
+    def _install_slow_callback_hook(self):
+        # asyncio debug mode does the same thing but it's far too expensive for
+        # production, so we wrap Handle._run (used by all callbacks and task steps)
+        original = asyncio.Handle._run  # type: ignore
+        monitor = self
+
+        def _run(handle):
+            # (Handle._run is patched for the whole process, other loops, like
+            # the API one, are not monitored)
+            if handle._loop is not monitor._loop:
+                return original(handle)
+            before = time.monotonic()
+            original(handle)
+            duration = time.monotonic() - before
+            if duration > monitor.slow_callback_threshold:
+                monitor.slow_callbacks += 1
+                LOGGER.warning(
+                    "slow callback detected",
+                    callback=_describe_handle(handle),
+                    duration=round(duration, 3),
+                )
+
+        self._original_handle_run = original
+        asyncio.Handle._run = _run  # type: ignore
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            "interval": self.interval,
+            "lag": self.lag.as_dict(),
+            "slow_callback_threshold": self.slow_callback_threshold,
+            "slow_callbacks": self.slow_callbacks,
+        }
+
+
+def install_task_factory(loop: asyncio.AbstractEventLoop):
+    """Install a task factory which records tasks creation times (for ages).
+
+    An existing task factory is kept (and called).
+    """
+    previous = loop.get_task_factory()
+    if getattr(previous, "_alwaysup", False):
+        return
+
+    def _factory(loop, coro, **kwargs):
+        # (kwargs: context... for python >= 3.11)
+        if previous is not None:
+            task = previous(loop, coro, **kwargs)
+        else:
+            task = asyncio.Task(coro, loop=loop, **kwargs)
+        _TASK_CREATION_TIMES[task] = time.monotonic()
+        return task
+
+    setattr(_factory, "_alwaysup", True)
+    loop.set_task_factory(_factory)
+
+
+def tasks_as_dict() -> Dict[str, Any]:
+    """Return live tasks of the running loop grouped by coroutine.
+
+    Ages are None for tasks created before the task factory installation.
+    """
+    now = time.monotonic()
+    groups: Dict[str, Dict[str, Any]] = {}
+    tasks = asyncio.all_tasks()
+    for task in tasks:
+        name = _coro_name(task)
+        group = groups.setdefault(
+            name, {"coroutine": name, "count": 0, "min_age": None, "max_age": None}
+        )
+        group["count"] += 1
+        created = _TASK_CREATION_TIMES.get(task)
+        if created is None:
+            continue
+        age = now - created
+        if group["min_age"] is None or age < group["min_age"]:
+            group["min_age"] = age
+        if group["max_age"] is None or age > group["max_age"]:
+            group["max_age"] = age
+    return {
+        "total": len(tasks),
+        "coroutines": sorted(groups.values(), key=lambda x: -x["count"]),
+    }
+
+
+class SamplingProfiler:
+    """Statistical profiler of a thread (the event loop one by default).
+
+    A background thread samples the stack of the profiled thread every
+    interval seconds (with sys._current_frames()), so there is no overhead at
+    all when the profiler is not running (no tracing hook).
+
+    Attributes:
+        interval: sampling interval (in seconds).
+        thread_id: identifier of the profiled thread.
+        samples: number of samples.
+        stacks: collapsed stack => number of samples.
+    """
+
+    def __init__(self, interval: float = 0.005, thread_id: Optional[int] = None):
+        self.interval: float = interval
+        self.thread_id: int = (
+            thread_id if thread_id is not None else threading.get_ident()
+        )
+        self.samples: int = 0
+        self.stacks: Dict[str, int] = {}
+        self._stop_event = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def is_running(self) -> bool:
+        return self._thread is not None
+
+    def start(self):
+        self._stop_event.clear()
+        self._thread = threading.Thread(
+            target=self._sample, name="alwaysup-profiler", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stop_event.set()
+        self._thread.join()
+        self._thread = None
+
+    def _sample(self):
+        while not self._stop_event.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            names: List[str] = []
+            while frame is not None:
+                code = frame.f_code
+                names.append(
+                    f"{code.co_name} ({code.co_filename}:{code.co_firstlineno})"
+                )
+                frame = frame.f_back
+            stack = ";".join(reversed(names))
+            self.stacks[stack] = self.stacks.get(stack, 0) + 1
+            self.samples += 1
+
+    def collapsed(self) -> str:
+        """Return samples in collapsed stack format (for flamegraph tools).
+
+        One line per stack: frames (root first) separated by ";", a space and
+        the number of samples (flamegraph tools split on the last space).
+        """
+        return "".join(
+            f"{stack} {count}\n"
+            for stack, count in sorted(self.stacks.items(), key=lambda x: -x[1])
+        )
+
+
+async def profile_loop(seconds: float, interval: float = 0.005) -> str:
+    """Profile the running event loop thread for some seconds.
+
+    Returns:
+        Samples in collapsed stack format.
+    """
+    profiler = SamplingProfiler(interval=interval)
+    profiler.start()
+    try:
+        await asyncio.sleep(seconds)
+    finally:
+        profiler.stop()
+    return profiler.collapsed()
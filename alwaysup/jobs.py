@@ -0,0 +1,434 @@
+"""Job queue services (slots which pull short jobs from a local queue).
+
+A job (argv and env) is submitted through the control API or dropped in a spool
+directory (json files). Jobs are executed by the slots of the service (a bounded
+number of concurrent ManagedProcess), higher priority first then in FIFO order.
+Exit code, duration and the tail of the output (stdout and stderr) of each job are
+recorded.
+
+When the queue is full (max_queue_length), submissions are rejected (back
+pressure) and spool files are left in place until there is room.
+"""
+
+from typing import Any, Deque, Dict, List, Optional, Tuple
+import asyncio
+import collections
+import dataclasses
+import heapq
+import itertools
+import json
+import os
+import time
+import enum
+from mfutil import get_unique_hexa_identifier
+from alwaysup.cmd import Cmd, StdxxxHandler, Templating
+from alwaysup.process import ManagedProcess
+from alwaysup.service import Service
+from alwaysup.slot import ProcessSlot, ProcessSlotState
+from alwaysup.tracing import detach_span
+from alwaysup.utils import log_exceptions
+
+# interval (in seconds) between two scans of the spool directory
+SPOOL_SCAN_INTERVAL = 1.0
+
+
+class JobQueueFull(Exception):
+    pass
+
+
+class JobState(enum.Enum):
+    QUEUED = 1
+    RUNNING = 2
+    SUCCEEDED = 3
+    FAILED = 4
+
+
+@dataclasses.dataclass
+class JobQueueSettings:
+    """Settings of a job queue service.
+
+    Attributes:
+        max_queue_length: maximum number of queued jobs (submissions are
+            rejected above).
+        spool_dir: directory scanned for job files (*.json files with argv, env
+            and priority keys, to be written elsewhere then renamed), None => no
+            spool directory.
+        output_tail_lines: number of output lines kept for each job.
+        max_finished: number of finished jobs kept (for queries).
+    """
+
+    max_queue_length: int = 1000
+    spool_dir: Optional[str] = None
+    output_tail_lines: int = 20
+    max_finished: int = 1000
+
+    @classmethod
+    def from_dict(cls, d: Dict[str, Any]) -> "JobQueueSettings":
+        return cls(**d)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return dataclasses.asdict(self)
+
+
+class Job:
+    """A job (a command executed once by a slot of a job queue service).
+
+    Attributes:
+        id: unique id of the job.
+        argv: command line of the job.
+        env: extra environment variables of the job.
+        priority: priority of the job (higher first).
+        state: state of the job.
+        slot_number: number of the slot which executes (or executed) the job.
+        pid: pid of the process (while running).
+        returncode: return code of the process (or None).
+        error: error message (if the job can't be launched).
+        output: latest lines of the output (stdout and stderr).
+        submitted: submission time (epoch).
+        started: start time (epoch) or None.
+        finished: end time (epoch) or None.
+    """
+
+    def __init__(
+        self,
+        argv: List[str],
+        env: Dict[str, str] = {},
+        priority: int = 0,
+        output_tail_lines: int = 20,
+    ):
+        self.id: str = get_unique_hexa_identifier()
+        self.argv: List[str] = list(argv)
+        self.env: Dict[str, str] = dict(env)
+        self.priority: int = priority
+        self.state: JobState = JobState.QUEUED
+        self.slot_number: Optional[int] = None
+        self.pid: Optional[int] = None
+        self.returncode: Optional[int] = None
+        self.error: Optional[str] = None
+        self.output: Deque[str] = collections.deque(maxlen=output_tail_lines)
+        self.submitted: float = time.time()
+        self.started: Optional[float] = None
+        self.finished: Optional[float] = None
+
+    def is_finished(self) -> bool:
+        return self.state in (JobState.SUCCEEDED, JobState.FAILED)
+
+    def as_dict(self) -> Dict[str, Any]:
+        end = self.finished if self.finished is not None else time.time()
+        return {
+            "id": self.id,
+            "argv": self.argv,
+            "env": self.env,
+            "priority": self.priority,
+            "state": self.state.name,
+            "slot_number": self.slot_number,
+            "pid": self.pid,
+            "returncode": self.returncode,
+            "error": self.error,
+            "output": list(self.output),
+            "submitted": self.submitted,
+            "duration": end - self.started if self.started is not None else None,
+        }
+
+
+class JobQueue:
+    """Priority queue of jobs (and registry of latest finished ones)."""
+
+    def __init__(self, settings: JobQueueSettings):
+        self.settings: JobQueueSettings = settings
+        self.jobs: "collections.OrderedDict[str, Job]" = collections.OrderedDict()
+        self.rejected: int = 0
+        self.counts: Dict[str, int] = {x.name: 0 for x in JobState}
+        self._heap: List[Tuple[int, int, Job]] = []
+        self._sequence = itertools.count()
+        self._waiters: Deque[asyncio.Future] = collections.deque()
+
+    def __len__(self) -> int:
+        return len(self._heap)
+
+    def is_full(self) -> bool:
+        return len(self._heap) >= self.settings.max_queue_length
+
+    def submit(
+        self, argv: List[str], env: Dict[str, str] = {}, priority: int = 0
+    ) -> Job:
+        """Submit a job.
+
+        Raises:
+            JobQueueFull: if the queue is full.
+            ValueError: if argv is empty.
+        """
+        if len(argv) == 0:
+            raise ValueError("argv can't be empty")
+        if self.is_full():
+            self.rejected += 1
+            raise JobQueueFull()
+        job = Job(argv, env, priority, self.settings.output_tail_lines)
+        self.jobs[job.id] = job
+        self.counts[JobState.QUEUED.name] += 1
+        self._purge()
+        self._push(job)
+        return job
+
+    def requeue(self, job: Job):
+        """Put back a job which was not started (even if the queue is full)."""
+        self._push(job)
+
+    def _push(self, job: Job):
+        heapq.heappush(self._heap, (-job.priority, next(self._sequence), job))
+        self._wake_up()
+
+    def _wake_up(self):
+        while len(self._waiters) > 0:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+
+    async def get(self) -> Job:
+        """Wait for the next job (highest priority first)."""
+        while len(self._heap) == 0:
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                if waiter.done() and len(self._heap) > 0:
+                    # (let's give the job to another waiter)
+                    self._wake_up()
+                raise
+        return heapq.heappop(self._heap)[2]
+
+    def set_job_state(self, job: Job, state: JobState):
+        self.counts[job.state.name] -= 1
+        self.counts[state.name] += 1
+        job.state = state
+
+    def _purge(self):
+        finished = [x for x in self.jobs.values() if x.is_finished()]
+        for job in finished[0 : max(len(finished) - self.settings.max_finished, 0)]:
+            del self.jobs[job.id]
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            "queue_length": len(self._heap),
+            "max_queue_length": self.settings.max_queue_length,
+            "full": self.is_full(),
+            "rejected": self.rejected,
+            "jobs_by_state": dict(self.counts),
+        }
+
+
+class JobSlot(ProcessSlot):
+    """A slot which executes jobs of a JobQueue (one at a time).
+
+    The slot is RUNNING while it waits for jobs (without process).
+    """
+
+    def __init__(self, *args, queue: JobQueue, **kwargs):
+        self.queue: JobQueue = queue
+        self.job: Optional[Job] = None
+        self._get_task: Optional[asyncio.Task] = None
+        ProcessSlot.__init__(self, *args, **kwargs)
+
+    def as_dict(self):
+        d = ProcessSlot.as_dict(self)
+        d["job"] = self.job.id if self.job is not None else None
+        return d
+
+    async def _start(self, admitted: bool = False):
+        self.set_state(ProcessSlotState.RUNNING)
+        self.logger.info("Job slot started")
+
+    def _begin_stop(self) -> Optional[ManagedProcess]:
+        if self._get_task is not None:
+            self._get_task.cancel()
+        return ProcessSlot._begin_stop(self)
+
+    async def _manage(self):
+        detach_span()
+        while self.state != ProcessSlotState.SHUTDOWN:
+            if self.state != ProcessSlotState.RUNNING:
+                await self.wait_for_state_change(timeout=1.0)
+                continue
+            self._get_task = asyncio.create_task(self.queue.get())
+            try:
+                job = await self._get_task
+            except asyncio.CancelledError:
+                # (the slot is stopping)
+                continue
+            finally:
+                self._get_task = None
+            if self.state != ProcessSlotState.RUNNING:
+                self.queue.requeue(job)
+                continue
+            await self._run(job)
+
+    def _make_job_cmd(self, job: Job) -> Cmd:
+        config = dataclasses.replace(
+            self.cmd.config,
+            program=job.argv[0],
+            args=job.argv[1:],
+            extra_envs=dict(self.cmd.config.extra_envs, **job.env),
+            templating=Templating.NO,
+            stdxxx_handler=StdxxxHandler.NULL,
+            stdout="PIPE",
+            stderr="STDOUT",
+        )
+        return Cmd(config)
+
+    async def _run(self, job: Job):
+        if not await self.spawn_scheduler.acquire(
+            self.name_prefix, self.cmd.spawn_priority
+        ):
+            # (manager shutdown)
+            self.queue.requeue(job)
+            return
+        self.job = job
+        job.slot_number = self.slot_number
+        job.started = time.time()
+        self.queue.set_job_state(job, JobState.RUNNING)
+        try:
+            process = ManagedProcess(
+                self.name,
+                self._make_job_cmd(job),
+                self.cgroup,
+                self.stop_stats,
+                self.cpus,
+            )
+            self.managed_process = process
+            await process.start()
+            job.pid = process.pid
+            if process.stdout is not None:
+                await _read_output(process.stdout, job)
+            await process.wait()
+            job.returncode = process.returncode
+            if job.returncode is None:
+                job.error = "can't launch the job"
+        except Exception as e:
+            self.logger.warning("job failure", exc_info=True)
+            job.error = str(e) or e.__class__.__name__
+        finally:
+            self.managed_process = None
+            self.job = None
+            job.pid = None
+            job.finished = time.time()
+            self.queue.set_job_state(
+                job, JobState.SUCCEEDED if job.returncode == 0 else JobState.FAILED
+            )
+
+
+async def _read_output(stream: asyncio.StreamReader, job: Job):
+    while True:
+        try:
+            line = await stream.readline()
+        except ValueError:
+            # (line too long)
+            continue
+        if not line:
+            return
+        job.output.append(line.decode(errors="replace").rstrip("\n"))
+
+
+class JobQueueService(Service):
+    """A service which executes jobs of a queue (see alwaysup.jobs).
+
+    The number of slots is the maximum number of concurrent jobs. The
+    configuration (except program and args) is used for all jobs.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        slot_number: int,
+        cmd: Cmd,
+        settings: Optional[JobQueueSettings] = None,
+    ):
+        self.settings: JobQueueSettings = (
+            settings if settings is not None else JobQueueSettings()
+        )
+        self.queue: JobQueue = JobQueue(self.settings)
+        self._spool_task: Optional[asyncio.Task] = None
+        Service.__init__(self, name, slot_number, cmd)
+
+    def as_dict(self):
+        d = Service.as_dict(self)
+        d["job_queue"] = dict(self.queue.as_dict(), settings=self.settings.to_dict())
+        return d
+
+    def record_in_journal(self):
+        if self.journal is not None:
+            self.journal.record_service(
+                self.name,
+                self.slot_number,
+                self.cmd.config.to_dict(),
+                job_queue=self.settings.to_dict(),
+            )
+
+    def submit(
+        self, argv: List[str], env: Dict[str, str] = {}, priority: int = 0
+    ) -> Job:
+        """Submit a job (see JobQueue.submit())."""
+        job = self.queue.submit(argv, env, priority)
+        self.notify_work()
+        return job
+
+    def in_flight(self) -> Optional[int]:
+        # (queued and running jobs)
+        res = Service.in_flight(self) or 0
+        return res + len(self.queue) + self.queue.counts[JobState.RUNNING.name]
+
+    def _make_slot(self, i: int) -> ProcessSlot:
+        # (jobs are not journaled: there is nothing to re-adopt)
+        return JobSlot(
+            self.name,
+            i,
+            self.cmd,
+            cgroup=self._make_slot_cgroup(i),
+            stop_stats=self.stop_stats,
+            status_table=self.status_table,
+            cpus=self._slot_cpus(i),
+            spawn_scheduler=self.spawn_scheduler,
+            queue=self.queue,
+        )
+
+    async def _start(self):
+        await Service._start(self)
+        if self.settings.spool_dir is not None and self._spool_task is None:
+            self._spool_task = asyncio.create_task(log_exceptions(self._scan_spool()))
+
+    async def _stop_or_shutdown(self, shutdown=True):
+        if self._spool_task is not None:
+            self._spool_task.cancel()
+            await asyncio.wait([self._spool_task])
+            self._spool_task = None
+        await Service._stop_or_shutdown(self, shutdown=shutdown)
+
+    async def _scan_spool(self):
+        while True:
+            self.scan_spool()
+            await asyncio.sleep(SPOOL_SCAN_INTERVAL)
+
+    def scan_spool(self):
+        """Submit jobs of the spool directory (until the queue is full)."""
+        spool_dir = self.settings.spool_dir
+        if spool_dir is None:
+            return
+        try:
+            names = sorted(x for x in os.listdir(spool_dir) if x.endswith(".json"))
+        except OSError:
+            self.logger.warning(f"can't read the spool directory: {spool_dir}")
+            return
+        for name in names:
+            if self.queue.is_full():
+                return
+            path = os.path.join(spool_dir, name)
+            try:
+                with open(path, "r") as f:
+                    d = json.loads(f.read())
+                self.submit(d["argv"], d.get("env", {}), int(d.get("priority", 0)))
+            except Exception:
+                self.logger.warning(f"invalid job file: {path}", exc_info=True)
+                os.rename(path, path + ".invalid")
+                continue
+            os.unlink(path)
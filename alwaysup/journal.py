@@ -0,0 +1,286 @@
+"""Append-only journal of services and slots.
+
+The journal is used to re-adopt still running processes after a restart of the
+daemon (crash or upgrade) instead of respawning them.
+
+Records are json lines. They are buffered in memory and written (and fsynced)
+in batches by a background task. The latest known state is also kept in memory
+so the journal can be compacted (rewritten from this state) when too many
+records were appended (crash looping slots append two records per respawn).
+"""
+
+from typing import Dict, List, Optional, Any
+import asyncio
+import copy
+import json
+import os
+from dataclasses import dataclass, field
+import mflog
+from alwaysup.utils import (
+    log_exceptions,
+    get_process_start_time,
+    get_process_cmd_line,
+)
+
+DEFAULT_FSYNC_INTERVAL = 0.5
+# minimum number of appended records before a compaction
+DEFAULT_COMPACT_THRESHOLD = 10000
+
+
+@dataclass
+class SlotRecord:
+    """Latest known process of a slot.
+
+    Attributes:
+        slot_number: the slot number.
+        pid: pid of the process.
+        start_time: start time of the process (in clock ticks after boot).
+        cmd_line: command line of the process.
+    """
+
+    slot_number: int
+    pid: int
+    start_time: Optional[int]
+    cmd_line: Optional[str]
+
+    def is_alive(self) -> bool:
+        """Return True if the recorded process is still the same running process."""
+        if self.start_time is None or self.cmd_line is None:
+            return False
+        return (
+            get_process_start_time(self.pid) == self.start_time
+            and get_process_cmd_line(self.pid) == self.cmd_line
+        )
+
+
+@dataclass
+class ServiceRecord:
+    """Latest known definition and processes of a service.
+
+    Attributes:
+        name: the service name.
+        slot_number: the (wanted) number of slots.
+        config: the CmdConfiguration of the service (as a dict).
+        slots: latest known processes of the service (slot number => SlotRecord).
+        job_queue: settings of a job queue service (see alwaysup.jobs) or None.
+    """
+
+    name: str
+    slot_number: int
+    config: Dict[str, Any]
+    slots: Dict[int, SlotRecord] = field(default_factory=dict)
+    job_queue: Optional[Dict[str, Any]] = None
+
+
+class Journal:
+    """Append-only, fsync-batched, journal.
+
+    Attributes:
+        path: full path of the journal file.
+        fsync_interval: maximum delay (in seconds) before buffered records are
+            written and fsynced.
+        compact_threshold: the journal is compacted when the number of records
+            appended since the latest compaction is above this threshold (and
+            above 4 times the number of records of the compacted journal).
+    """
+
+    def __init__(
+        self,
+        path: str,
+        fsync_interval: float = DEFAULT_FSYNC_INTERVAL,
+        compact_threshold: int = DEFAULT_COMPACT_THRESHOLD,
+    ):
+        self.path: str = path
+        self.fsync_interval: float = fsync_interval
+        self.compact_threshold: int = compact_threshold
+        self.logger = mflog.get_logger("alwaysup.journal").bind(path=path)
+        self._buffer: List[str] = []
+        self._services: Dict[str, ServiceRecord] = {}
+        self._appended: int = 0
+        self._compacted_size: int = 0
+        self._event: Optional[asyncio.Event] = None
+        self._flush_task: Optional[asyncio.Task] = None
+        self._closed: bool = False
+
+    def replay(self) -> Dict[str, ServiceRecord]:
+        """Read the journal file and return the latest known state."""
+        services: Dict[str, ServiceRecord] = {}
+        try:
+            with open(self.path, "r") as f:
+                lines = f.readlines()
+        except FileNotFoundError:
+            return services
+        for line in lines:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # probably a partial write during a crash
+                self.logger.warning("ignoring a corrupted journal line")
+                continue
+            self._apply(services, record)
+        return services
+
+    def _apply(self, services: Dict[str, ServiceRecord], record: Dict[str, Any]):
+        typ = record.get("t")
+        if typ == "service":
+            old = services.get(record["name"])
+            services[record["name"]] = ServiceRecord(
+                name=record["name"],
+                slot_number=record["slot_number"],
+                config=record["config"],
+                slots=old.slots if old is not None else {},
+                job_queue=record.get("job_queue"),
+            )
+        elif typ == "service_removed":
+            services.pop(record["name"], None)
+        elif typ == "slot":
+            service = services.get(record["service"])
+            if service is None:
+                return
+            if record["pid"] is None:
+                service.slots.pop(record["slot"], None)
+            else:
+                service.slots[record["slot"]] = SlotRecord(
+                    slot_number=record["slot"],
+                    pid=record["pid"],
+                    start_time=record["start_time"],
+                    cmd_line=record["cmd_line"],
+                )
+
+    def open(self, replay: bool = True) -> Dict[str, ServiceRecord]:
+        """Replay the journal, compact it and return the latest known state.
+
+        Args:
+            replay: if False, the previous content is dropped (empty journal).
+        """
+        self._services = self.replay() if replay else {}
+        self._buffer = []
+        self._write_compacted(self._compacted_lines())
+        self.logger.info(f"journal opened with {len(self._services)} known services")
+        return copy.deepcopy(self._services)
+
+    def _compacted_lines(self) -> List[str]:
+        lines: List[str] = []
+        for service in self._services.values():
+            record: Dict[str, Any] = {
+                "t": "service",
+                "name": service.name,
+                "slot_number": service.slot_number,
+                "config": service.config,
+            }
+            if service.job_queue is not None:
+                record["job_queue"] = service.job_queue
+            lines.append(json.dumps(record) + "\n")
+            for slot in service.slots.values():
+                record = {
+                    "t": "slot",
+                    "service": service.name,
+                    "slot": slot.slot_number,
+                    "pid": slot.pid,
+                    "start_time": slot.start_time,
+                    "cmd_line": slot.cmd_line,
+                }
+                lines.append(json.dumps(record) + "\n")
+        self._appended = 0
+        self._compacted_size = len(lines)
+        return lines
+
+    def _write_compacted(self, lines: List[str]):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            f.write("".join(lines))
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_path, self.path)
+
+    def _must_compact(self) -> bool:
+        return self._appended > max(self.compact_threshold, 4 * self._compacted_size)
+
+    def start(self):
+        """Start the background flush task (must be called in a running loop)."""
+        self._event = asyncio.Event()
+        self._flush_task = asyncio.create_task(log_exceptions(self._flush_loop()))
+
+    async def close(self):
+        """Stop the background flush task and flush remaining records."""
+        self._closed = True
+        if self._flush_task is not None and self._event is not None:
+            self._event.set()
+            await self._flush_task
+            self._flush_task = None
+        self.flush()
+
+    async def _flush_loop(self):
+        assert self._event is not None
+        loop = asyncio.get_event_loop()
+        while not self._closed:
+            await self._event.wait()
+            if not self._closed:
+                await asyncio.sleep(self.fsync_interval)
+            self._event.clear()
+            lines, self._buffer = self._buffer, []
+            if self._must_compact():
+                # (buffered records are already in the in-memory state)
+                self.logger.info("compacting the journal")
+                lines = self._compacted_lines()
+                await loop.run_in_executor(None, self._write_compacted, lines)
+            else:
+                await loop.run_in_executor(None, self._write, lines)
+
+    def flush(self):
+        """Write and fsync buffered records (blocking)."""
+        lines, self._buffer = self._buffer, []
+        self._write(lines)
+
+    def _write(self, lines: List[str]):
+        if len(lines) == 0:
+            return
+        with open(self.path, "a") as f:
+            f.write("".join(lines))
+            f.flush()
+            os.fsync(f.fileno())
+
+    def append(self, record: Dict[str, Any]):
+        self._apply(self._services, record)
+        self._appended += 1
+        self._buffer.append(json.dumps(record) + "\n")
+        if self._event is not None:
+            self._event.set()
+
+    def record_service(
+        self,
+        name: str,
+        slot_number: int,
+        config: Dict[str, Any],
+        job_queue: Optional[Dict[str, Any]] = None,
+    ):
+        record = {
+            "t": "service",
+            "name": name,
+            "slot_number": slot_number,
+            "config": config,
+        }
+        if job_queue is not None:
+            record["job_queue"] = job_queue
+        self.append(record)
+
+    def record_service_removed(self, name: str):
+        self.append({"t": "service_removed", "name": name})
+
+    def record_slot(self, service_name: str, slot_number: int, pid: Optional[int]):
+        """Record the current process of a slot (pid=None for no process).
+
+        Start time and command line are read from /proc now (so the command line
+        is the real one, even if the program is a script).
+
+        """
+        self.append(
+            {
+                "t": "slot",
+                "service": service_name,
+                "slot": slot_number,
+                "pid": pid,
+                "start_time": get_process_start_time(pid) if pid else None,
+                "cmd_line": get_process_cmd_line(pid) if pid else None,
+            }
+        )
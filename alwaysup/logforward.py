@@ -0,0 +1,312 @@
+"""Structured log forwarding of process output (see LogForwarder).
+
+When a service has a log_forward sink, the stdout (and stderr if it is
+redirected to stdout) of its processes is captured by the daemon:
+
+- each line is parsed as a JSON object (other lines are wrapped in a
+  {"message": ...} object) and enriched with service, slot, pid and host keys
+  (keys already set by the process are kept)
+- records are put in a bounded queue (records are dropped, and counted, when the
+  queue is full, so a slow sink never blocks processes)
+- records are written to the sink in batches, when batch_size records are
+  queued or batch_delay seconds after the first queued record
+
+Sinks:
+
+- unix:/path: unix stream socket (one JSON record per line)
+- unixgram:/path: unix datagram socket (one JSON record per datagram)
+- gzip:/path: gzip compressed file (one JSON record per line, appended)
+"""
+
+from typing import Any, Deque, Dict, List, Optional, Set, Tuple
+import asyncio
+import collections
+import gzip
+import json
+import socket
+import time
+import mflog
+from alwaysup.utils import log_exceptions
+
+DEFAULT_BATCH_SIZE = 100
+DEFAULT_BATCH_DELAY = 1.0
+DEFAULT_QUEUE_SIZE = 10000
+
+# timeout (in seconds) of a socket sink write (then the batch is dropped)
+SINK_TIMEOUT = 5.0
+
+# maximum delay (in seconds) to read what is left of the output of stopped
+# processes (a daemonized descendant can keep the pipe open)
+READERS_TIMEOUT = 2.0
+
+HOSTNAME = socket.gethostname()
+
+
+def parse_line(line: bytes, context: Dict[str, Any]) -> Tuple[Dict[str, Any], bool]:
+    """Parse (and enrich with context) an output line.
+
+    Returns:
+        (record, parsed) tuple, record is the JSON object (parsed is True) or a
+        {"message": line} object (parsed is False).
+    """
+    text = line.decode(errors="replace").rstrip("\r\n")
+    record: Any = None
+    if text.startswith("{"):
+        try:
+            record = json.loads(text)
+        except ValueError:
+            pass
+    parsed = isinstance(record, dict)
+    if not parsed:
+        record = {"message": text}
+    for key, value in context.items():
+        record.setdefault(key, value)
+    return (record, parsed)
+
+
+class Sink:
+    """Destination of forwarded records (see open_sink())."""
+
+    def write(self, batch: List[bytes]):
+        raise NotImplementedError()
+
+    def close(self):
+        pass
+
+
+class UnixSocketSink(Sink):
+    def __init__(self, path: str, datagram: bool = False):
+        self.datagram = datagram
+        self.sock = socket.socket(
+            socket.AF_UNIX, socket.SOCK_DGRAM if datagram else socket.SOCK_STREAM
+        )
+        self.sock.settimeout(SINK_TIMEOUT)
+        try:
+            self.sock.connect(path)
+        except Exception:
+            self.sock.close()
+            raise
+
+    def write(self, batch: List[bytes]):
+        if self.datagram:
+            for record in batch:
+                self.sock.send(record)
+        else:
+            self.sock.sendall(b"\n".join(batch) + b"\n")
+
+    def close(self):
+        self.sock.close()
+
+
+class GzipFileSink(Sink):
+    def __init__(self, path: str):
+        self.file = gzip.open(path, "ab")
+
+    def write(self, batch: List[bytes]):
+        self.file.write(b"\n".join(batch) + b"\n")
+        # (sync flush, so the file can be read while it is written)
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+def open_sink(address: str) -> Sink:
+    """Open a sink (unix:/path, unixgram:/path or gzip:/path).
+
+    Raises:
+        OSError: if the sink can't be opened.
+        ValueError: if the address is invalid.
+    """
+    kind, sep, path = address.partition(":")
+    if sep == "" or path == "":
+        raise ValueError(f"invalid log forward sink: {address}")
+    if kind == "unix":
+        return UnixSocketSink(path)
+    if kind == "unixgram":
+        return UnixSocketSink(path, datagram=True)
+    if kind == "gzip":
+        return GzipFileSink(path)
+    raise ValueError(f"invalid log forward sink: {address}")
+
+
+class LogForwarder:
+    """Batched forwarding of the (parsed) output of processes to a sink.
+
+    Attributes:
+        sink: address of the sink (see open_sink()).
+        batch_size: maximum number of records in a batch.
+        batch_delay: maximum delay (in seconds) before a queued record is
+            written.
+        queue_size: maximum number of queued records.
+        received: number of received records.
+        parsed: number of received records which were JSON objects.
+        forwarded: number of records written to the sink.
+        dropped: number of dropped records (queue full, line too long or sink
+            error).
+        errors: number of sink errors.
+        batches: number of written batches.
+    """
+
+    def __init__(
+        self,
+        sink: str,
+        batch_size: int = DEFAULT_BATCH_SIZE,
+        batch_delay: float = DEFAULT_BATCH_DELAY,
+        queue_size: int = DEFAULT_QUEUE_SIZE,
+    ):
+        self.sink: str = sink
+        self.batch_size: int = max(batch_size, 1)
+        self.batch_delay: float = batch_delay
+        self.queue_size: int = queue_size
+        self.received: int = 0
+        self.parsed: int = 0
+        self.forwarded: int = 0
+        self.dropped: int = 0
+        self.errors: int = 0
+        self.batches: int = 0
+        self.logger = mflog.get_logger("alwaysup.logforward").bind(id=sink)
+        self._queue: Deque[bytes] = collections.deque()
+        self._sink: Optional[Sink] = None
+        self._failing: bool = False
+        self._readers: Set[asyncio.Task] = set()
+        self._flush_task: Optional[asyncio.Task] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._closing: bool = False
+
+    def start(self):
+        """Start the flushing task."""
+        if self._flush_task is not None:
+            return
+        self._closing = False
+        self._wakeup = asyncio.Event()
+        self._flush_task = asyncio.create_task(log_exceptions(self._flush_forever()))
+
+    async def close(self):
+        """Read what is left of outputs, write queued records and stop."""
+        if len(self._readers) > 0:
+            _, pending = await asyncio.wait(
+                list(self._readers), timeout=READERS_TIMEOUT
+            )
+            for task in pending:
+                task.cancel()
+        if self._flush_task is not None:
+            # (a running batch write is not interrupted)
+            self._closing = True
+            assert self._wakeup is not None
+            self._wakeup.set()
+            await self._flush_task
+            self._flush_task = None
+        while len(self._queue) > 0:
+            await self._flush()
+        if self._sink is not None:
+            self._sink.close()
+            self._sink = None
+
+    def follow(self, stream: asyncio.StreamReader, context: Dict[str, Any]):
+        """Forward the output of a process (until EOF).
+
+        Args:
+            stream: output stream of the process.
+            context: keys added to records (service, slot, pid...).
+        """
+        context = dict(context, host=HOSTNAME)
+        task = asyncio.create_task(log_exceptions(self._read(stream, context)))
+        self._readers.add(task)
+        task.add_done_callback(self._readers.discard)
+
+    async def _read(self, stream: asyncio.StreamReader, context: Dict[str, Any]):
+        # (the stream is always drained, even when records are dropped)
+        while True:
+            try:
+                line = await stream.readline()
+            except ValueError:
+                # (line too long)
+                self.received += 1
+                self.dropped += 1
+                continue
+            if not line:
+                return
+            self.put(*parse_line(line, context))
+
+    def put(self, record: Dict[str, Any], parsed: bool = True):
+        """Queue a record (unless the queue is full)."""
+        self.received += 1
+        if parsed:
+            self.parsed += 1
+        if len(self._queue) >= self.queue_size:
+            self.dropped += 1
+            return
+        self._queue.append(json.dumps(record, default=str).encode())
+        if self._wakeup is not None and (
+            len(self._queue) == 1 or len(self._queue) >= self.batch_size
+        ):
+            self._wakeup.set()
+
+    async def _wait(self, n: int, timeout: Optional[float]):
+        # wait until n records are queued (or the timeout)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while len(self._queue) < n and not self._closing:
+            assert self._wakeup is not None
+            self._wakeup.clear()
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                return
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), remaining)
+            except asyncio.TimeoutError:
+                return
+
+    async def _flush_forever(self):
+        while not self._closing:
+            await self._wait(1, None)
+            await self._wait(self.batch_size, self.batch_delay)
+            await self._flush()
+
+    async def _flush(self):
+        n = min(len(self._queue), self.batch_size)
+        if n == 0:
+            return
+        batch = [self._queue.popleft() for _ in range(0, n)]
+        loop = asyncio.get_running_loop()
+        error = await loop.run_in_executor(None, self._write, batch)
+        if error is not None:
+            self.errors += 1
+            self.dropped += n
+            if not self._failing:
+                self.logger.warning(f"can't write to the log forward sink: {error}")
+            self._failing = True
+            return
+        if self._failing:
+            self.logger.info("the log forward sink is writable again")
+            self._failing = False
+        self.forwarded += n
+        self.batches += 1
+
+    def _write(self, batch: List[bytes]) -> Optional[Exception]:
+        # (executed in a thread, the sink is reopened after an error)
+        try:
+            if self._sink is None:
+                self._sink = open_sink(self.sink)
+            self._sink.write(batch)
+        except (OSError, ValueError) as e:
+            if self._sink is not None:
+                self._sink.close()
+                self._sink = None
+            return e
+        return None
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            "sink": self.sink,
+            "batch_size": self.batch_size,
+            "batch_delay": self.batch_delay,
+            "queue_size": self.queue_size,
+            "queue_length": len(self._queue),
+            "received": self.received,
+            "parsed": self.parsed,
+            "forwarded": self.forwarded,
+            "dropped": self.dropped,
+            "errors": self.errors,
+            "batches": self.batches,
+        }
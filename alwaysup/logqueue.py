@@ -0,0 +1,235 @@
+"""Asynchronous logging of the daemon itself (see LogPipeline).
+
+mflog writes log records synchronously (on the event loop), so a slow disk or
+a blocked stderr stalls the supervision, and a crash looping fleet produces
+thousands of records per second. With the pipeline:
+
+- records are rendered by the calling thread (structlog processors) then put
+  in a bounded queue, drained by a background writer thread (records are
+  dropped, and counted, when the queue is full)
+- records are rate limited per object (bound "id" or logger name) with a token
+  bucket, suppressed records are aggregated by message and reported by the
+  writer at the end of each aggregation window ("... [repeated 57 times in
+  60s]")
+- critical records are never rate limited
+"""
+
+from typing import Any, Dict, Optional, Tuple
+import datetime
+import os
+import queue
+import threading
+import time
+import structlog
+
+DEFAULT_QUEUE_SIZE = 10000
+DEFAULT_RATE = 10.0
+DEFAULT_BURST = 50
+DEFAULT_AGGREGATION_WINDOW = 60.0
+
+# logger methods called by structlog (after processors)
+METHODS = ("debug", "info", "msg", "warning", "error", "critical", "exception")
+
+# (end of the writer thread)
+_STOP = object()
+
+
+def _now() -> str:
+    # (same format as structlog TimeStamper(fmt="iso", utc=True))
+    return datetime.datetime.utcnow().isoformat() + "Z"
+
+
+class _Bucket:
+    def __init__(self, burst: int):
+        self.tokens: float = float(burst)
+        self.refilled: float = time.monotonic()
+
+
+class _QueuedLogger:
+    """Logger proxy which puts records in the pipeline (instead of writing)."""
+
+    def __init__(self, logger: Any, pipeline: "LogPipeline"):
+        self._logger = logger
+        self._pipeline = pipeline
+
+    def __getattr__(self, name: str) -> Any:
+        if name in METHODS:
+            logger = self._logger
+
+            def put(**event_dict):
+                self._pipeline.put(logger, name, event_dict)
+
+            return put
+        return getattr(self._logger, name)
+
+
+class _QueuedLoggerFactory:
+    def __init__(self, factory: Any, pipeline: "LogPipeline"):
+        self.factory = factory
+        self.pipeline = pipeline
+
+    def __call__(self, *args):
+        return _QueuedLogger(self.factory(*args), self.pipeline)
+
+
+class LogPipeline:
+    """Bounded queue of log records drained by a writer thread.
+
+    Attributes:
+        queue_size: maximum number of queued records.
+        rate: maximum number of records per second per object (0 => no rate
+            limiting).
+        burst: maximum number of records per object without rate limiting.
+        aggregation_window: interval (in seconds) between two reports of
+            suppressed (rate limited) records.
+        enqueued: number of queued records.
+        written: number of written records.
+        dropped: number of records dropped (queue full).
+        suppressed: number of rate limited records.
+    """
+
+    def __init__(
+        self,
+        queue_size: int = DEFAULT_QUEUE_SIZE,
+        rate: float = DEFAULT_RATE,
+        burst: int = DEFAULT_BURST,
+        aggregation_window: float = DEFAULT_AGGREGATION_WINDOW,
+    ):
+        self.queue_size: int = queue_size
+        self.rate: float = rate
+        self.burst: int = max(burst, 1)
+        self.aggregation_window: float = aggregation_window
+        self.enqueued: int = 0
+        self.written: int = 0
+        self.dropped: int = 0
+        self.suppressed: int = 0
+        self._queue: "queue.Queue[Any]" = queue.Queue(maxsize=queue_size)
+        self._lock = threading.Lock()
+        self._buckets: Dict[str, _Bucket] = {}
+        # (object, level, message) => (logger, latest record, count)
+        self._aggregated: Dict[Tuple[str, str, str], Tuple[Any, Dict, int]] = {}
+        self._reported_dropped: int = 0
+        self._thread: Optional[threading.Thread] = None
+        self._logger: Any = None
+
+    def install(self):
+        """Route structlog (mflog) loggers created from now on to the pipeline.
+
+        It must be called after mflog.set_config() (and records are only
+        written after start()).
+        """
+        factory = structlog.get_config()["logger_factory"]
+        self._logger = factory("alwaysup.logqueue")
+        structlog.configure(logger_factory=_QueuedLoggerFactory(factory, self))
+
+    def start(self):
+        """Start the writer thread (after a daemonization fork)."""
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(
+            target=self._write_forever, name="alwaysup-log-writer", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self, timeout: float = 5.0):
+        """Write queued records (and reports) then stop the writer thread."""
+        if self._thread is None:
+            return
+        try:
+            self._queue.put(_STOP, timeout=timeout)
+        except queue.Full:
+            pass
+        self._thread.join(timeout)
+        self._thread = None
+
+    def put(self, logger: Any, method: str, event_dict: Dict[str, Any]):
+        """Queue a record (unless it is rate limited or the queue is full)."""
+        if not self._allowed(logger, method, event_dict):
+            return
+        try:
+            self._queue.put_nowait((logger, method, event_dict))
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+            return
+        with self._lock:
+            self.enqueued += 1
+
+    def _allowed(self, logger: Any, method: str, event_dict: Dict[str, Any]) -> bool:
+        if self.rate <= 0 or method == "critical":
+            return True
+        key = str(event_dict.get("id") or event_dict.get("name") or "")
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = _Bucket(self.burst)
+            elapsed = now - bucket.refilled
+            bucket.tokens = min(bucket.tokens + elapsed * self.rate, float(self.burst))
+            bucket.refilled = now
+            if bucket.tokens >= 1.0:
+                bucket.tokens -= 1.0
+                return True
+            self.suppressed += 1
+            aggregation_key = (key, method, str(event_dict.get("event")))
+            _, _, count = self._aggregated.get(aggregation_key, (None, None, 0))
+            self._aggregated[aggregation_key] = (logger, event_dict, count + 1)
+            return False
+
+    def _write_forever(self):
+        next_report = time.monotonic() + self.aggregation_window
+        while True:
+            timeout = max(next_report - time.monotonic(), 0.0)
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+            if item is _STOP:
+                self.report()
+                return
+            if item is not None:
+                self._write(*item)
+            if time.monotonic() >= next_report:
+                self.report()
+                next_report = time.monotonic() + self.aggregation_window
+
+    def _write(self, logger: Any, method: str, event_dict: Dict[str, Any]):
+        try:
+            getattr(logger, method)(**event_dict)
+        except Exception:
+            # (mflog already reports its own write errors)
+            pass
+        self.written += 1
+
+    def report(self):
+        """Write aggregated suppressed records (and the dropped count)."""
+        with self._lock:
+            aggregated, self._aggregated = self._aggregated, {}
+            dropped = self.dropped - self._reported_dropped
+            self._reported_dropped = self.dropped
+        window = f"{self.aggregation_window:g}s"
+        for (_, method, message), (logger, event_dict, count) in aggregated.items():
+            record = dict(event_dict, timestamp=_now(), repeated=count)
+            record["event"] = f"{message} [repeated {count} times in {window}]"
+            self._write(logger, method, record)
+        if dropped > 0 and self._logger is not None:
+            record = {
+                "event": f"{dropped} log records dropped (log queue full)",
+                "level": "warning",
+                "timestamp": _now(),
+                "pid": os.getpid(),
+                "name": "alwaysup.logqueue",
+            }
+            self._write(self._logger, "warning", record)
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            "queue_size": self.queue_size,
+            "queue_length": self._queue.qsize(),
+            "rate": self.rate,
+            "burst": self.burst,
+            "enqueued": self.enqueued,
+            "written": self.written,
+            "dropped": self.dropped,
+            "suppressed": self.suppressed,
+        }
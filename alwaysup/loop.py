@@ -0,0 +1,55 @@
+"""Event loop backend selection (stock asyncio or uvloop).
+
+The same backend is used for every event loop of the daemon (uvicorn one,
+non-API mode one, supervision thread one), so subprocess creation and child
+watching behave the same way in all modes.
+
+uvloop is an optional dependency (pip install alwaysup[uvloop]).
+"""
+
+import asyncio
+import enum
+
+
+class LoopBackend(enum.Enum):
+
+    AUTO = 0  # uvloop if installed, else asyncio
+    ASYNCIO = 1
+    UVLOOP = 2
+
+
+def uvloop_is_available() -> bool:
+    try:
+        import uvloop  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def resolve_loop_backend(backend: LoopBackend) -> LoopBackend:
+    """Resolve AUTO backend (and check uvloop availability).
+
+    Raises:
+        Exception: if UVLOOP is requested but uvloop is not installed.
+    """
+    if backend == LoopBackend.AUTO:
+        return LoopBackend.UVLOOP if uvloop_is_available() else LoopBackend.ASYNCIO
+    if backend == LoopBackend.UVLOOP and not uvloop_is_available():
+        raise Exception("uvloop loop backend requested but uvloop is not installed")
+    return backend
+
+
+def install_loop_policy(backend: LoopBackend) -> LoopBackend:
+    """Install the event loop policy of the given backend (for all new loops).
+
+    Returns:
+        The resolved backend.
+    """
+    backend = resolve_loop_backend(backend)
+    if backend == LoopBackend.UVLOOP:
+        import uvloop
+
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    else:
+        asyncio.set_event_loop_policy(asyncio.DefaultEventLoopPolicy())
+    return backend
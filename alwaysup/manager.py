@@ -1,4 +1,4 @@
-from typing import Dict
+from typing import Dict, Optional
 import enum
 import asyncio
 import mflog
@@ -6,6 +6,11 @@ from alwaysup.service import Service
 from alwaysup.state import StateMixin, OnlyStatesOrRaise, OnlyStates
 from alwaysup.utils import AsyncMutuallyExclusive
 from alwaysup.status import Status, list_of_status_to_status
+from alwaysup.journal import Journal
+from alwaysup.status_table import StatusTable
+from alwaysup.scheduler import SpawnScheduler
+from alwaysup.budget import WorkerBudget
+from alwaysup.tracing import TRACER
 
 
 class ManagerState(enum.Enum):
@@ -15,10 +20,22 @@ class ManagerState(enum.Enum):
 
 
 class Manager(StateMixin):
-    def __init__(self):
+    def __init__(
+        self,
+        journal: Optional[Journal] = None,
+        status_table: Optional[StatusTable] = None,
+        spawn_scheduler: Optional[SpawnScheduler] = None,
+        budget: Optional[WorkerBudget] = None,
+    ):
         self.logger = mflog.get_logger("alwaysup.manager")
         StateMixin.__init__(self)
         self.services: Dict[str, Service] = {}
+        self.journal: Optional[Journal] = journal
+        self.status_table: Optional[StatusTable] = status_table
+        self.spawn_scheduler: SpawnScheduler = (
+            spawn_scheduler if spawn_scheduler is not None else SpawnScheduler()
+        )
+        self.budget: WorkerBudget = budget if budget is not None else WorkerBudget()
         self.set_state(ManagerState.RUNNING)
         self.logger.info("Manager started")
 
@@ -44,25 +61,29 @@ class Manager(StateMixin):
             "state_since": self.seconds_since_latest_state_change(),
             "state_hsince": self.humanized_time_since_latest_state_change(),
             "services": {x: y.as_dict() for x, y in self.services.items()},
+            "spawn_scheduler": self.spawn_scheduler.as_dict(),
+            "budget": self.budget.as_dict(),
         }
 
     @AsyncMutuallyExclusive()
     @OnlyStatesOrRaise([ManagerState.RUNNING])
     async def stop_all(self):
-        self._stop_or_shutdown_all(shutdown=False)
+        await self._stop_or_shutdown_all(shutdown=False)
 
     async def _stop_or_shutdown_all(self, shutdown=True):
         if len(self.services) > 0:
             if shutdown:
-                tasks = [x.shutdown() for x in self.services.values()]
+                coros = [x.shutdown() for x in self.services.values()]
             else:
-                tasks = [x.stop() for x in self.services.values()]
-            await asyncio.wait(tasks)
+                coros = [x.stop() for x in self.services.values()]
+            await asyncio.wait([asyncio.create_task(x) for x in coros])
 
     @AsyncMutuallyExclusive()
     @OnlyStatesOrRaise([ManagerState.RUNNING])
     async def shutdown(self):
         self.logger.info("Manager is starting to shutdown")
+        # (no more spawns, waiting ones are abandoned)
+        self.spawn_scheduler.close()
         await self._stop_or_shutdown_all(shutdown=True)
         self.set_state(ManagerState.SHUTDOWN)
         await self.wait()
@@ -75,6 +96,12 @@ class Manager(StateMixin):
             return
         self.logger.info("Adding service: %s to manager" % service.name)
         self.services[service.name] = service
+        service.journal = self.journal
+        service.status_table = self.status_table
+        service.spawn_scheduler = self.spawn_scheduler
+        service.budget = self.budget
+        self.budget.register(service)
+        service.record_in_journal()
         if service.autostart:
             await service.start()
         self.logger.info("Service: %s added to manager" % service.name)
@@ -86,6 +113,10 @@ class Manager(StateMixin):
             return
         await self.services[service_name].shutdown()
         self.services.pop(service_name)
+        self.budget.forget(service_name)
+        TRACER.forget(service_name)
+        if self.journal is not None:
+            self.journal.record_service_removed(service_name)
 
     async def wait(self):
         while self.state != ManagerState.SHUTDOWN:
@@ -0,0 +1,147 @@
+"""Asynchronous operations (long running control commands).
+
+A long running command (start/stop/scale/remove of a service) can be executed
+in background: an Operation is returned immediately and its progress (slots
+done out of total, errors) can be queried (or streamed) later.
+
+Progress is reported by the service code with operation_add_total() and
+operation_progress(): the current operation is a context variable, so it
+follows the command execution (even on the supervision thread, as
+run_coroutine_threadsafe() copies the context).
+"""
+
+from typing import Any, Dict, List, Optional
+import collections
+import contextvars
+import enum
+import time
+from mfutil import get_unique_hexa_identifier
+
+# number of finished operations kept (for queries)
+MAX_FINISHED_OPERATIONS = 100
+
+# commands which can be executed as operations
+OPERATION_COMMANDS = (
+    "start_service",
+    "stop_service",
+    "scale_service",
+    "remove_service",
+)
+
+_CURRENT_OPERATION: "contextvars.ContextVar[Optional[Operation]]" = (
+    contextvars.ContextVar("alwaysup_current_operation", default=None)
+)
+
+
+class OperationState(enum.Enum):
+    RUNNING = 1
+    SUCCEEDED = 2
+    FAILED = 3
+
+
+class Operation:
+    """Background execution of a control command.
+
+    Attributes:
+        id: unique id of the operation.
+        command: the control command.
+        params: parameters of the command.
+        state: state of the operation.
+        total: number of slots to start/stop (grows while the command runs).
+        done: number of slots started/stopped.
+        errors: error messages.
+        result: result of the command (if succeeded).
+        started: start time (epoch).
+        finished: end time (epoch) or None.
+    """
+
+    def __init__(self, command: str, params: Dict[str, Any]):
+        self.id: str = get_unique_hexa_identifier()
+        self.command: str = command
+        self.params: Dict[str, Any] = dict(params)
+        self.state: OperationState = OperationState.RUNNING
+        self.total: int = 0
+        self.done: int = 0
+        self.errors: List[str] = []
+        self.result: Any = None
+        self.started: float = time.time()
+        self.finished: Optional[float] = None
+
+    def is_finished(self) -> bool:
+        return self.state != OperationState.RUNNING
+
+    def succeed(self, result: Any = None):
+        self.result = result
+        self.state = OperationState.SUCCEEDED
+        self.finished = time.time()
+
+    def fail(self, error: str):
+        self.errors.append(error)
+        self.state = OperationState.FAILED
+        self.finished = time.time()
+
+    def as_dict(self) -> Dict[str, Any]:
+        end = self.finished if self.finished is not None else time.time()
+        return {
+            "id": self.id,
+            "command": self.command,
+            "params": self.params,
+            "state": self.state.name,
+            "total": self.total,
+            "done": self.done,
+            "errors": self.errors,
+            "result": self.result,
+            "started": self.started,
+            "duration": end - self.started,
+        }
+
+
+class Operations:
+    """Registry of running (and latest finished) operations."""
+
+    def __init__(self, max_finished: int = MAX_FINISHED_OPERATIONS):
+        self.max_finished: int = max_finished
+        self._operations: "collections.OrderedDict[str, Operation]" = (
+            collections.OrderedDict()
+        )
+
+    def create(self, command: str, params: Dict[str, Any]) -> Operation:
+        operation = Operation(command, params)
+        self._operations[operation.id] = operation
+        self._purge()
+        return operation
+
+    def get(self, operation_id: str) -> Optional[Operation]:
+        return self._operations.get(operation_id)
+
+    def as_list(self) -> List[Dict[str, Any]]:
+        return [x.as_dict() for x in self._operations.values()]
+
+    def _purge(self):
+        finished = [x for x in self._operations.values() if x.is_finished()]
+        for operation in finished[0 : max(len(finished) - self.max_finished, 0)]:
+            del self._operations[operation.id]
+
+
+def set_current_operation(operation: Optional[Operation]):
+    """Set the operation of the current context (and of tasks created later)."""
+    _CURRENT_OPERATION.set(operation)
+
+
+def get_current_operation() -> Optional[Operation]:
+    """Return the operation of the current context (if any)."""
+    return _CURRENT_OPERATION.get()
+
+
+def operation_add_total(n: int):
+    """Add slots to do to the current operation (if any)."""
+    operation = _CURRENT_OPERATION.get()
+    if operation is not None:
+        operation.total += n
+
+
+def operation_progress(n: int = 1):
+    """Mark slots as done in the current operation (if any)."""
+    operation = _CURRENT_OPERATION.get()
+    if operation is not None:
+        operation.done += n
@@ -0,0 +1,145 @@
+"""CPU placement of slots (see Placement).
+
+The host topology (online CPUs, physical cores and NUMA nodes) is read from
+/sys. CPU sets only depend on the slot number, the number of slots and the
+topology, so they are stable between respawns and recomputed when the service
+is scaled.
+"""
+
+from typing import Dict, Iterable, List, Optional, Tuple
+import os
+from dataclasses import dataclass
+from alwaysup.cmd import Placement
+
+SYS_CPU_PATH = "/sys/devices/system/cpu"
+
+
+def parse_cpu_list(value: str) -> List[int]:
+    """Parse a kernel cpu list (0-3,8,10-11)."""
+    res: List[int] = []
+    for part in value.strip().split(","):
+        if part == "":
+            continue
+        if "-" in part:
+            start, end = part.split("-", 1)
+            res.extend(range(int(start), int(end) + 1))
+        else:
+            res.append(int(part))
+    return res
+
+
+def _read(path: str) -> Optional[str]:
+    try:
+        with open(path, "r") as f:
+            return f.read()
+    except OSError:
+        return None
+
+
+@dataclass
+class CpuTopology:
+    """Host CPU topology.
+
+    Attributes:
+        cores: physical cores as lists of logical CPUs (hyperthreads), sorted by
+            NUMA node and core.
+        nodes: NUMA nodes as lists of physical cores (indexes in cores).
+    """
+
+    cores: List[List[int]]
+    nodes: List[List[int]]
+
+    @property
+    def cpus(self) -> List[int]:
+        return [x for core in self.cores for x in core]
+
+    @classmethod
+    def read(
+        cls, allowed: Optional[Iterable[int]] = None, sys_path: str = SYS_CPU_PATH
+    ) -> "CpuTopology":
+        """Read the topology of allowed CPUs (default: the ones we can run on).
+
+        NUMA nodes are read in the "node" directory next to sys_path.
+        """
+        cpus = set(allowed if allowed is not None else os.sched_getaffinity(0))
+        online = _read(f"{sys_path}/online")
+        if online is not None:
+            cpus &= set(parse_cpu_list(online))
+        node_of: Dict[int, int] = {}
+        node_path = os.path.join(os.path.dirname(sys_path), "node")
+        if os.path.isdir(node_path):
+            for entry in os.listdir(node_path):
+                if entry.startswith("node") and entry[4:].isdigit():
+                    cpulist = _read(f"{node_path}/{entry}/cpulist") or ""
+                    for cpu in parse_cpu_list(cpulist):
+                        node_of[cpu] = int(entry[4:])
+        cores: Dict[Tuple[int, int, int], List[int]] = {}
+        for cpu in sorted(cpus):
+            topology = f"{sys_path}/cpu{cpu}/topology"
+            package = _read(f"{topology}/physical_package_id")
+            core = _read(f"{topology}/core_id")
+            key = (
+                node_of.get(cpu, 0),
+                int(package) if package is not None else 0,
+                # (no topology => each cpu is a core)
+                int(core) if core is not None else -cpu - 1,
+            )
+            cores.setdefault(key, []).append(cpu)
+        keys = sorted(cores.keys())
+        nodes: Dict[int, List[int]] = {}
+        for index, key in enumerate(keys):
+            nodes.setdefault(key[0], []).append(index)
+        return cls(
+            cores=[cores[x] for x in keys], nodes=[nodes[x] for x in sorted(nodes)]
+        )
+
+    def slot_cpus(
+        self, placement: Placement, slot_number: int, slot_count: int
+    ) -> List[int]:
+        """Return the CPU set of a slot (empty => no pinning)."""
+        if placement == Placement.NO or len(self.cores) == 0:
+            return []
+        slot_count = max(slot_count, slot_number + 1)
+        if placement == Placement.PACK:
+            # one logical cpu per slot, hyperthreads of a core first
+            cpus = self.cpus
+            return [cpus[slot_number % len(cpus)]]
+        if placement == Placement.SPREAD:
+            # cores interleaved across nodes, shared between slots as evenly as
+            # possible (a slot gets several cores when there are less slots)
+            order = _interleave(self.nodes)
+            mine = order[slot_number % len(order) :: slot_count]
+            return sorted(x for index in mine for x in self.cores[index])
+        # NUMA: contiguous blocks of slots per node (all cpus of the node)
+        if slot_count >= len(self.nodes):
+            node = slot_number * len(self.nodes) // slot_count
+        else:
+            node = slot_number % len(self.nodes)
+        return sorted(x for index in self.nodes[node] for x in self.cores[index])
+
+
+def _interleave(nodes: List[List[int]]) -> List[int]:
+    res: List[int] = []
+    for i in range(0, max(len(x) for x in nodes)):
+        res.extend(node[i] for node in nodes if i < len(node))
+    return res
+
+
+def set_process_affinity(pid: int, cpus: List[int]):
+    """Set the CPU affinity of all threads of a process.
+
+    Raises:
+        OSError: if the affinity can't be set (on the main thread).
+    """
+    os.sched_setaffinity(pid, cpus)
+    try:
+        tids = [int(x) for x in os.listdir(f"/proc/{pid}/task")]
+    except OSError:
+        return
+    for tid in tids:
+        if tid != pid:
+            try:
+                os.sched_setaffinity(tid, cpus)
+            except OSError:
+                # (thread ended in the meantime)
+                pass
@@ -1,11 +1,15 @@
-from typing import Optional
+from typing import Optional, List, Set, Dict, Any, Counter, cast
 import asyncio
+import collections
+import signal
+import time
 from asyncio.subprocess import Process
 import subprocess
 import enum
 import os
+from contextlib import AsyncExitStack
 import mflog
-from mfutil import get_unique_hexa_identifier, kill_process_and_children
+from mfutil import get_unique_hexa_identifier
 from alwaysup.state import (
     StateMixin,
     OnlyStates,
@@ -15,8 +19,13 @@ from alwaysup.state import (
 from alwaysup.utils import (
     log_exceptions,
     AsyncMutuallyExclusive,
+    get_process_start_time,
+    get_descendant_pids,
 )
-from alwaysup.cmd import Cmd
+from alwaysup.cmd import Cmd, CgroupMode
+from alwaysup.cgroup import Cgroup
+from alwaysup.tracing import span
+from alwaysup.spawn import tune_process
 
 
 class ManagedProcessState(enum.Enum):
@@ -31,6 +40,29 @@ class ManagedProcessState(enum.Enum):
     DEAD = 6  # the process was self-stopped with a !=0 return code or by signal
 
 
+class StopStats:
+    """Which signal of the smart stop ladder actually stopped processes.
+
+    Attributes:
+        counts: number of stopped processes by signal name.
+        durations: total stop duration (in seconds) by signal name.
+    """
+
+    def __init__(self):
+        self.counts: Counter[str] = collections.Counter()
+        self.durations: Dict[str, float] = {}
+
+    def add(self, signal_name: str, duration: float):
+        self.counts[signal_name] += 1
+        self.durations[signal_name] = self.durations.get(signal_name, 0.0) + duration
+
+    def as_dict(self) -> Dict[str, Dict[str, float]]:
+        return {
+            x: {"count": y, "average_duration": self.durations[x] / y}
+            for x, y in self.counts.items()
+        }
+
+
 class ManagedProcess(StateMixin):
     """Short lived object which monitor a process.
 
@@ -41,16 +73,35 @@ class ManagedProcess(StateMixin):
         name: (generated) name of the process
         pid: pid of the process (or None)
         returncode: return code of the process (or None)
+        adopted: True if the process was not launched by us but adopted
+            (after a daemon restart)
         logger: logger to use for structured logging
         cmd: FIXME
+        cgroup: cgroup v2 to put the process in (or None).
+        stop_step: index of the current smart stop step (or None).
+        stopped_by: name of the signal which actually stopped the process (or None
+            if the process was not stopped by us).
+        stop_stats: StopStats object to update at the end of a stop (or None).
+        stdout: stdout stream of the process (if stdout is PIPE, kept after the
+            process end so the output can be read until EOF).
     """
 
     def __init__(
         self,
         name_prefix: str,
         cmd: Cmd,
+        cgroup: Optional[Cgroup] = None,
+        stop_stats: Optional["StopStats"] = None,
+        cpus: List[int] = [],
     ):
         self.cmd: Cmd = cmd
+        self.cpus: List[int] = list(cpus)
+        self.cgroup: Optional[Cgroup] = cgroup
+        self.stop_stats: Optional[StopStats] = stop_stats
+        self.stop_step: Optional[int] = None
+        self.stop_started: Optional[float] = None
+        self.stop_step_started: Optional[float] = None
+        self.stopped_by: Optional[str] = None
         self.id: str = get_unique_hexa_identifier()[0:10]
         self.name: str = f"{name_prefix}.managed_process.{self.id}"
         self.logger = mflog.get_logger("alwaysup.managed_process").bind(id=self.name)
@@ -58,9 +109,11 @@ class ManagedProcess(StateMixin):
         self.process: Optional[Process] = None
         self.pid: Optional[int] = None
         self.returncode: Optional[int] = None
+        self.stdout: Optional[asyncio.StreamReader] = None
         self.set_state(ManagedProcessState.READY)
         self._wait_for_process_end_task: Optional[asyncio.Task] = None
         self.cmd_line: Optional[str] = None
+        self.adopted: bool = False
 
     def is_alive(self) -> bool:
         """Return True if the process still has a pid."""
@@ -103,17 +156,33 @@ class ManagedProcess(StateMixin):
     @AsyncMutuallyExclusive()
     @OnlyStatesOrRaise([ManagedProcessState.READY])
     async def start(self):
-        self.logger.info(f"Creating subprocess (shell) with cmd: {self.cmd}")
+        with span("process.render"):
+            program = self.cmd.program
+            args = self.cmd.args
+        self.cmd_line = " ".join([program] + args)
+        self.logger.info(f"Creating subprocess (shell) with cmd: {self.cmd_line}")
         self.set_state(ManagedProcessState.STARTING)
         try:
-            self.cmd_line = str(self.cmd)
-            self.process = await asyncio.create_subprocess_exec(
-                self.cmd.program,
-                *self.cmd.args,
-                stdin=subprocess.DEVNULL,
-                stdout=self.cmd.stdoutsubprocess,
-                stderr=self.cmd.stderrsubprocess,
-            )
+            with span("process.env"):
+                env = self.cmd.env
+            kwargs: Dict[str, Any] = {}
+            if self.cgroup is not None:
+                # (slower fork path, but the child joins its cgroup before exec,
+                # see alwaysup.spawn)
+                kwargs["preexec_fn"] = self.cgroup.join_function()
+            if self.cmd.listen_fd is not None:
+                kwargs["pass_fds"] = (self.cmd.listen_fd,)
+            with span("process.spawn"):
+                self.process = await asyncio.create_subprocess_exec(
+                    program,
+                    *args,
+                    stdin=subprocess.DEVNULL,
+                    stdout=self.cmd.stdoutsubprocess,
+                    stderr=self.cmd.stderrsubprocess,
+                    start_new_session=True,
+                    env=env,
+                    **kwargs,
+                )
         except Exception:
             self.logger.warning(
                 "can't launch subprocess because of exception", exc_info=True
@@ -121,55 +190,250 @@ class ManagedProcess(StateMixin):
             self.set_state(ManagedProcessState.DEAD)
             return
         self.pid = self.process.pid
+        self.stdout = self.process.stdout
         self.logger = self.logger.bind(_pid=self.pid)
+        if self.cgroup is not None:
+            # (no-op if the child already joined its cgroup)
+            with span("process.cgroup"):
+                try:
+                    self.cgroup.add_process(self.pid)
+                except OSError:
+                    self.logger.warning("can't add the process to its cgroup")
+        with span("process.tune"):
+            settings = self.cmd.process_settings
+            if len(self.cpus) > 0:
+                settings["cpu_affinity"] = self.cpus
+            for error in tune_process(self.pid, **settings):
+                self.logger.warning(error)
         self.set_state(ManagedProcessState.RUNNING)
         event = asyncio.Event()
         self._wait_for_process_end_task: asyncio.Task = asyncio.create_task(
             log_exceptions(self._wait_for_process_end(event))
         )
         # let's wait the _wait_for_process_end coroutine to be started
+        with span("process.wait_monitoring"):
+            await event.wait()
+
+    async def _wait_for_adopted_process_end(self, wait_event: asyncio.Event) -> None:
+        """Wait for the end of an adopted process.
+
+        As an adopted process is not our child, we can't get its return code. We use
+        a pidfd (if available) or a polling loop on the process start time.
+
+        Args:
+            wait_event: asyncio Event to notify when this coroutine is really started.
+        """
+        self.logger.info("Waiting for adopted process to end...")
+        assert self.pid is not None
+        start_time = get_process_start_time(self.pid)
+        pidfd: Optional[int] = None
+        try:
+            pidfd = os.pidfd_open(self.pid)  # type: ignore
+        except Exception:
+            pass
+        wait_event.set()
+        if pidfd is not None:
+            loop = asyncio.get_event_loop()
+            future = loop.create_future()
+            loop.add_reader(pidfd, future.set_result, None)
+            try:
+                await future
+            finally:
+                loop.remove_reader(pidfd)
+                os.close(pidfd)
+        else:
+            while get_process_start_time(self.pid) == start_time:
+                await asyncio.sleep(1.0)
+        self.logger.info("Adopted process ended (unknown returncode)")
+        self.set_state(ManagedProcessState.DEAD)
+        self.logger = self.logger.unbind("_pid")
+        self.pid = None
+
+    @AsyncMutuallyExclusive()
+    @OnlyStatesOrRaise([ManagedProcessState.READY])
+    async def adopt(self, pid: int, cmd_line: Optional[str] = None):
+        """Adopt an already running process (instead of starting a new one)."""
+        self.logger.info(f"Adopting already running process: {pid}")
+        self.adopted = True
+        self.cmd_line = cmd_line
+        self.pid = pid
+        self.logger = self.logger.bind(_pid=self.pid)
+        self.set_state(ManagedProcessState.RUNNING)
+        event = asyncio.Event()
+        self._wait_for_process_end_task = asyncio.create_task(
+            log_exceptions(self._wait_for_adopted_process_end(event))
+        )
         await event.wait()
 
     @AsyncMutuallyExclusive()
     @NotTheseStatesOrRaise([ManagedProcessState.READY])
     @OnlyStates([ManagedProcessState.RUNNING])
     async def stop(self):
-        smart = self.cmd.smart_stop
-        if not smart:
-            return await self._non_smart_stop()
-        self.logger.info("Smart stopping process...")
+        with span("process.stop"):
+            await _stop_processes([self])
+
+    def _begin_stop_step(self, step: int):
+        sig, timeout = self.cmd.smart_stop_steps[step]
+        now = time.monotonic()
+        if self.stop_started is None:
+            self.logger.info("Smart stopping process...")
+            self.stop_started = now
+        else:
+            self.logger.info(f"Smart stopping process (step: {step})...")
         self.set_state(ManagedProcessState.SMART_STOPPING)
-        self._kill(self.cmd.smart_stop_signal)
-        done, _ = await asyncio.wait([self.wait()], timeout=self.cmd.smart_stop_timeout)
-        if len(done) != 1:
-            self.logger.warning("Timeout of smart stopping => let's kill")
-            return await self._non_smart_stop()
+        self.stop_step = step
+        self.stop_step_started = now
+        self._kill(sig)
+
+    def _end_stop(self, sig: int):
+        self.stopped_by = signal.Signals(sig).name
+        if self.stop_started is None:
+            self.stop_started = self.stop_step_started
+        duration = time.monotonic() - cast(float, self.stop_started)
+        if self.stop_stats is not None:
+            self.stop_stats.add(self.stopped_by, duration)
 
-    async def _non_smart_stop(self):
-        self.set_state(ManagedProcessState.STOPPING)
-        self._kill(9)
-        await self.wait()
+    def stop_step_as_dict(self) -> Optional[Dict[str, Any]]:
+        """Return information about the current stop step (or None)."""
+        if not self.is_alive() or self.stop_step_started is None:
+            return None
+        since = time.monotonic() - self.stop_step_started
+        if self.state == ManagedProcessState.STOPPING:
+            return {"index": None, "signal": "SIGKILL", "timeout": None, "since": since}
+        assert self.stop_step is not None
+        sig, timeout = self.cmd.smart_stop_steps[self.stop_step]
+        return {
+            "index": self.stop_step,
+            "signal": signal.Signals(sig).name,
+            "timeout": timeout,
+            "since": since,
+        }
+
+    def _kill_with_cgroup(self) -> bool:
+        return self.cgroup is not None and self.cmd.cgroup == CgroupMode.SLOT
 
     def _kill(self, signal: int):
-        if self.process is None:
+        if self.pid is None:
             return
-        if self.cmd.recursive_sigkill and signal == 9:
-            self.logger.info(
-                "Sending signal %i to %i (and children)" % (signal, self.process.pid)
-            )
-            try:
-                kill_process_and_children(self.process.pid)
-            except Exception:
-                self.logger.warning("can't recursively kill %i", exc_info=True)
-        else:
-            self.logger.info("Sending signal %i to %i" % (signal, self.process.pid))
-            try:
-                os.kill(self.process.pid, signal)
-            except ProcessLookupError:
-                pass
-            except Exception:
-                self.logger.warning("can't kill %i", exc_info=True)
+        if signal == 9:
+            return _sigkill_processes([self])
+        self.logger.info("Sending signal %i to %i" % (signal, self.pid))
+        try:
+            os.kill(self.pid, signal)
+        except ProcessLookupError:
+            pass
+        except Exception:
+            self.logger.warning("can't kill %i", exc_info=True)
 
     @OnlyStates([ManagedProcessState.RUNNING, ManagedProcessState.SMART_STOPPING])
     def kill(self, signal: int):
         self._kill(signal)
+
+
+def _sigkill_processes(processes: List[ManagedProcess]):
+    """Send SIGKILL to several processes together.
+
+    Depending on the configuration, we kill:
+
+    - the whole slot cgroup (cgroup mode SLOT)
+    - the process group and all the descendants (recursive_sigkill)
+    - only the process
+
+    For recursive_sigkill, descendants (even the ones which left the process group)
+    are found with a single /proc scan for all processes.
+
+    """
+    alive = [x for x in processes if x.pid is not None]
+    recursive = [x for x in alive if x.cmd.recursive_sigkill]
+    descendants: Set[int] = set()
+    if len(recursive) > 0:
+        descendants = get_descendant_pids([cast(int, x.pid) for x in recursive])
+    for process in alive:
+        pid = cast(int, process.pid)
+        if process._kill_with_cgroup():
+            process.logger.info("Sending signal 9 to the whole slot cgroup")
+            try:
+                cast(Cgroup, process.cgroup).kill()
+                continue
+            except Exception:
+                process.logger.warning("can't kill the cgroup", exc_info=True)
+        process.logger.info("Sending signal 9 to %i" % pid)
+        try:
+            if process.cmd.recursive_sigkill:
+                # all our processes are started in a new session
+                os.killpg(pid, 9)
+            else:
+                os.kill(pid, 9)
+        except ProcessLookupError:
+            pass
+        except Exception:
+            process.logger.warning("can't kill %i" % pid, exc_info=True)
+    for pid in descendants:
+        try:
+            os.kill(pid, 9)
+        except ProcessLookupError:
+            pass
+        except Exception:
+            mflog.warning("can't kill %i" % pid, exc_info=True)
+
+
+def _wait_tasks(processes: List[ManagedProcess]) -> List[asyncio.Task]:
+    return [
+        x._wait_for_process_end_task
+        for x in processes
+        if x._wait_for_process_end_task is not None
+    ]
+
+
+async def _stop_processes(processes: List[ManagedProcess]):
+    running = [x for x in processes if x.state == ManagedProcessState.RUNNING]
+    step = 0
+    alive = [x for x in running if x.cmd.smart_stop]
+    while True:
+        in_step = [x for x in alive if len(x.cmd.smart_stop_steps) > step]
+        if len(in_step) == 0:
+            break
+        with span("process.stop_step", step=step, processes=len(in_step)):
+            for process in in_step:
+                process._begin_stop_step(step)
+            tasks = _wait_tasks(in_step)
+            if len(tasks) > 0:
+                # a single shared deadline for all processes at this step
+                timeout = max([x.cmd.smart_stop_steps[step][1] for x in in_step])
+                await asyncio.wait(tasks, timeout=timeout)
+        for process in in_step:
+            if not process.is_alive():
+                process._end_stop(process.cmd.smart_stop_steps[step][0])
+        alive = [x for x in in_step if x.is_alive()]
+        step += 1
+    survivors = [x for x in running if x.is_alive()]
+    if len(survivors) == 0:
+        return
+    for process in survivors:
+        if process.state == ManagedProcessState.SMART_STOPPING:
+            process.logger.warning("Timeout of smart stopping => let's kill")
+        process.set_state(ManagedProcessState.STOPPING)
+        process.stop_step_started = time.monotonic()
+    with span("process.sigkill", processes=len(survivors)):
+        _sigkill_processes(survivors)
+        tasks = _wait_tasks(survivors)
+        if len(tasks) > 0:
+            await asyncio.wait(tasks)
+    for process in survivors:
+        process._end_stop(9)
+
+
+async def stop_processes(processes: List[ManagedProcess]):
+    """Stop several processes at once (with a single shared deadline).
+
+    Smart stop signals are sent to all processes in one pass, then we wait for
+    all of them with a single timeout and we SIGKILL survivors together.
+
+    """
+    async with AsyncExitStack() as stack:
+        with span("process.stop", processes=len(processes)):
+            with span("lock_wait", function="stop_processes"):
+                for process in processes:
+                    lock = AsyncMutuallyExclusive.get_lock(process)
+                    await stack.enter_async_context(lock)
+            await _stop_processes(processes)
@@ -0,0 +1,247 @@
+"""Daemon wide spawn scheduler (rate limiting and admission control).
+
+Every process spawn (start, respawn) asks the scheduler for a token first:
+
+- tokens are refilled at a fixed rate (token bucket, with a burst size)
+- waiting spawns are served by priority (higher first), then in FIFO order
+- optional admission control defers spawns while the host is under pressure
+  (Linux PSI "some avg10" of cpu/memory or available memory below a threshold),
+  a spawn deferred for more than max_defer seconds is admitted anyway (still
+  rate limited) so pressure caused by the managed workload can't block respawns
+  forever
+
+So when all slots crash at once (dependency outage...), respawns are smoothed
+instead of fork bombing an already degraded host.
+"""
+
+from typing import Any, Dict, List, Optional, Tuple
+import asyncio
+import heapq
+import itertools
+import time
+import mflog
+from alwaysup.debug import Histogram
+from alwaysup.utils import log_exceptions
+
+# upper bounds (in seconds) of the spawn wait time histogram buckets
+WAIT_BUCKETS: List[float] = [0.001, 0.01, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0]
+
+
+def read_psi(resource: str) -> Optional[float]:
+    """Return the "some avg10" pressure (in %) of a resource (cpu, memory, io)."""
+    try:
+        with open(f"/proc/pressure/{resource}", "r") as f:
+            lines = f.readlines()
+    except OSError:
+        return None
+    for line in lines:
+        if line.startswith("some "):
+            for field in line.split()[1:]:
+                key, value = field.split("=", 1)
+                if key == "avg10":
+                    return float(value)
+    return None
+
+
+def read_available_memory() -> Optional[int]:
+    """Return the available memory (in bytes) of the host (MemAvailable)."""
+    try:
+        with open("/proc/meminfo", "r") as f:
+            lines = f.readlines()
+    except OSError:
+        return None
+    for line in lines:
+        if line.startswith("MemAvailable:"):
+            return int(line.split()[1]) * 1024
+    return None
+
+
+class SpawnScheduler:
+    """Token bucket spawn scheduler with priorities and admission control.
+
+    Attributes:
+        rate: maximum number of spawns per second (0 => no limit).
+        burst: maximum number of tokens (spawns without waiting).
+        psi_cpu_threshold: defer spawns while cpu pressure (some avg10, in %) is
+            above this threshold (0 => no check).
+        psi_memory_threshold: defer spawns while memory pressure (some avg10, in
+            %) is above this threshold (0 => no check).
+        min_available_memory: defer spawns while available memory (in bytes) is
+            below this threshold (0 => no check).
+        max_defer: maximum time (in seconds) a spawn can be deferred by the
+            admission control.
+        check_interval: interval (in seconds) between two host pressure checks.
+    """
+
+    def __init__(
+        self,
+        rate: float = 0.0,
+        burst: int = 10,
+        psi_cpu_threshold: float = 0.0,
+        psi_memory_threshold: float = 0.0,
+        min_available_memory: int = 0,
+        max_defer: float = 60.0,
+        check_interval: float = 1.0,
+    ):
+        self.rate: float = rate
+        self.burst: int = max(burst, 1)
+        self.psi_cpu_threshold: float = psi_cpu_threshold
+        self.psi_memory_threshold: float = psi_memory_threshold
+        self.min_available_memory: int = min_available_memory
+        self.max_defer: float = max_defer
+        self.check_interval: float = check_interval
+        self.logger = mflog.get_logger("alwaysup.scheduler")
+        self.tokens: float = float(self.burst)
+        self.spawns: int = 0
+        self.deferred: int = 0
+        self.wait: Histogram = Histogram(WAIT_BUCKETS)
+        self._refilled: float = time.monotonic()
+        # (-priority, sequence, service, enqueue time, future)
+        self._queue: List[Tuple[int, int, str, float, asyncio.Future]] = []
+        self._sequence = itertools.count()
+        self._dispatch_task: Optional[asyncio.Task] = None
+        self._closed: bool = False
+        self._pressure: Dict[str, Any] = {}
+        self._pressure_checked: Optional[float] = None
+        self._admitted: bool = True
+
+    @property
+    def enabled(self) -> bool:
+        return self.rate > 0 or self.admission_control
+
+    @property
+    def admission_control(self) -> bool:
+        return (
+            self.psi_cpu_threshold > 0
+            or self.psi_memory_threshold > 0
+            or self.min_available_memory > 0
+        )
+
+    async def acquire(self, service: str, priority: int = 0) -> bool:
+        """Wait for the right to spawn a process.
+
+        Returns:
+            False if the scheduler is closed (the spawn must be abandoned).
+        """
+        if self._closed:
+            return False
+        if not self.enabled:
+            return True
+        now = time.monotonic()
+        if len(self._queue) == 0 and self._try_take(now):
+            self._record_wait(0.0)
+            return True
+        future = asyncio.get_running_loop().create_future()
+        entry = (-priority, next(self._sequence), service, now, future)
+        heapq.heappush(self._queue, entry)
+        if self._dispatch_task is None:
+            self._dispatch_task = asyncio.create_task(log_exceptions(self._dispatch()))
+        try:
+            return await future
+        except asyncio.CancelledError:
+            if entry in self._queue:
+                self._queue.remove(entry)
+                heapq.heapify(self._queue)
+            raise
+
+    def close(self):
+        """Abandon all waiting (and future) spawns (manager shutdown)."""
+        self._closed = True
+        for entry in self._queue:
+            if not entry[4].done():
+                entry[4].set_result(False)
+        self._queue = []
+        if self._dispatch_task is not None:
+            self._dispatch_task.cancel()
+
+    def _refill(self, now: float):
+        if self.rate > 0:
+            elapsed = now - self._refilled
+            self.tokens = min(self.tokens + elapsed * self.rate, float(self.burst))
+        self._refilled = now
+
+    def _try_take(self, now: float, force_admission: bool = False) -> bool:
+        if not force_admission and not self._check_admission(now):
+            return False
+        if self.rate <= 0:
+            return True
+        self._refill(now)
+        if self.tokens >= 1.0:
+            self.tokens -= 1.0
+            return True
+        return False
+
+    def _check_admission(self, now: float) -> bool:
+        if not self.admission_control:
+            return True
+        if (
+            self._pressure_checked is not None
+            and now - self._pressure_checked < self.check_interval
+        ):
+            return self._admitted
+        self._pressure_checked = now
+        cpu = read_psi("cpu") if self.psi_cpu_threshold > 0 else None
+        memory = read_psi("memory") if self.psi_memory_threshold > 0 else None
+        available = read_available_memory() if self.min_available_memory > 0 else None
+        self._pressure = {"cpu": cpu, "memory": memory, "available_memory": available}
+        admitted = (
+            (cpu is None or cpu <= self.psi_cpu_threshold)
+            and (memory is None or memory <= self.psi_memory_threshold)
+            and (available is None or available >= self.min_available_memory)
+        )
+        if admitted != self._admitted:
+            if admitted:
+                self.logger.info("host pressure is back to normal, resuming spawns")
+            else:
+                self.logger.warning(
+                    "host is under pressure, deferring spawns", **self._pressure
+                )
+        self._admitted = admitted
+        return admitted
+
+    async def _dispatch(self):
+        try:
+            while len(self._queue) > 0 and not self._closed:
+                now = time.monotonic()
+                _, _, _, enqueued, future = self._queue[0]
+                if future.done():
+                    heapq.heappop(self._queue)
+                    continue
+                forced = now - enqueued > self.max_defer
+                if self._try_take(now, force_admission=forced):
+                    heapq.heappop(self._queue)
+                    self._record_wait(now - enqueued)
+                    future.set_result(True)
+                    continue
+                if not self._check_admission(now) and not forced:
+                    self.deferred += 1
+                    await asyncio.sleep(self.check_interval)
+                else:
+                    # (waiting for the next token)
+                    await asyncio.sleep((1.0 - self.tokens) / self.rate)
+        finally:
+            self._dispatch_task = None
+
+    def _record_wait(self, wait: float):
+        self.spawns += 1
+        self.wait.add(wait)
+
+    def as_dict(self) -> Dict[str, Any]:
+        queued: Dict[str, int] = {}
+        for entry in self._queue:
+            queued[entry[2]] = queued.get(entry[2], 0) + 1
+        now = time.monotonic()
+        return {
+            "rate": self.rate,
+            "burst": self.burst,
+            "tokens": self.tokens,
+            "queue_depth": len(self._queue),
+            "queued_by_service": queued,
+            "oldest_wait": max([now - x[3] for x in self._queue], default=0.0),
+            "spawns": self.spawns,
+            "wait": self.wait.as_dict(),
+            "admission_control": self.admission_control,
+            "admitted": self._admitted,
+            "deferred": self.deferred,
+            "pressure": self._pressure,
+        }
@@ -1,12 +1,31 @@
-from typing import Dict
+from typing import Dict, List, Optional
+import asyncio
 import enum
+import os
+import socket
 import mflog
-import asyncio
 from alwaysup.state import StateMixin, OnlyStates
-from alwaysup.slot import ProcessSlot
-from alwaysup.cmd import Cmd
-from alwaysup.utils import AsyncMutuallyExclusive
+from alwaysup.slot import ProcessSlot, ProcessSlotState, stop_slots, select_victims
+from alwaysup.cmd import Cmd, CgroupMode, Placement
+from alwaysup.cgroup import Cgroup
+from alwaysup.process import StopStats
+from alwaysup.utils import AsyncMutuallyExclusive, log_exceptions
+from alwaysup.journal import Journal, SlotRecord
+from alwaysup.status_table import StatusTable
+from alwaysup.placement import CpuTopology
+from alwaysup.scheduler import SpawnScheduler
+from alwaysup.budget import WorkerBudget
+from alwaysup.logforward import LogForwarder
+from alwaysup.operations import operation_add_total, operation_progress
 from alwaysup.status import Status, list_of_status_to_status
+from alwaysup.tracing import span, TRACER
+from alwaysup.activation import (
+    IDLE_CHECK_INTERVAL,
+    open_listen_socket,
+    close_listen_socket,
+    count_connections,
+    count_files,
+)
 
 
 class ServiceState(enum.Enum):
@@ -29,6 +48,34 @@ class Service(StateMixin):
         StateMixin.__init__(self, logger=self.logger)
         self.slots: Dict[int, ProcessSlot] = {}
         self.slot_number: int = slot_number
+        self.journal: Optional[Journal] = None
+        self.status_table: Optional[StatusTable] = None
+        self.spawn_scheduler: Optional[SpawnScheduler] = None
+        self.budget: Optional[WorkerBudget] = None
+        self._starting: int = 0
+        self._to_adopt: Dict[int, SlotRecord] = {}
+        self.cgroup: Optional[Cgroup] = None
+        self.stop_stats: StopStats = StopStats()
+        self._topology: Optional[CpuTopology] = None
+        # target (see _reconcile()) and number of coalesced commands
+        self._running: bool = False
+        self._generation: int = 0
+        self._reconciled: int = 0
+        self.coalesced: int = 0
+        # scale to zero (see _watch_idle())
+        self._idle: bool = False
+        self._idle_task: Optional[asyncio.Task] = None
+        self._activity: Optional[asyncio.Event] = None
+        self._activation_socket: Optional[socket.socket] = None
+        self.idle_scale_downs: int = 0
+        self.log_forwarder: Optional[LogForwarder] = None
+        if cmd.log_forward != "":
+            self.log_forwarder = LogForwarder(
+                cmd.log_forward,
+                batch_size=cmd.log_forward_batch_size,
+                batch_delay=cmd.log_forward_batch_delay,
+                queue_size=cmd.log_forward_queue_size,
+            )
         self.set_state(ServiceState.STOPPED)
 
     @property
@@ -36,6 +83,9 @@ class Service(StateMixin):
         if self.state in [ServiceState.STOPPED, ServiceState.SHUTDOWN]:
             return Status.STOPPED
         statuses = [x.status for x in self.slots.values()]
+        if len(statuses) == 0 and self.state == ServiceState.RUNNING:
+            # (scaled to zero)
+            return Status.OK
         if self.state in [
             ServiceState.STOPPING,
             ServiceState.STARTING,
@@ -54,8 +104,23 @@ class Service(StateMixin):
             "state_since": self.seconds_since_latest_state_change(),
             "state_hsince": self.humanized_time_since_latest_state_change(),
             "slot_number": self.slot_number,
+            "target": {
+                "running": self._running,
+                "slot_number": self.slot_number,
+                "granted": self._target_slot_number(),
+            },
+            "coalesced": self.coalesced,
+            "idle": self._idle,
+            "idle_scale_downs": self.idle_scale_downs,
+            "in_flight": self.in_flight(),
+            "log_forward": (
+                self.log_forwarder.as_dict() if self.log_forwarder is not None else None
+            ),
             "number_of_slots_running": self.number_of_slots_running(),
             "slots": {x: y.as_dict() for x, y in self.slots.items()},
+            "cgroup": self.cgroup.stats() if self.cgroup is not None else None,
+            "stopped_by": self.stop_stats.as_dict(),
+            "latencies": TRACER.percentiles(self.name),
         }
 
     def is_running(self):
@@ -67,38 +132,370 @@ class Service(StateMixin):
     def number_of_slots_running(self):
         return len([x for x in self.slots.values() if x.is_running()])
 
+    def number_of_slots_in_use(self) -> int:
+        """Return the number of slots which are not stopped (or being started)."""
+        stopped = (ProcessSlotState.STOPPED, ProcessSlotState.SHUTDOWN)
+        in_use = [x for x in self.slots.values() if x.state not in stopped]
+        return len(in_use) + self._starting
+
     @property
     def autostart(self):
-        return self.cmd.autostart
+        return self.cmd.autostart or len(self._to_adopt) > 0
+
+    def set_processes_to_adopt(self, slots: Dict[int, SlotRecord]):
+        """Set already running processes to adopt (instead of spawning new ones).
+
+        Processes which are not running anymore (or replaced by another process
+        with the same pid) are ignored.
+
+        """
+        self._to_adopt = {x: y for x, y in slots.items() if y.is_alive()}
+
+    def record_in_journal(self):
+        if self.journal is not None:
+            self.journal.record_service(
+                self.name, self.slot_number, self.cmd.config.to_dict()
+            )
+
+    def _new_target(self) -> int:
+        self._generation += 1
+        return self._generation
 
-    @AsyncMutuallyExclusive()
-    @OnlyStates([ServiceState.STOPPED])
     async def start(self):
+        """Start the service (the target is changed, see _reconcile())."""
+        if self.is_shutdown():
+            return
+        self._running = True
+        self._idle = False
+        self.notify_work()
+        await self._reconcile(self._new_target())
+
+    async def stop(self) -> None:
+        """Stop the service (the target is changed, see _reconcile())."""
+        if self.is_shutdown():
+            return
+        self._running = False
+        await self._reconcile(self._new_target())
+
+    async def set_slot_number(self, slot_number: int) -> None:
+        """Change the number of slots (the target is changed, see _reconcile())."""
+        if self.is_shutdown():
+            return
+        if slot_number != self.slot_number:
+            self.slot_number = slot_number
+            self.record_in_journal()
+        # (an explicit scale is some demand)
+        self._idle = False
+        self.notify_work()
+        await self._reconcile(self._new_target())
+
+    @AsyncMutuallyExclusive()
+    async def _reconcile(self, generation: int):
+        """Converge to the latest target (running or not, number of slots).
+
+        Commands only change the target and wait for the convergence. Commands
+        queued behind a running convergence are coalesced: the convergence
+        follows the latest target (re-read between two slot starts) so obsolete
+        intermediate targets are skipped, and queued commands find their target
+        already reached.
+        """
+        if self._reconciled >= generation:
+            self.coalesced += 1
+            return
+        while self._reconciled < self._generation and not self.is_shutdown():
+            converging = self._generation
+            if self.budget is not None:
+                self.budget.update(caller=self)
+            if not self._running:
+                if self.state != ServiceState.STOPPED:
+                    await self._stop_or_shutdown(shutdown=False)
+            elif self.state == ServiceState.STOPPED:
+                await self._start()
+            else:
+                await self._scale()
+            self._reconciled = converging
+
+    async def _start(self):
         self.logger.info("Service is starting")
         self.set_state(ServiceState.STARTING)
-        for i in range(0, self.slot_number):
-            await self._start_slot(i)
+        # (env files and CPU topology are reloaded at each service start)
+        self.cmd.reset_env()
+        self._topology = None
+        self._create_cgroup()
+        self._open_activation_socket()
+        if self.log_forwarder is not None:
+            self.log_forwarder.start()
+        # (stopped slots of a previous run are replaced by new ones)
+        stale, self.slots = list(self.slots.values()), {}
+        await stop_slots(stale, shutdown=True)
+        self._notify_budget()
+        operation_add_total(self._target_slot_number())
+        await self._start_slots()
         self.set_state(ServiceState.RUNNING)
         self.logger.info("Service started")
+        if self.cmd.idle_timeout > 0 and self._idle_task is None:
+            self._idle_task = asyncio.create_task(log_exceptions(self._watch_idle()))
 
-    async def _start_slot(self, i):
-        slot = ProcessSlot(self.name, i, self.cmd)
-        await slot.start()
-        self.slots[i] = slot
+    def _free_slot_number(self) -> int:
+        # (numbers of processes to adopt first, then the lowest free one)
+        for i in sorted(self._to_adopt.keys()):
+            if i not in self.slots:
+                return i
+        i = 0
+        while i in self.slots:
+            i += 1
+        return i
 
-    @AsyncMutuallyExclusive()
-    @OnlyStates([ServiceState.RUNNING])
-    async def stop(self) -> None:
-        await self._stop_or_shutdown(shutdown=False)
+    async def _start_slots(self):
+        # (the target is re-read after each slot start)
+        while self._running and len(self.slots) < self._target_slot_number():
+            if self.budget is not None and not self.budget.has_room(self):
+                # (preempted slots of other services are still stopping)
+                await self.budget.wait_for_room()
+                continue
+            self._starting += 1
+            try:
+                await self._start_slot(self._free_slot_number())
+            finally:
+                self._starting -= 1
+
+    def wanted_slot_number(self) -> int:
+        """Return the number of slots wanted (before the worker budget)."""
+        if not self._running or self._idle:
+            # (an idle service is scaled to zero, see _watch_idle())
+            return 0
+        return self.slot_number
+
+    def _target_slot_number(self) -> int:
+        if self.budget is None:
+            return self.wanted_slot_number()
+        return min(self.wanted_slot_number(), self.budget.granted(self))
+
+    async def apply_budget(self):
+        """Converge to a new grant of the worker budget (see WorkerBudget)."""
+        if self.is_shutdown() or not self._running:
+            return
+        await self._reconcile(self._new_target())
+
+    def _notify_budget(self):
+        # (some slots were removed)
+        if self.budget is not None:
+            self.budget.notify()
+
+    async def _scale(self):
+        current = len(self.slots)
+        target = self._target_slot_number()
+        if target > current:
+            self.logger.info(f"Service is scaling up {current} => {target}")
+            self.set_state(ServiceState.SCALING_UP)
+            self._rebalance()
+            operation_add_total(target - current)
+            await self._start_slots()
+            self.set_state(ServiceState.RUNNING)
+        elif target < current:
+            self.logger.info(f"Service is scaling down {current} => {target}")
+            self.set_state(ServiceState.SCALING_DOWN)
+            operation_add_total(current - target)
+            victims = await select_victims(
+                list(self.slots.values()),
+                current - target,
+                self.cmd.scale_down_policy,
+            )
+            for slot in victims:
+                self.slots.pop(slot.slot_number)
+            # (victims are drained together, remaining slots keep their numbers)
+            await stop_slots(victims, shutdown=True)
+            self._notify_budget()
+            operation_progress(len(victims))
+            self._rebalance()
+            self.set_state(ServiceState.RUNNING)
+
+    def in_flight(self) -> Optional[int]:
+        """Return the amount of in-flight work (None => unknown).
+
+        See alwaysup.activation.
+        """
+        res: Optional[int] = None
+        if self._activation_socket is not None:
+            res = count_connections(self._activation_socket)
+        if self.cmd.activation_spool_dir != "":
+            res = (res or 0) + count_files(self.cmd.activation_spool_dir)
+        return res
+
+    def notify_work(self):
+        """Wake up an idle service (some work arrived)."""
+        if self._activity is not None:
+            self._activity.set()
+
+    async def _watch_idle(self):
+        """Scale the service to zero when idle, and back when some work arrives.
+
+        The service stays RUNNING (with zero slots) while idle.
+        """
+        loop = asyncio.get_running_loop()
+        self._activity = asyncio.Event()
+        if self.in_flight() is None:
+            self.logger.warning(
+                "idle_timeout without activation socket or spool => never idle"
+            )
+        busy = loop.time()
+        while self._idle_task is asyncio.current_task():
+            if self._idle:
+                await self._wait_for_work()
+                if self._idle:
+                    self.logger.info("Some work arrived, starting the service")
+                    self._idle = False
+                    await self._reconcile(self._new_target())
+                # (else an explicit command already woke the service up)
+                busy = loop.time()
+                continue
+            await asyncio.sleep(IDLE_CHECK_INTERVAL)
+            in_flight = self.in_flight()
+            if in_flight is None or in_flight > 0 or len(self.slots) == 0:
+                busy = loop.time()
+            elif loop.time() - busy >= self.cmd.idle_timeout:
+                self.logger.info(
+                    f"No in-flight work for {self.cmd.idle_timeout}s, "
+                    "scaling to zero"
+                )
+                self._idle = True
+                self.idle_scale_downs += 1
+                await self._reconcile(self._new_target())
+
+    async def _wait_for_work(self):
+        assert self._activity is not None
+        self._activity.clear()
+        sock = self._activation_socket
+        loop = asyncio.get_running_loop()
+        if sock is not None:
+            # (a pending connection wakes us up, it stays in the backlog)
+            loop.add_reader(sock.fileno(), self._activity.set)
+        try:
+            while (
+                self._idle
+                and not self._activity.is_set()
+                and (self.in_flight() or 0) == 0
+            ):
+                try:
+                    await asyncio.wait_for(self._activity.wait(), IDLE_CHECK_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            if sock is not None:
+                loop.remove_reader(sock.fileno())
+
+    async def _stop_idle_watch(self):
+        task, self._idle_task = self._idle_task, None
+        self._idle = False
+        if task is not None and task is not asyncio.current_task():
+            task.cancel()
+            await asyncio.wait([task])
+        # (else the watch is stopping the service itself, it ends after that)
+
+    def _open_activation_socket(self):
+        if self.cmd.activation_socket == "" or self._activation_socket is not None:
+            return
+        try:
+            sock = open_listen_socket(self.cmd.activation_socket)
+        except (OSError, ValueError):
+            self.logger.warning(
+                "can't open the activation socket => no socket", exc_info=True
+            )
+            return
+        self._activation_socket = sock
+        self.cmd.set_listen_fd(sock.fileno())
+
+    def _close_activation_socket(self):
+        if self._activation_socket is None:
+            return
+        self.cmd.set_listen_fd(None)
+        close_listen_socket(self._activation_socket)
+        self._activation_socket = None
+
+    def _create_cgroup(self):
+        if self.cmd.cgroup == CgroupMode.NO or self.cgroup is not None:
+            return
+        cgroup = Cgroup(os.path.join(self.cmd.cgroup_root, self.name))
+        try:
+            cgroup.create(enable_controllers=self.cmd.cgroup == CgroupMode.SLOT)
+        except OSError:
+            self.logger.warning(
+                "can't create the service cgroup => no cgroup", exc_info=True
+            )
+            return
+        if self.cmd.cgroup == CgroupMode.SERVICE:
+            cgroup.set_limits(self.cmd.memory_max, self.cmd.cpu_max)
+        self.cgroup = cgroup
+
+    def _make_slot_cgroup(self, i) -> Optional[Cgroup]:
+        if self.cgroup is None or self.cmd.cgroup != CgroupMode.SLOT:
+            return self.cgroup
+        cgroup = self.cgroup.child(f"slot{i}")
+        try:
+            cgroup.create()
+        except OSError:
+            self.logger.warning("can't create the slot cgroup", exc_info=True)
+            return None
+        cgroup.set_limits(self.cmd.memory_max, self.cmd.cpu_max)
+        return cgroup
+
+    def _slot_cpus(self, i: int) -> List[int]:
+        if self.cmd.placement == Placement.NO:
+            return []
+        if self._topology is None:
+            allowed = self.cmd.process_settings["cpu_affinity"]
+            self._topology = CpuTopology.read(allowed if allowed else None)
+        return self._topology.slot_cpus(self.cmd.placement, i, self.slot_number)
+
+    def _rebalance(self):
+        # (CPU sets depend on the number of slots)
+        for i, slot in self.slots.items():
+            slot.set_cpus(self._slot_cpus(i))
+
+    def _make_slot(self, i: int) -> ProcessSlot:
+        return ProcessSlot(
+            self.name,
+            i,
+            self.cmd,
+            journal=self.journal,
+            cgroup=self._make_slot_cgroup(i),
+            stop_stats=self.stop_stats,
+            status_table=self.status_table,
+            cpus=self._slot_cpus(i),
+            spawn_scheduler=self.spawn_scheduler,
+            log_forwarder=self.log_forwarder,
+        )
+
+    async def _start_slot(self, i):
+        with span("service.start_slot", self.name, slot=i):
+            with span("slot.create"):
+                slot = self._make_slot(i)
+            record = self._to_adopt.pop(i, None)
+            if record is not None and record.is_alive():
+                await slot.adopt(record.pid, record.cmd_line)
+            else:
+                await slot.start()
+            self.slots[i] = slot
+        operation_progress()
 
     async def _stop_or_shutdown(self, shutdown=True):
         self.logger.info("Service is stopping")
         self.set_state(ServiceState.STOPPING)
+        await self._stop_idle_watch()
         if len(self.slots) > 0:
-            if shutdown:
-                await asyncio.wait([x.shutdown() for x in self.slots.values()])
-            else:
-                await asyncio.wait([x.stop() for x in self.slots.values()])
+            operation_add_total(len(self.slots))
+            await stop_slots(list(self.slots.values()), shutdown=shutdown)
+            # (slots are stopped together, with a single deadline)
+            operation_progress(len(self.slots))
+            self._notify_budget()
+        if self.cgroup is not None and self.cmd.cgroup == CgroupMode.SERVICE:
+            # kill what is left in the service cgroup (daemonized descendants...),
+            # slots can't use it themselves as it is shared by all slots
+            self.cgroup.kill()
+        self._close_activation_socket()
+        if self.log_forwarder is not None:
+            # (the end of the output of stopped processes is forwarded)
+            await self.log_forwarder.close()
         if shutdown:
             self.set_state(ServiceState.SHUTDOWN)
             self.logger.info("Service is shutdown")
@@ -106,43 +503,22 @@ class Service(StateMixin):
             self.set_state(ServiceState.STOPPED)
             self.logger.info("Service is stopped")
 
+    async def shutdown(self):
+        # (pending targets are obsolete, a running convergence stops early)
+        self._running = False
+        self._new_target()
+        if self.budget is not None:
+            self.budget.update(caller=self)
+        await self._shutdown()
+
     @AsyncMutuallyExclusive()
     @OnlyStates([ServiceState.RUNNING, ServiceState.STOPPED])
-    async def shutdown(self):
+    async def _shutdown(self):
         await self._stop_or_shutdown(shutdown=True)
         self.set_state(ServiceState.SHUTDOWN)
         await self.wait()
-
-    @AsyncMutuallyExclusive()
-    @OnlyStates([ServiceState.RUNNING, ServiceState.STOPPED])
-    async def set_slot_number(self, slot_number: int) -> None:
-        if self.state == ServiceState.STOPPED:
-            self.slot_number = slot_number
-            return
-        if slot_number > self.slot_number:
-            old_slot_number = self.slot_number
-            self.slot_number = slot_number
-            self.logger.info(
-                f"Service is scaling up {self.slot_number} => {slot_number}"
-            )
-            self.set_state(ServiceState.SCALING_UP)
-            for i in range(old_slot_number, slot_number):
-                await self._start_slot(i)
-            self.set_state(ServiceState.RUNNING)
-        elif slot_number < self.slot_number:
-            old_slot_number = self.slot_number
-            self.slot_number = slot_number
-            self.logger.info(
-                f"Service is scaling down {self.slot_number} => {slot_number}"
-            )
-            self.set_state(ServiceState.SCALING_DOWN)
-            for i in range(slot_number, old_slot_number):
-                slot = self.slots.pop(i)
-                await slot.shutdown()
-            self.set_state(ServiceState.RUNNING)
-        else:
-            # no change
-            return
+        if self.cgroup is not None:
+            self.cgroup.remove()
 
     async def wait(self):
         while self.state != ServiceState.SHUTDOWN:
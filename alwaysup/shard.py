@@ -0,0 +1,331 @@
+"""Sharded supervision (services partitioned across several processes).
+
+Each shard is an alwaysup daemon process (without HTTP API) with its own manager,
+journal and control socket. Shards are managed as services of the coordinator
+manager: a crashed shard is respawned (and re-adopts its still running processes
+thanks to its journal) without impacting other shards.
+
+Services are assigned to shards with a stable hash of their name.
+"""
+
+from typing import Any, Dict, List, Optional
+import asyncio
+import datetime
+import os
+import shutil
+import sys
+import tempfile
+import zlib
+import mflog
+from alwaysup.manager import Manager
+from alwaysup.service import Service
+from alwaysup.cmd import Cmd, CmdConfiguration, Templating, StdxxxHandler
+from alwaysup.commands import CommandError
+from alwaysup.control import ControlError, async_request
+from alwaysup.status import Status, list_of_status_to_status
+from alwaysup.scheduler import SpawnScheduler
+from alwaysup.jobs import JobQueueService
+from alwaysup.operations import OPERATION_COMMANDS, Operation, get_current_operation
+from alwaysup.utils import log_exceptions
+
+# commands routed to a single shard (depending on the service name)
+ROUTED_COMMANDS = (
+    "service",
+    "add_service",
+    "remove_service",
+    "start_service",
+    "stop_service",
+    "scale_service",
+    "scale_service_up",
+    "scale_service_down",
+    "start_slot",
+    "stop_slot",
+    "kill_slot",
+    "submit_job",
+    "jobs",
+    "job",
+)
+
+
+def shard_of(name: str, shards: int) -> int:
+    """Return the shard index of a service (stable between restarts)."""
+    return zlib.crc32(name.encode()) % shards
+
+
+class ShardCoordinator:
+    """Start shards and route control commands to them.
+
+    Attributes:
+        manager: the coordinator manager (shards are its services).
+        shards: number of shards.
+        socket_path: base path of shards control sockets ({socket_path}.shard{i}).
+        journal_path: base path of shards journals ({journal_path}.shard{i}),
+            None => temporary journals (removed at the end).
+        stdout: stdout of shard processes (see CmdConfiguration).
+        refresh_interval: interval (in seconds) between two merged snapshots.
+        operation_poll_interval: interval (in seconds) between two polls of a
+            shard operation (see execute_operation()).
+        timeout: timeout (in seconds) of requests to shards.
+        loop: event loop backend of shards (see alwaysup.loop).
+        status_table_path: base path of shards status tables
+            ({status_table_path}.shard{i}), None => no status table.
+        spawn_scheduler: spawn scheduler settings (the rate and burst are split
+            between shards, admission control thresholds are the same).
+        worker_budget: worker budget capacity (split between shards, 0 => no
+            limit).
+        snapshot: latest merged snapshot (same format as Manager.as_dict() with an
+            extra "shards" key).
+    """
+
+    def __init__(
+        self,
+        manager: Manager,
+        shards: int,
+        socket_path: str,
+        journal_path: Optional[str] = None,
+        stdout: str = "NULL",
+        refresh_interval: float = 0.5,
+        operation_poll_interval: float = 0.2,
+        timeout: float = 60.0,
+        loop: str = "auto",
+        status_table_path: Optional[str] = None,
+        spawn_scheduler: Optional[SpawnScheduler] = None,
+        worker_budget: float = 0.0,
+    ):
+        self.manager: Manager = manager
+        self.shards: int = shards
+        self.socket_path: str = socket_path
+        self.journal_path: Optional[str] = journal_path
+        self.stdout: str = stdout
+        self.refresh_interval: float = refresh_interval
+        self.operation_poll_interval: float = operation_poll_interval
+        self.timeout: float = timeout
+        self.loop: str = loop
+        self.status_table_path: Optional[str] = status_table_path
+        self.spawn_scheduler: Optional[SpawnScheduler] = spawn_scheduler
+        self.worker_budget: float = worker_budget
+        self.snapshot: Dict[str, Any] = {}
+        self.logger = mflog.get_logger("alwaysup.shard")
+        self._tmp_dir: Optional[str] = None
+        self._refresh_task: Optional[asyncio.Task] = None
+
+    def shard_socket_path(self, i: int) -> str:
+        return f"{self.socket_path}.shard{i}"
+
+    def shard_journal_path(self, i: int) -> str:
+        if self.journal_path is not None:
+            return f"{self.journal_path}.shard{i}"
+        if self._tmp_dir is None:
+            self._tmp_dir = tempfile.mkdtemp(prefix="alwaysup-shards-")
+        return os.path.join(self._tmp_dir, f"journal.shard{i}")
+
+    def make_shard_service(self, i: int) -> Service:
+        args = [
+            "-m",
+            "alwaysup.cli",
+            "start-daemon",
+            "--foreground",
+            "--port=0",
+            f"--socket-path={self.shard_socket_path(i)}",
+            f"--journal-path={self.shard_journal_path(i)}",
+            # (no delay: a record lost in a crash means an orphaned process)
+            "--journal-fsync-interval=0",
+            "--readopt",
+            "--no-supervisor-thread",
+            f"--loop={self.loop}",
+        ]
+        if self.status_table_path is not None:
+            args.append(f"--status-table-path={self.status_table_path}.shard{i}")
+        scheduler = self.spawn_scheduler
+        if scheduler is not None:
+            args += [
+                f"--spawn-rate={scheduler.rate / self.shards}",
+                f"--spawn-burst={max(scheduler.burst // self.shards, 1)}",
+                f"--admission-psi-cpu={scheduler.psi_cpu_threshold}",
+                f"--admission-psi-memory={scheduler.psi_memory_threshold}",
+                f"--admission-min-memory={scheduler.min_available_memory}",
+            ]
+        if self.worker_budget > 0:
+            args.append(f"--worker-budget={self.worker_budget / self.shards}")
+        config = CmdConfiguration(
+            program=sys.executable,
+            args=args,
+            templating=Templating.NO,
+            stdxxx_handler=StdxxxHandler.NULL,
+            stdout=self.stdout,
+            # let the shard stop its own processes
+            smart_stop_timeout=max(self.timeout, 60.0),
+            # a killed shard must not take its processes with it (they will be
+            # re-adopted by the respawned shard)
+            recursive_sigkill=False,
+        )  # type: ignore
+        return Service(f"shard{i}", 1, Cmd(config))
+
+    async def start(self):
+        """Start shards (and wait for their control sockets)."""
+        for i in range(0, self.shards):
+            await self.manager.add_service(self.make_shard_service(i))
+        for i in range(0, self.shards):
+            await self._wait_for_shard(i)
+        await self.refresh()
+        self._refresh_task = asyncio.create_task(
+            log_exceptions(self._refresh_forever())
+        )
+
+    async def _wait_for_shard(self, i: int, timeout: float = 30.0):
+        loop = asyncio.get_event_loop()
+        end = loop.time() + timeout
+        while loop.time() < end:
+            try:
+                await async_request(self.shard_socket_path(i), "manager", timeout=1.0)
+                return
+            except (ConnectionError, OSError, asyncio.TimeoutError):
+                await asyncio.sleep(0.1)
+        self.logger.warning(f"shard {i} is not available after {timeout} seconds")
+
+    async def stop(self):
+        """Stop the snapshot refresh (shards are stopped with the manager)."""
+        if self._refresh_task is not None:
+            self._refresh_task.cancel()
+            await asyncio.wait([self._refresh_task])
+            self._refresh_task = None
+        if self._tmp_dir is not None and not self.manager.is_running():
+            shutil.rmtree(self._tmp_dir, ignore_errors=True)
+            self._tmp_dir = None
+
+    async def _refresh_forever(self):
+        while True:
+            await asyncio.sleep(self.refresh_interval)
+            await self.refresh()
+
+    async def request(self, i: int, command: str, params: Dict[str, Any]) -> Any:
+        """Send a command to a shard.
+
+        Raises:
+            CommandError: if the command fails or if the shard is not available.
+        """
+        try:
+            return await async_request(
+                self.shard_socket_path(i), command, params, timeout=self.timeout
+            )
+        except ControlError as e:
+            raise CommandError(e.status_code, e.detail)
+        except (ConnectionError, OSError, asyncio.TimeoutError):
+            raise CommandError(503, f"shard {i} is not available")
+
+    async def broadcast(self, command: str, params: Dict[str, Any] = {}) -> List[Any]:
+        """Send a command to all shards (exceptions are returned, not raised)."""
+        return await asyncio.gather(
+            *[self.request(i, command, params) for i in range(0, self.shards)],
+            return_exceptions=True,
+        )
+
+    async def refresh(self):
+        """Build a new merged snapshot from all shards."""
+        results = await self.broadcast("manager")
+        services: Dict[str, Any] = {}
+        shards: Dict[int, Dict[str, Any]] = {}
+        statuses: List[Status] = []
+        for i, result in enumerate(results):
+            shard_service = self.manager.services.get(f"shard{i}")
+            available = not isinstance(result, Exception)
+            shards[i] = {
+                "socket_path": self.shard_socket_path(i),
+                "state": shard_service.state.name if shard_service else None,
+                "available": available,
+                "pid": (
+                    shard_service.slots[0].pid
+                    if shard_service is not None and 0 in shard_service.slots
+                    else None
+                ),
+            }
+            if not available:
+                statuses.append(Status.NOK)
+                continue
+            for name, service in result["services"].items():
+                services[name] = dict(service, shard=i)
+                statuses.append(Status[service["status"]])
+        self.snapshot = {
+            "state": self.manager.state.name,
+            "status": list_of_status_to_status(statuses).name,
+            "state_since": self.manager.seconds_since_latest_state_change(),
+            "state_hsince": self.manager.humanized_time_since_latest_state_change(),
+            "services": services,
+            "shards": shards,
+            "refreshed": datetime.datetime.utcnow().isoformat(),
+        }
+
+    async def execute(self, command: str, params: Dict[str, Any]) -> Any:
+        """Execute a control command (see alwaysup.commands) on shards.
+
+        Raises:
+            CommandError: if the command fails.
+        """
+        if command in ROUTED_COMMANDS:
+            name = params.get("config", {}).get("name", params.get("name"))
+            if name is None:
+                raise CommandError(400, "missing name parameter")
+            shard = shard_of(name, self.shards)
+            operation = get_current_operation()
+            if operation is not None and command in OPERATION_COMMANDS:
+                res = await self.execute_operation(shard, operation, command, params)
+            else:
+                res = await self.request(shard, command, params)
+            if command in ("add_service", "remove_service"):
+                await self.refresh()
+            return res
+        if command == "manager":
+            await self.refresh()
+            return self.snapshot
+        if command == "services":
+            await self.refresh()
+            return list(self.snapshot["services"].values())
+        if command in ("spawn_scheduler", "budget"):
+            results = await self.broadcast(command)
+            return {
+                i: None if isinstance(x, Exception) else x
+                for i, x in enumerate(results)
+            }
+        if command == "stop_all":
+            for result in await self.broadcast("stop_all"):
+                if isinstance(result, CommandError):
+                    raise result
+            return None
+        if command == "shutdown":
+            # (shards shutdown their processes when they are stopped)
+            await self.manager.shutdown()
+            return None
+        raise CommandError(400, f"unknown command: {command}")
+
+    async def execute_operation(
+        self, i: int, operation: Operation, command: str, params: Dict[str, Any]
+    ) -> Any:
+        """Execute a command as an operation of a shard.
+
+        The shard operation is polled and its progress is copied to the local
+        operation (services run in shards, so progress is only known there).
+
+        Raises:
+            CommandError: if the command (or the shard operation) fails.
+        """
+        res = await self.request(i, command, dict(params, wait=False))
+        while True:
+            await asyncio.sleep(self.operation_poll_interval)
+            d = await self.request(i, "operation", {"id": res["id"]})
+            operation.total = d["total"]
+            operation.done = d["done"]
+            if d["state"] == "SUCCEEDED":
+                return d["result"]
+            if d["state"] == "FAILED":
+                raise CommandError(500, "; ".join(d["errors"]))
+
+    async def add_service(self, service: Service):
+        """Add a (not started) service object to its shard."""
+        params = {
+            "name": service.name,
+            "workers": service.slot_number,
+            "config": service.cmd.config.to_dict(),
+        }
+        if isinstance(service, JobQueueService):
+            params["job_queue"] = service.settings.to_dict()
+        await self.execute("add_service", params)
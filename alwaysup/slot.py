@@ -1,12 +1,26 @@
-from typing import Optional
+from typing import Dict, Optional, List, cast
 import asyncio
 import enum
+from contextlib import AsyncExitStack
 import mflog
-from alwaysup.utils import log_exceptions, AsyncMutuallyExclusive
+from alwaysup.utils import (
+    log_exceptions,
+    AsyncMutuallyExclusive,
+    get_process_start_time,
+    get_process_cpu_time,
+    get_process_rss,
+)
 from alwaysup.state import StateMixin, OnlyStates
-from alwaysup.cmd import Cmd
-from alwaysup.process import ManagedProcess
+from alwaysup.cmd import Cmd, CgroupMode, ScaleDownPolicy
+from alwaysup.process import ManagedProcess, StopStats, stop_processes
 from alwaysup.status import Status
+from alwaysup.journal import Journal
+from alwaysup.status_table import StatusTable
+from alwaysup.placement import set_process_affinity
+from alwaysup.scheduler import SpawnScheduler
+from alwaysup.logforward import LogForwarder
+from alwaysup.cgroup import Cgroup
+from alwaysup.tracing import span, detach_span
 
 
 class ProcessSlotState(enum.Enum):
@@ -18,8 +32,27 @@ class ProcessSlotState(enum.Enum):
     WAITING_FOR_RESTART = 6
 
 
+# CPU usage sampling duration (in seconds) of the LEAST_CPU scale down policy
+CPU_SAMPLE_DURATION = 0.5
+
+STOPPABLE_STATES = [ProcessSlotState.RUNNING, ProcessSlotState.WAITING_FOR_RESTART]
+SHUTDOWNABLE_STATES = STOPPABLE_STATES + [ProcessSlotState.STOPPED]
+
+
 class ProcessSlot(StateMixin):
-    def __init__(self, name_prefix, slot_number, cmd: Cmd):
+    def __init__(
+        self,
+        name_prefix,
+        slot_number,
+        cmd: Cmd,
+        journal: Optional[Journal] = None,
+        cgroup: Optional[Cgroup] = None,
+        stop_stats: Optional[StopStats] = None,
+        status_table: Optional[StatusTable] = None,
+        cpus: List[int] = [],
+        spawn_scheduler: Optional[SpawnScheduler] = None,
+        log_forwarder: Optional[LogForwarder] = None,
+    ):
         self.name_prefix = name_prefix
         self.slot_number: int = slot_number
         self.name = self.name_prefix + "." + str(self.slot_number)
@@ -27,9 +60,21 @@ class ProcessSlot(StateMixin):
         self.logger = mflog.get_logger("alwaysup.process_slot").bind(id=self.name)
         StateMixin.__init__(self, logger=self.logger)
         self.managed_process: Optional[ManagedProcess] = None
+        self.restarts: int = 0
+        self.cpus: List[int] = list(cpus)
+        self.status_table: Optional[StatusTable] = status_table
         self.set_state(ProcessSlotState.STOPPED)
         self._manage_task = asyncio.create_task(log_exceptions(self._manage()))
         self._waiting_for_restart_task = None
+        self.journal: Optional[Journal] = journal
+        self.cgroup: Optional[Cgroup] = cgroup
+        self.stop_stats: StopStats = (
+            stop_stats if stop_stats is not None else StopStats()
+        )
+        self.spawn_scheduler: SpawnScheduler = (
+            spawn_scheduler if spawn_scheduler is not None else SpawnScheduler()
+        )
+        self.log_forwarder: Optional[LogForwarder] = log_forwarder
 
     def as_dict(self):
         return {
@@ -40,8 +85,36 @@ class ProcessSlot(StateMixin):
             "state_hsince": self.humanized_time_since_latest_state_change(),
             "slot_number": self.slot_number,
             "pid": self.pid,
+            "restarts": self.restarts,
+            "cpus": self.cpus,
+            "adopted": self.managed_process is not None
+            and self.managed_process.adopted,
+            "cgroup": self.cgroup.stats() if self._own_cgroup() else None,
+            "stop_step": (
+                self.managed_process.stop_step_as_dict()
+                if self.managed_process is not None
+                else None
+            ),
         }
 
+    def set_state(self, new_state: enum.Enum) -> None:
+        changed = new_state != self.state
+        StateMixin.set_state(self, new_state)
+        if changed and self.status_table is not None:
+            if new_state == ProcessSlotState.SHUTDOWN:
+                self.status_table.remove(self.name_prefix, self.slot_number)
+            else:
+                self.status_table.update(
+                    self.name_prefix,
+                    self.slot_number,
+                    new_state,
+                    self.pid,
+                    self.restarts,
+                )
+
+    def _own_cgroup(self) -> bool:
+        return self.cgroup is not None and self.cmd.cgroup == CgroupMode.SLOT
+
     @property
     def cmd_line(self) -> Optional[str]:
         if self.managed_process is None:
@@ -79,12 +152,15 @@ class ProcessSlot(StateMixin):
         return self.state == ProcessSlotState.SHUTDOWN
 
     async def _manage(self):
+        # this task is created inside the "slot.create" span
+        detach_span()
         while self.state != ProcessSlotState.SHUTDOWN:
             if self.state != ProcessSlotState.RUNNING:
                 await self.wait_for_state_change(timeout=1.0)
                 continue
             await self.managed_process.wait()
             self.managed_process = None
+            self._record()
             if self.state == ProcessSlotState.RUNNING:
                 # self-stop
                 if self.cmd.autorespawn:
@@ -92,14 +168,23 @@ class ProcessSlot(StateMixin):
                     self._waiting_for_restart_task = asyncio.create_task(
                         self._waiting_for_restart()
                     )
-                    await self._waiting_for_restart_task
+                    admitted = await self._waiting_for_restart_task
                     self._waiting_for_restart_task = None
+                    if not admitted:
+                        # (manager shutdown)
+                        continue
+                    if self.state == ProcessSlotState.WAITING_FOR_RESTART:
+                        self.restarts += 1
                     await self._autorestart()
                 else:
                     self.set_state(ProcessSlotState.STOPPED)
 
-    async def _waiting_for_restart(self):
+    async def _waiting_for_restart(self) -> bool:
         await asyncio.sleep(self.cmd.waiting_for_restart_delay)
+        # (a stop cancels this task, so a waiting respawn leaves the queue)
+        return await self.spawn_scheduler.acquire(
+            self.name_prefix, self.cmd.spawn_priority
+        )
 
     @AsyncMutuallyExclusive()
     @OnlyStates([ProcessSlotState.STOPPED, ProcessSlotState.WAITING_FOR_RESTART])
@@ -114,47 +199,104 @@ class ProcessSlot(StateMixin):
     @AsyncMutuallyExclusive(wait=False)
     @OnlyStates([ProcessSlotState.WAITING_FOR_RESTART])
     async def _autorestart(self):
-        return await self._start()
+        return await self._start(admitted=True)
+
+    async def _start(self, admitted: bool = False):
+        with span("slot.start", self.name_prefix, slot=self.slot_number):
+            self.logger.info("Process slot is starting")
+            self.set_state(ProcessSlotState.STARTING)
+            if not admitted:
+                with span("slot.spawn_wait"):
+                    admitted = await self.spawn_scheduler.acquire(
+                        self.name_prefix, self.cmd.spawn_priority
+                    )
+                if not admitted:
+                    self.logger.info("Process slot start abandoned (shutdown)")
+                    self.set_state(ProcessSlotState.STOPPED)
+                    return
+            self.managed_process = ManagedProcess(
+                self.name, self.cmd, self.cgroup, self.stop_stats, self.cpus
+            )
+            await self.managed_process.start()
+            self._forward_output()
+            with span("slot.journal"):
+                self._record()
+            self.set_state(ProcessSlotState.RUNNING)
+            self.logger.info("Process slot started")
 
-    async def _start(self):
-        self.logger.info("Process slot is starting")
+    @AsyncMutuallyExclusive()
+    @OnlyStates([ProcessSlotState.STOPPED])
+    async def adopt(self, pid: int, cmd_line: Optional[str] = None):
+        """Adopt an already running process (after a daemon restart)."""
+        self.logger.info("Process slot is adopting an already running process")
         self.set_state(ProcessSlotState.STARTING)
-        self.managed_process = ManagedProcess(self.name, self.cmd)
-        await self.managed_process.start()
+        self.managed_process = ManagedProcess(
+            self.name, self.cmd, self.cgroup, self.stop_stats, self.cpus
+        )
+        await self.managed_process.adopt(pid, cmd_line)
+        self._apply_cpus()
         self.set_state(ProcessSlotState.RUNNING)
-        self.logger.info("Process slot started")
+        self.logger.info("Process slot adopted an already running process")
+
+    def _forward_output(self):
+        process = self.managed_process
+        if self.log_forwarder is None or process is None or process.stdout is None:
+            return
+        self.log_forwarder.follow(
+            process.stdout,
+            {"service": self.name_prefix, "slot": self.slot_number, "pid": process.pid},
+        )
+
+    def set_cpus(self, cpus: List[int]):
+        """Change the CPU set of the slot (applied to the running process)."""
+        if cpus == self.cpus:
+            return
+        self.cpus = list(cpus)
+        self._apply_cpus()
+
+    def _apply_cpus(self):
+        pid = self.pid
+        if pid is None or len(self.cpus) == 0:
+            return
+        try:
+            set_process_affinity(pid, self.cpus)
+        except OSError:
+            self.logger.warning("can't set the CPU affinity of the process")
+
+    def _record(self):
+        if self.journal is not None:
+            self.journal.record_slot(self.name_prefix, self.slot_number, self.pid)
 
     @AsyncMutuallyExclusive()
-    @OnlyStates(
-        [
-            ProcessSlotState.STOPPED,
-            ProcessSlotState.RUNNING,
-            ProcessSlotState.WAITING_FOR_RESTART,
-        ]
-    )
+    @OnlyStates(SHUTDOWNABLE_STATES)
     async def shutdown(self):
-        await self._stop()
-        self.set_state(ProcessSlotState.SHUTDOWN)
-        await self.wait()
-        self.logger.info("Process slot is shutdown")
+        with span("slot.shutdown", self.name_prefix, slot=self.slot_number):
+            await _stop_slots([self], shutdown=True)
 
     @AsyncMutuallyExclusive()
-    @OnlyStates([ProcessSlotState.RUNNING, ProcessSlotState.WAITING_FOR_RESTART])
+    @OnlyStates(STOPPABLE_STATES)
     async def stop(self):
-        return await self._stop()
+        with span("slot.stop", self.name_prefix, slot=self.slot_number):
+            await _stop_slots([self], shutdown=False)
 
-    async def _stop(self):
+    def _begin_stop(self) -> Optional[ManagedProcess]:
         if self.state == ProcessSlotState.WAITING_FOR_RESTART:
             if self._waiting_for_restart_task is not None:
                 self._waiting_for_restart_task.cancel()
             self.set_state(ProcessSlotState.STOPPED)
-            return
+            return None
+        if self.state != ProcessSlotState.RUNNING:
+            return None
         self.logger.info("Stopping process slot")
         self.set_state(ProcessSlotState.STOPPING)
-        if self.managed_process is not None:
-            await self.managed_process.stop()
-        self.set_state(ProcessSlotState.STOPPED)
-        self.logger.info("Process slot stopped")
+        return self.managed_process
+
+    def _end_stop(self, shutdown: bool):
+        if self.state == ProcessSlotState.STOPPING:
+            self.set_state(ProcessSlotState.STOPPED)
+            self.logger.info("Process slot stopped")
+        if shutdown:
+            self.set_state(ProcessSlotState.SHUTDOWN)
 
     async def wait(self):
         await self._manage_task
@@ -163,3 +305,82 @@ class ProcessSlot(StateMixin):
     def kill(self, signal: int):
         if self.managed_process is not None:
             return self.managed_process.kill(signal)
+
+
+async def _stop_slots(slots: List[ProcessSlot], shutdown: bool):
+    processes: List[ManagedProcess] = []
+    for slot in slots:
+        process = slot._begin_stop()
+        if process is not None:
+            processes.append(process)
+    await stop_processes(processes)
+    for slot in slots:
+        slot._end_stop(shutdown)
+    if shutdown:
+        await asyncio.wait([x._manage_task for x in slots])
+        for slot in slots:
+            if slot._own_cgroup():
+                cast(Cgroup, slot.cgroup).remove()
+            slot.logger.info("Process slot is shutdown")
+
+
+async def stop_slots(slots: List[ProcessSlot], shutdown: bool = False):
+    """Stop (or shutdown) several slots at once.
+
+    All processes are stopped together with a single shared deadline (see
+    stop_processes()). Slots which are not in a valid state are ignored.
+
+    """
+    valid_states = SHUTDOWNABLE_STATES if shutdown else STOPPABLE_STATES
+    if len(slots) == 0:
+        return
+    name = "slots.shutdown" if shutdown else "slots.stop"
+    async with AsyncExitStack() as stack:
+        with span(name, slots[0].name_prefix, slots=len(slots)):
+            with span("lock_wait", function="stop_slots"):
+                for slot in slots:
+                    lock = AsyncMutuallyExclusive.get_lock(slot)
+                    await stack.enter_async_context(lock)
+            slots = [x for x in slots if x.state in valid_states]
+            if len(slots) > 0:
+                await _stop_slots(slots, shutdown)
+
+
+async def select_victims(
+    slots: List[ProcessSlot], count: int, policy: ScaleDownPolicy
+) -> List[ProcessSlot]:
+    """Select slots to remove when scaling down.
+
+    Slots without a running process are always selected first, then running
+    ones are ordered by the policy (see ScaleDownPolicy).
+
+    """
+    idle = [x for x in slots if x.pid is None]
+    running = [x for x in slots if x.pid is not None]
+    keys: Dict[int, float] = {}
+    if policy in (ScaleDownPolicy.YOUNGEST, ScaleDownPolicy.OLDEST):
+        for slot in running:
+            start_time = get_process_start_time(cast(int, slot.pid))
+            keys[slot.slot_number] = start_time if start_time is not None else 0
+        if policy == ScaleDownPolicy.YOUNGEST:
+            keys = {x: -y for x, y in keys.items()}
+    elif policy == ScaleDownPolicy.LEAST_CPU:
+        before = {
+            x.slot_number: get_process_cpu_time(cast(int, x.pid)) for x in running
+        }
+        await asyncio.sleep(CPU_SAMPLE_DURATION)
+        for slot in running:
+            after = get_process_cpu_time(cast(int, slot.pid)) if slot.pid else None
+            first = before[slot.slot_number]
+            keys[slot.slot_number] = (
+                after - first if after is not None and first is not None else 0
+            )
+    elif policy == ScaleDownPolicy.MOST_RSS:
+        for slot in running:
+            rss = get_process_rss(cast(int, slot.pid))
+            keys[slot.slot_number] = -rss if rss is not None else 0
+    else:
+        keys = {x.slot_number: -x.slot_number for x in running}
+    idle.sort(key=lambda x: -x.slot_number)
+    running.sort(key=lambda x: (keys[x.slot_number], -x.slot_number))
+    return (idle + running)[0:count]
@@ -0,0 +1,117 @@
+"""Per process settings (rlimits, nice, ionice, oom_score_adj, CPU affinity).
+
+Settings are applied from the parent right after the spawn instead of with a
+preexec_fn: a preexec_fn forces the slow fork path of subprocess (no
+vfork/posix_spawn) and running python code between fork and exec is not safe in
+a multi-threaded daemon (supervision thread).
+
+The (tiny) drawback is that the first instructions of the new program run with
+inherited settings.
+
+Cgroup membership is the exception: processes of cgroup enabled services join
+their cgroup with a preexec_fn (see Cgroup.join_function()), so nothing they fork
+can escape it. These services take the fork path, even in a threaded daemon, and
+their preexec_fn only does raw os calls on pre-encoded arguments.
+"""
+
+from typing import List, Optional
+import ctypes
+import os
+import platform
+import resource
+
+# ioprio_set() syscall numbers (no wrapper in the libc nor in the stdlib)
+IOPRIO_SET_SYSCALLS = {
+    "x86_64": 251,
+    "i386": 289,
+    "i686": 289,
+    "aarch64": 30,
+    "armv7l": 314,
+    "ppc64le": 273,
+    "s390x": 282,
+}
+IOPRIO_CLASSES = {"realtime": 1, "best-effort": 2, "idle": 3}
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_CLASS_SHIFT = 13
+
+_LIBC: Optional[ctypes.CDLL] = None
+
+
+def _libc() -> ctypes.CDLL:
+    global _LIBC
+    if _LIBC is None:
+        _LIBC = ctypes.CDLL(None, use_errno=True)
+    return _LIBC
+
+
+def set_ionice(pid: int, klass: str, level: int = 4):
+    """Set the io scheduling class (and level) of a process.
+
+    Raises:
+        OSError: if the syscall fails (or is not available).
+    """
+    number = IOPRIO_SET_SYSCALLS.get(platform.machine())
+    if number is None:
+        raise OSError(f"ioprio_set is not supported on {platform.machine()}")
+    ioprio = (IOPRIO_CLASSES[klass] << IOPRIO_CLASS_SHIFT) | level
+    if _libc().syscall(number, IOPRIO_WHO_PROCESS, pid, ioprio) != 0:
+        errno = ctypes.get_errno()
+        raise OSError(errno, os.strerror(errno))
+
+
+def set_oom_score_adj(pid: int, value: int):
+    with open(f"/proc/{pid}/oom_score_adj", "w") as f:
+        f.write(str(value))
+
+
+def tune_process(
+    pid: int,
+    rlimit_nofile: int = 0,
+    nice: int = 0,
+    ionice_class: str = "",
+    ionice_level: int = 4,
+    oom_score_adj: Optional[int] = None,
+    cpu_affinity: List[int] = [],
+) -> List[str]:
+    """Apply settings to a (just spawned) process.
+
+    Args:
+        pid: pid of the process.
+        rlimit_nofile: RLIMIT_NOFILE (soft and hard) value (0 => unchanged).
+        nice: niceness (0 => unchanged).
+        ionice_class: io scheduling class (realtime, best-effort, idle or empty
+            => unchanged).
+        ionice_level: io scheduling level (0-7) for realtime and best-effort.
+        oom_score_adj: oom_score_adj value (None => unchanged).
+        cpu_affinity: list of allowed CPUs (empty => unchanged).
+
+    Returns:
+        Error messages of settings which can't be applied (others are applied).
+    """
+    errors: List[str] = []
+    if rlimit_nofile > 0:
+        try:
+            resource.prlimit(pid, resource.RLIMIT_NOFILE, (rlimit_nofile,) * 2)
+        except (OSError, ValueError) as e:
+            errors.append(f"can't set RLIMIT_NOFILE: {e}")
+    if nice != 0:
+        try:
+            os.setpriority(os.PRIO_PROCESS, pid, nice)
+        except OSError as e:
+            errors.append(f"can't set nice: {e}")
+    if ionice_class:
+        try:
+            set_ionice(pid, ionice_class, ionice_level)
+        except (OSError, KeyError) as e:
+            errors.append(f"can't set ionice: {e}")
+    if oom_score_adj is not None:
+        try:
+            set_oom_score_adj(pid, oom_score_adj)
+        except OSError as e:
+            errors.append(f"can't set oom_score_adj: {e}")
+    if len(cpu_affinity) > 0:
+        try:
+            os.sched_setaffinity(pid, cpu_affinity)
+        except OSError as e:
+            errors.append(f"can't set CPU affinity: {e}")
+    return errors
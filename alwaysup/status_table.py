@@ -0,0 +1,279 @@
+"""Memory-mapped status table (one fixed size record per slot).
+
+The daemon updates records in place (on each slot state change and periodically
+for RSS), local readers (monitoring agents, health checkers...) can poll the file
+at any frequency without any request to the daemon.
+
+Layout (little endian):
+
+- header: magic (8 bytes), layout version (u32), capacity (u32), record size
+  (u32), writer pid (u32), padding up to HEADER_SIZE
+- capacity records: seq (u64), used (u8), state (u8), padding (2 bytes),
+  slot_number (u32), pid (i32, 0 => no process), restarts (u32), since (f64,
+  epoch of the latest state change), rss (u64, bytes), service name (utf-8,
+  NUL padded)
+
+Each record is protected by a seqlock: the (single) writer makes seq odd, writes
+the record and makes seq even again. A reader retries while seq is odd or has
+changed during its read, so it never returns a torn record (without any lock
+between the daemon and readers).
+"""
+
+from typing import Dict, List, Optional, Tuple
+import asyncio
+import enum
+import mmap
+import os
+import struct
+import time
+from dataclasses import dataclass
+import mflog
+from alwaysup.utils import get_process_rss
+
+MAGIC = b"AUPSTAT1"
+LAYOUT_VERSION = 1
+HEADER = struct.Struct("<8sIIII")
+HEADER_SIZE = 64
+SEQ = struct.Struct("<Q")
+RECORD = struct.Struct("<QBBxxIiIdQ64s")
+NAME_MAX_LENGTH = 64
+DEFAULT_CAPACITY = 4096
+DEFAULT_RSS_REFRESH_INTERVAL = 5.0
+READ_RETRIES = 100
+
+# ProcessSlotState values => names (alwaysup.slot is far too heavy to import in
+# readers)
+STATE_NAMES: Dict[int, str] = {
+    1: "STOPPED",
+    2: "RUNNING",
+    3: "STOPPING",
+    4: "STARTING",
+    5: "SHUTDOWN",
+    6: "WAITING_FOR_RESTART",
+}
+
+
+@dataclass
+class SlotStatus:
+    """Status of a slot (as read in a status table).
+
+    Attributes:
+        service: name of the service.
+        slot_number: the slot number.
+        state: name of the slot state (see ProcessSlotState).
+        pid: pid of the process (or None).
+        since: epoch of the latest state change.
+        restarts: number of automatic restarts of the slot.
+        rss: resident set size (in bytes) of the process (0 if unknown).
+    """
+
+    service: str
+    slot_number: int
+    state: str
+    pid: Optional[int]
+    since: float
+    restarts: int
+    rss: int
+
+
+class StatusTable:
+    """Writer side of a status table (single writer: the daemon).
+
+    Attributes:
+        path: full path of the status table file.
+        capacity: maximum number of records (slots).
+        rss_refresh_interval: interval (in seconds) between two RSS refreshes
+            of running slots.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        capacity: int = DEFAULT_CAPACITY,
+        rss_refresh_interval: float = DEFAULT_RSS_REFRESH_INTERVAL,
+    ):
+        self.path: str = path
+        self.capacity: int = capacity
+        self.rss_refresh_interval: float = rss_refresh_interval
+        self.logger = mflog.get_logger("alwaysup.status_table").bind(path=path)
+        self._mmap: Optional[mmap.mmap] = None
+        # (service, slot_number) => record index
+        self._indexes: Dict[Tuple[str, int], int] = {}
+        self._free: List[int] = []
+        # index => record values (without seq) of used records, for RSS refreshes
+        self._records: Dict[int, Tuple] = {}
+        self._refresh_task: Optional[asyncio.Task] = None
+        self._full_warned: bool = False
+
+    def open(self):
+        """Create (or recreate) the file and map it."""
+        size = HEADER_SIZE + self.capacity * RECORD.size
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.truncate(size)
+            f.write(
+                HEADER.pack(
+                    MAGIC, LAYOUT_VERSION, self.capacity, RECORD.size, os.getpid()
+                )
+            )
+        # (readers never see a partially initialized file)
+        os.rename(tmp_path, self.path)
+        with open(self.path, "r+b") as f:
+            self._mmap = mmap.mmap(f.fileno(), size)
+        self._indexes = {}
+        self._free = list(range(self.capacity - 1, -1, -1))
+        self._records = {}
+        self.logger.info(f"status table opened with {self.capacity} records")
+
+    def start(self):
+        """Start the background RSS refresh (must be called in a running loop)."""
+        self._refresh_task = asyncio.create_task(self._refresh_loop())
+
+    async def close(self):
+        """Stop the RSS refresh, unmap and remove the file."""
+        if self._refresh_task is not None:
+            self._refresh_task.cancel()
+            await asyncio.wait([self._refresh_task])
+            self._refresh_task = None
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+
+    async def _refresh_loop(self):
+        while True:
+            await asyncio.sleep(self.rss_refresh_interval)
+            try:
+                self.refresh_rss()
+            except Exception:
+                self.logger.exception("can't refresh RSS")
+
+    def refresh_rss(self):
+        """Update the RSS of all records with a process."""
+        for index, values in list(self._records.items()):
+            pid = values[3]
+            if pid > 0:
+                rss = get_process_rss(pid) or 0
+                if rss != values[6]:
+                    self._write(index, values[:6] + (rss,) + values[7:])
+
+    def update(
+        self,
+        service: str,
+        slot_number: int,
+        state: enum.Enum,
+        pid: Optional[int],
+        restarts: int,
+    ):
+        """Update (or allocate) the record of a slot."""
+        if self._mmap is None:
+            return
+        key = (service, slot_number)
+        index = self._indexes.get(key)
+        if index is None:
+            if len(self._free) == 0:
+                if not self._full_warned:
+                    self.logger.warning("status table is full, some slots are missing")
+                    self._full_warned = True
+                return
+            index = self._free.pop()
+            self._indexes[key] = index
+        rss = (get_process_rss(pid) or 0) if pid else 0
+        name = service.encode()[0:NAME_MAX_LENGTH]
+        values = (1, state.value, slot_number, pid or 0, restarts, time.time(), rss)
+        self._write(index, values + (name,))
+
+    def remove(self, service: str, slot_number: int):
+        """Free the record of a slot."""
+        index = self._indexes.pop((service, slot_number), None)
+        if index is None or self._mmap is None:
+            return
+        self._write(index, (0, 0, 0, 0, 0, 0.0, 0, b""))
+        self._records.pop(index, None)
+        self._free.append(index)
+
+    def _write(self, index: int, values: Tuple):
+        assert self._mmap is not None
+        offset = HEADER_SIZE + index * RECORD.size
+        (seq,) = SEQ.unpack_from(self._mmap, offset)
+        SEQ.pack_into(self._mmap, offset, seq + 1)
+        RECORD.pack_into(self._mmap, offset, seq + 1, *values)
+        SEQ.pack_into(self._mmap, offset, seq + 2)
+        if values[0]:
+            self._records[index] = values
+
+
+class StatusTableReader:
+    """Reader side of a status table (any number of readers).
+
+    Attributes:
+        path: full path of the status table file.
+        capacity: number of records.
+        writer_pid: pid of the daemon which writes the table.
+    """
+
+    def __init__(self, path: str):
+        self.path: str = path
+        with open(path, "rb") as f:
+            header = f.read(HEADER_SIZE)
+            magic, version, capacity, record_size, writer_pid = HEADER.unpack_from(
+                header
+            )
+            if magic != MAGIC or version != LAYOUT_VERSION:
+                raise Exception(f"{path} is not a supported status table")
+            if record_size != RECORD.size:
+                raise Exception(f"bad record size in {path}")
+            self.capacity: int = capacity
+            self.writer_pid: int = writer_pid
+            self._mmap = mmap.mmap(
+                f.fileno(), HEADER_SIZE + capacity * RECORD.size, prot=mmap.PROT_READ
+            )
+
+    def close(self):
+        self._mmap.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def read(self) -> List[SlotStatus]:
+        """Return a consistent status of each used record."""
+        res: List[SlotStatus] = []
+        for index in range(0, self.capacity):
+            record = self._read_record(index)
+            if record is not None:
+                res.append(record)
+        return res
+
+    def _read_record(self, index: int) -> Optional[SlotStatus]:
+        offset = HEADER_SIZE + index * RECORD.size
+        for _ in range(0, READ_RETRIES):
+            values = RECORD.unpack_from(self._mmap, offset)
+            (seq_after,) = SEQ.unpack_from(self._mmap, offset)
+            if values[0] % 2 == 0 and values[0] == seq_after:
+                break
+        else:
+            raise Exception(f"can't get a consistent read of record {index}")
+        _, used, state, slot_number, pid, restarts, since, rss, name = values
+        if not used:
+            return None
+        return SlotStatus(
+            service=name.rstrip(b"\0").decode(errors="replace"),
+            slot_number=slot_number,
+            state=STATE_NAMES.get(state, str(state)),
+            pid=pid if pid > 0 else None,
+            since=since,
+            restarts=restarts,
+            rss=rss,
+        )
+
+
+def read_status_table(path: str) -> List[SlotStatus]:
+    """Read a status table file (see StatusTableReader)."""
+    with StatusTableReader(path) as reader:
+        return reader.read()
@@ -0,0 +1,121 @@
+"""Supervision core running in a dedicated thread (with its own event loop).
+
+So a burst of API/UI traffic (or a huge template rendering) on the API event loop
+doesn't delay process reaping and respawning.
+
+The API side talks to the supervision side with:
+
+- commands: coroutines scheduled (thread-safe) on the supervision loop
+- reads: a snapshot of the manager (as a dict) published periodically (and after
+  each command) by the supervision loop
+
+Both threads share the GIL: a long CPU bound rendering on the API side is
+preempted every switch interval (instead of blocking the supervision loop until
+its end), so we lower the interpreter switch interval.
+"""
+
+from typing import Any, Awaitable, Callable, Dict, Optional
+import asyncio
+import sys
+import threading
+from alwaysup.manager import Manager
+from alwaysup.utils import log_exceptions
+
+
+class Supervisor:
+    """Run a supervision coroutine in a dedicated thread.
+
+    Attributes:
+        manager: the manager (only to be used from the supervision thread).
+        main: coroutine function to run in the supervision thread (it must return
+            when the manager is shutdown).
+        snapshot_interval: interval (in seconds) between two published snapshots.
+        switch_interval: interpreter thread switch interval to set (in seconds,
+            None => no change), see sys.setswitchinterval().
+        snapshot: latest published snapshot (manager as a dict).
+        loop: event loop of the supervision thread (None before start).
+    """
+
+    def __init__(
+        self,
+        manager: Manager,
+        main: Callable[[], Awaitable[Any]],
+        snapshot_interval: float = 0.5,
+        switch_interval: Optional[float] = 0.001,
+    ):
+        self.manager: Manager = manager
+        self.main = main
+        self.snapshot_interval: float = snapshot_interval
+        self.switch_interval: Optional[float] = switch_interval
+        self.snapshot: Dict[str, Any] = {}
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread: Optional[threading.Thread] = None
+        self._started = threading.Event()
+
+    def start(self):
+        """Start the supervision thread (and wait for its loop to be ready)."""
+        if self.switch_interval is not None:
+            sys.setswitchinterval(self.switch_interval)
+        self._thread = threading.Thread(
+            target=self._run, name="alwaysup-supervisor", daemon=True
+        )
+        self._thread.start()
+        self._started.wait()
+
+    def _run(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_until_complete(self._main())
+        finally:
+            self.loop.close()
+
+    async def _main(self):
+        self.publish()
+        publisher = asyncio.create_task(log_exceptions(self._publish_forever()))
+        self._started.set()
+        try:
+            await log_exceptions(self.main())
+        finally:
+            publisher.cancel()
+            await asyncio.wait([publisher])
+            self.publish()
+
+    async def _publish_forever(self):
+        while True:
+            await asyncio.sleep(self.snapshot_interval)
+            self.publish()
+
+    def publish(self):
+        """Publish a new snapshot (must be called from the supervision thread)."""
+        # (replacing the reference is atomic, readers never see a partial dict)
+        self.snapshot = self.manager.as_dict()
+
+    def is_alive(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def in_supervisor_thread(self) -> bool:
+        return self._thread is not None and threading.current_thread() is self._thread
+
+    async def call(self, coro: Awaitable[Any]) -> Any:
+        """Run a coroutine on the supervision loop and wait for its result.
+
+        A new snapshot is published after the coroutine execution (so a read
+        after a command sees its effects).
+        """
+        if self.in_supervisor_thread():
+            return await coro
+
+        async def _wrapper():
+            try:
+                return await coro
+            finally:
+                self.publish()
+
+        assert self.loop is not None
+        future = asyncio.run_coroutine_threadsafe(_wrapper(), self.loop)
+        return await asyncio.wrap_future(future)
+
+    def join(self, timeout: Optional[float] = None):
+        if self._thread is not None:
+            self._thread.join(timeout)
@@ -0,0 +1,170 @@
+"""Lightweight lifecycle tracing (spans with per-phase timings).
+
+Spans are nested with a context variable (so each asyncio task follows its own
+span tree), they can be exported as json lines and their durations are kept (in
+bounded buffers) to compute per-service latency percentiles.
+
+Usage:
+
+    with span("process.spawn", service="foo"):
+        ...
+"""
+
+from typing import Any, Deque, Dict, IO, Iterator, List, Optional, Tuple
+import collections
+import contextvars
+import json
+import time
+from contextlib import contextmanager
+from mfutil import get_unique_hexa_identifier
+
+# number of kept durations (for percentiles) per (service, span name)
+DURATIONS_MAXLEN = 1000
+
+_CURRENT_SPAN: "contextvars.ContextVar[Optional[Span]]" = contextvars.ContextVar(
+    "alwaysup_current_span", default=None
+)
+
+
+class Span:
+    """Timed phase of an operation.
+
+    Attributes:
+        name: name of the phase (process.spawn...).
+        service: name of the service (inherited from the parent span if not set).
+        attributes: extra attributes.
+        span_id: unique id of the span.
+        trace_id: id of the root span.
+        parent_id: id of the parent span (or None for a root span).
+        start: start time (epoch).
+        duration: duration in seconds (None if the span is not finished).
+    """
+
+    def __init__(
+        self,
+        name: str,
+        service: Optional[str] = None,
+        parent: Optional["Span"] = None,
+        attributes: Dict[str, Any] = {},
+    ):
+        self.name: str = name
+        self.span_id: str = get_unique_hexa_identifier()[0:16]
+        self.parent_id: Optional[str] = None
+        self.trace_id: str = self.span_id
+        self.service: Optional[str] = service
+        if parent is not None:
+            self.parent_id = parent.span_id
+            self.trace_id = parent.trace_id
+            if self.service is None:
+                self.service = parent.service
+        self.attributes: Dict[str, Any] = dict(attributes)
+        self.start: float = time.time()
+        self._start: float = time.perf_counter()
+        self.duration: Optional[float] = None
+
+    def finish(self):
+        self.duration = time.perf_counter() - self._start
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            "name": self.name,
+            "service": self.service,
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "start": self.start,
+            "duration": self.duration,
+            "attributes": self.attributes,
+        }
+
+
+def _percentile(values: List[float], p: float) -> float:
+    # nearest-rank on a sorted list
+    index = max(int(round(p / 100.0 * len(values))) - 1, 0)
+    return values[min(index, len(values) - 1)]
+
+
+class Tracer:
+    """Span collector.
+
+    Attributes:
+        export_path: json lines file to export finished spans to (or None).
+        durations: (service, span name) => latest durations.
+    """
+
+    def __init__(self):
+        self.export_path: Optional[str] = None
+        self.durations: Dict[Tuple[str, str], Deque[float]] = {}
+        self._file: Optional[IO[str]] = None
+
+    def set_export_path(self, path: Optional[str]):
+        """Export finished spans to a json lines file (None => no export)."""
+        self.close()
+        self.export_path = path
+        if path is not None:
+            self._file = open(path, "a")
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    @contextmanager
+    def span(
+        self, name: str, service: Optional[str] = None, **attributes
+    ) -> Iterator[Span]:
+        s = Span(name, service, _CURRENT_SPAN.get(), attributes)
+        token = _CURRENT_SPAN.set(s)
+        try:
+            yield s
+        finally:
+            _CURRENT_SPAN.reset(token)
+            s.finish()
+            self.record(s)
+
+    def record(self, s: Span):
+        key = (s.service or "", s.name)
+        if key not in self.durations:
+            self.durations[key] = collections.deque(maxlen=DURATIONS_MAXLEN)
+        self.durations[key].append(s.duration or 0.0)
+        if self._file is not None:
+            self._file.write(json.dumps(s.as_dict(), default=str) + "\n")
+            self._file.flush()
+
+    def percentiles(self, service: str) -> Dict[str, Dict[str, float]]:
+        """Return latency percentiles (in seconds) by span name for a service."""
+        res: Dict[str, Dict[str, float]] = {}
+        for (s, name), durations in self.durations.items():
+            if s != service or len(durations) == 0:
+                continue
+            values = sorted(durations)
+            res[name] = {
+                "count": len(values),
+                "p50": _percentile(values, 50),
+                "p90": _percentile(values, 90),
+                "p99": _percentile(values, 99),
+                "max": values[-1],
+            }
+        return res
+
+    def forget(self, service: str):
+        """Forget durations of a service (when it's removed)."""
+        for key in [x for x in self.durations if x[0] == service]:
+            del self.durations[key]
+
+
+TRACER = Tracer()
+
+
+def span(name: str, service: Optional[str] = None, **attributes):
+    """Trace a phase with the global tracer (context manager)."""
+    return TRACER.span(name, service, **attributes)
+
+
+def current_span() -> Optional[Span]:
+    return _CURRENT_SPAN.get()
+
+
+def detach_span():
+    """Forget the current span (for long lived tasks created inside a span)."""
+    _CURRENT_SPAN.set(None)
@@ -1,9 +1,13 @@
 """Utility functions, classes."""
 
-from typing import Awaitable, Any
+from typing import Awaitable, Any, Optional, List, Dict, Set, Iterable
 import mflog
 import asyncio
+import os
 from functools import wraps
+from alwaysup.tracing import span, current_span
+
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
 
 
 async def log_exceptions(awaitable: Awaitable[Any]):
@@ -19,6 +23,9 @@ async def log_exceptions(awaitable: Awaitable[Any]):
 class AsyncMutuallyExclusive:
     """Decorator for coroutines to manage a mutually exclusive lock on the instance.
 
+    Inside a traced operation, the time spent waiting for the lock is traced as a
+    "lock_wait" span.
+
     Attributes:
         wait: If True, we will wait for the lock. If False, the call will be silently
             ignored (if we don't get the lock of course).
@@ -27,17 +34,103 @@ class AsyncMutuallyExclusive:
     def __init__(self, wait: bool = True):
         self.wait: bool = wait
 
+    @staticmethod
+    def get_lock(obj) -> asyncio.Lock:
+        """Return the lock used for the given instance."""
+        try:
+            lock = getattr(obj, "__aiomutuallyexclusivelock")
+        except AttributeError:
+            lock = asyncio.Lock()
+            setattr(obj, "__aiomutuallyexclusivelock", lock)
+        return lock
+
     def __call__(self, f):
         @wraps(f)
         async def wrapper(obj, *args, **kwargs):
-            try:
-                lock = getattr(obj, "__aiomutuallyexclusivelock")
-            except AttributeError:
-                lock = asyncio.Lock()
-                setattr(obj, "__aiomutuallyexclusivelock", lock)
+            lock = AsyncMutuallyExclusive.get_lock(obj)
             if not self.wait and lock.locked():
                 return
-            async with lock:
+            if current_span() is not None and lock.locked():
+                with span("lock_wait", function=f.__qualname__):
+                    await lock.acquire()
+            else:
+                await lock.acquire()
+            try:
                 return await f(obj, *args, **kwargs)
+            finally:
+                lock.release()
 
         return wrapper
+
+
+def _get_process_stat_fields(pid: int) -> List[str]:
+    """Return /proc/{pid}/stat fields after the command name (or [])."""
+    try:
+        with open(f"/proc/{pid}/stat", "r") as f:
+            content = f.read()
+    except OSError:
+        return []
+    # the second field (command name) can contain spaces or parenthesis
+    return content[content.rfind(")") + 2 :].split()
+
+
+def get_process_start_time(pid: int) -> Optional[int]:
+    """Return the start time of a process (in clock ticks after boot).
+
+    None is returned if the process does not exist (or is a zombie).
+
+    """
+    fields = _get_process_stat_fields(pid)
+    if len(fields) < 20 or fields[0] in ("Z", "X"):
+        return None
+    return int(fields[19])
+
+
+def get_process_cpu_time(pid: int) -> Optional[int]:
+    """Return the CPU time (user + system, in clock ticks) of a process (or None)."""
+    fields = _get_process_stat_fields(pid)
+    if len(fields) < 13:
+        return None
+    return int(fields[11]) + int(fields[12])
+
+
+def get_descendant_pids(pids: Iterable[int]) -> Set[int]:
+    """Return pids of all descendants of the given pids (with a single /proc scan)."""
+    children: Dict[int, List[int]] = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        fields = _get_process_stat_fields(int(entry))
+        if len(fields) >= 2:
+            children.setdefault(int(fields[1]), []).append(int(entry))
+    res: Set[int] = set()
+    to_visit = list(pids)
+    while to_visit:
+        for child in children.get(to_visit.pop(), []):
+            if child not in res:
+                res.add(child)
+                to_visit.append(child)
+    return res
+
+
+def get_process_cmd_line(pid: int) -> Optional[str]:
+    """Return the command line of a process (as a single string) or None."""
+    try:
+        with open(f"/proc/{pid}/cmdline", "rb") as f:
+            content = f.read()
+    except OSError:
+        return None
+    return " ".join(x.decode(errors="replace") for x in content.split(b"\0") if x)
+
+
+def get_process_rss(pid: int) -> Optional[int]:
+    """Return the resident set size (in bytes) of a process (or None)."""
+    try:
+        with open(f"/proc/{pid}/statm", "r") as f:
+            content = f.read()
+    except OSError:
+        return None
+    fields = content.split()
+    if len(fields) < 2:
+        return None
+    return int(fields[1]) * PAGE_SIZE
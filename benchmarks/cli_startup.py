@@ -0,0 +1,32 @@
+"""Measure the startup time of the CLI client (vs the server side modules).
+
+Usage: python benchmarks/cli_startup.py [number_of_runs]
+"""
+
+import statistics
+import subprocess
+import sys
+import time
+
+MODULES = ["alwaysup.client", "alwaysup.cli", "alwaysup.daemon"]
+
+
+def measure(module: str, runs: int) -> float:
+    durations = []
+    for _ in range(0, runs):
+        before = time.perf_counter()
+        subprocess.run([sys.executable, "-c", f"import {module}"], check=True)
+        durations.append(time.perf_counter() - before)
+    return statistics.median(durations)
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    baseline = measure("sys", runs)
+    print(f"python interpreter: {baseline * 1000:.0f} ms")
+    for module in MODULES:
+        print(f"import {module}: {measure(module, runs) * 1000:.0f} ms")
+
+
+if __name__ == "__main__":
+    main()
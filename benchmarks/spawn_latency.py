@@ -0,0 +1,75 @@
+"""Spawn latency with per process settings (see alwaysup.spawn).
+
+Compare the latency of asyncio.create_subprocess_exec() (as used by
+ManagedProcess.start()):
+
+- plain: without any setting
+- tune: settings applied from the parent after the spawn (alwaysup.spawn)
+- preexec_fn: same settings applied in the child with a preexec_fn (slow fork
+  path)
+
+Usage: python benchmarks/spawn_latency.py [spawns]
+
+Example (500 spawns, python 3.8, single core):
+
+          plain: p50=2.83ms p99=3.82ms
+           tune: p50=3.10ms p99=4.48ms
+     preexec_fn: p50=4.06ms p99=6.53ms
+"""
+
+import asyncio
+import os
+import resource
+import statistics
+import subprocess
+import sys
+import time
+from alwaysup.spawn import tune_process
+
+SETTINGS = {"rlimit_nofile": 1024, "nice": 1, "oom_score_adj": 100}
+
+
+def _preexec():
+    resource.setrlimit(resource.RLIMIT_NOFILE, (1024, 1024))
+    os.nice(1)
+    with open("/proc/self/oom_score_adj", "w") as f:
+        f.write("100")
+
+
+async def spawn(mode):
+    kwargs = {}
+    if mode == "preexec_fn":
+        kwargs["preexec_fn"] = _preexec
+    before = time.perf_counter()
+    process = await asyncio.create_subprocess_exec(
+        "sleep",
+        "10",
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        start_new_session=True,
+        **kwargs,
+    )
+    if mode == "tune":
+        tune_process(process.pid, **SETTINGS)
+    duration = time.perf_counter() - before
+    process.kill()
+    await process.wait()
+    return duration
+
+
+async def bench(mode, spawns):
+    durations = sorted([await spawn(mode) for _ in range(0, spawns)])
+    p50 = statistics.median(durations) * 1000
+    p99 = durations[int(len(durations) * 0.99) - 1] * 1000
+    print(f"{mode:>15}: p50={p50:.2f}ms p99={p99:.2f}ms")
+
+
+def main():
+    spawns = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    for mode in ("plain", "tune", "preexec_fn"):
+        asyncio.run(bench(mode, spawns))
+
+
+if __name__ == "__main__":
+    main()
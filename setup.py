@@ -23,6 +23,7 @@ setup(
     long_description_content_type="text/markdown",
     packages=find_packages(),
     install_requires=install_requires,
+    extras_require={"uvloop": ["uvloop"]},
     entry_points={
         "console_scripts": [
             "alwaysup = alwaysup.cli:main",
@@ -0,0 +1,48 @@
+import pytest
+import os
+import socket
+from alwaysup.activation import (
+    parse_address,
+    open_listen_socket,
+    close_listen_socket,
+    count_connections,
+    count_files,
+)
+
+
+def test_parse_address():
+    assert parse_address("/tmp/foo.sock") == (socket.AF_UNIX, "/tmp/foo.sock", 0)
+    assert parse_address("127.0.0.1:8080") == (socket.AF_INET, "127.0.0.1", 8080)
+    assert parse_address("[::1]:8080") == (socket.AF_INET6, "::1", 8080)
+    with pytest.raises(ValueError):
+        parse_address("localhost")
+
+
+@pytest.mark.parametrize("address", ["127.0.0.1:0", "unix"])
+def test_count_connections(tmpdir, address):
+    if address == "unix":
+        address = str(tmpdir.join("activation.sock"))
+    sock = open_listen_socket(address)
+    assert count_connections(sock) == 0
+    clients = [socket.socket(sock.family) for _ in range(0, 2)]
+    for client in clients:
+        client.connect(sock.getsockname())
+    # (not accepted yet)
+    assert count_connections(sock) == 2
+    accepted, _ = sock.accept()
+    assert count_connections(sock) == 2
+    accepted.close()
+    clients[0].close()
+    assert count_connections(sock) == 1
+    clients[1].close()
+    close_listen_socket(sock)
+    if sock.family == socket.AF_UNIX:
+        assert not os.path.exists(address)
+
+
+def test_count_files(tmpdir):
+    assert count_files(str(tmpdir)) == 0
+    tmpdir.join("job").write("foo")
+    tmpdir.join(".job.tmp").write("foo")
+    assert count_files(str(tmpdir)) == 1
+    assert count_files(str(tmpdir.join("missing"))) == 0
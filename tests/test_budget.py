@@ -0,0 +1,51 @@
+import pytest
+import asyncio
+from alwaysup.budget import Demand, WorkerBudget, allocate
+from alwaysup.manager import Manager
+from alwaysup.service import Service
+from alwaysup.cmd import Cmd
+
+
+def test_allocate():
+    demands = [
+        Demand("low", 4, priority=0, min_slots=1),
+        Demand("high", 4, priority=10),
+        Demand("heavy", 2, priority=5, weight=2.0),
+    ]
+    assert allocate(0, demands) == {"low": 0, "high": 0, "heavy": 0}
+    assert allocate(5, demands) == {"low": 1, "high": 4, "heavy": 0}
+    assert allocate(8, demands) == {"low": 2, "high": 4, "heavy": 1}
+    assert allocate(20, demands) == {"low": 4, "high": 4, "heavy": 2}
+
+
+async def wait_for_slots(service, n):
+    for _ in range(0, 50):
+        if service.number_of_slots_in_use() == n:
+            return
+        await asyncio.sleep(0.1)
+    raise Exception("timeout")
+
+
+@pytest.mark.asyncio
+async def test_preemption():
+    x = Manager(budget=WorkerBudget(3))
+    low = Service("low", 3, Cmd.make_from_shell_cmd("sleep 10", budget_min_slots=1))
+    high = Service("high", 2, Cmd.make_from_shell_cmd("sleep 10", budget_priority=1))
+    await x.add_service(low)
+    assert low.number_of_slots_running() == 3
+    await x.add_service(high)
+    # (high waits for preempted slots of low)
+    assert high.number_of_slots_running() == 2
+    await wait_for_slots(low, 1)
+    d = x.as_dict()["budget"]
+    assert d["preemptions"] == 2
+    assert d["used"] == 3
+    assert d["services"]["low"]["pending"] == 2
+    # (more than the budget: partially granted)
+    await high.set_slot_number(4)
+    assert high.number_of_slots_running() == 2
+    assert x.budget.as_dict()["services"]["high"]["pending"] == 2
+    # (released capacity goes back to low)
+    await high.stop()
+    await wait_for_slots(low, 3)
+    await x.shutdown()
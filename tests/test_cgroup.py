@@ -0,0 +1,62 @@
+import pytest
+import os
+import subprocess
+from alwaysup.cgroup import Cgroup
+from alwaysup.service import Service
+from alwaysup.cmd import Cmd, CgroupMode
+
+
+def test_cgroup(tmp_path):
+    # a fake cgroup filesystem
+    a = Cgroup(str(tmp_path / "alwaysup" / "foo"))
+    a.create()
+    assert os.path.isdir(a.path)
+    a.set_limits(memory_max="100M")
+    with open(os.path.join(a.path, "memory.max")) as f:
+        assert f.read() == "100M"
+    assert not os.path.exists(os.path.join(a.path, "cpu.max"))
+    with open(os.path.join(a.path, "cpu.stat"), "w") as f:
+        f.write("usage_usec 1234\nuser_usec 1000\n")
+    with open(os.path.join(a.path, "memory.current"), "w") as f:
+        f.write("4096\n")
+    assert a.stats() == {"cpu_usage_usec": 1234, "memory_current": 4096}
+    a.add_process(123)
+    assert a.pids() == [123]
+    # (the child joins the cgroup itself, before exec)
+    subprocess.run(["true"], preexec_fn=a.join_function(), check=True)
+    assert a.pids() == [0]
+
+
+@pytest.mark.asyncio
+async def test_service_cgroup(tmp_path):
+    a = Service(
+        "foo",
+        2,
+        Cmd.make_from_shell_cmd(
+            "sleep 10", cgroup=CgroupMode.SLOT, cgroup_root=str(tmp_path)
+        ),
+    )
+    await a.start()
+    assert a.cgroup is not None
+    for i in range(0, 2):
+        slot_cgroup = a.slots[i].cgroup
+        assert slot_cgroup is not None
+        assert slot_cgroup.pids() == [a.slots[i].pid]
+    await a.shutdown()
+
+
+@pytest.mark.asyncio
+async def test_service_cgroup_kill(tmp_path):
+    a = Service(
+        "foo",
+        1,
+        Cmd.make_from_shell_cmd(
+            "sleep 10", cgroup=CgroupMode.SERVICE, cgroup_root=str(tmp_path)
+        ),
+    )
+    await a.start()
+    assert a.cgroup is not None
+    await a.stop()
+    with open(os.path.join(a.cgroup.path, "cgroup.kill")) as f:
+        assert f.read() == "1"
+    await a.shutdown()
@@ -0,0 +1,51 @@
+import pytest
+import asyncio
+import socket
+import urllib.error
+from alwaysup.manager import Manager
+from alwaysup.commands import execute
+from alwaysup.control import ControlServer, ControlError, default_socket_path
+from alwaysup.client import Client
+
+
+def client_scenario(path):
+    client = Client(socket_path=path, timeout=10)
+    client.request("add_service", name="foo", config={"program": "sleep"})
+    assert client.request("service", name="foo")["name"] == "foo"
+    with pytest.raises(ControlError):
+        client.request("service", name="bar")
+
+
+@pytest.mark.asyncio
+async def test_client(tmp_path):
+    path = str(tmp_path / "alwaysup.sock")
+    manager = Manager()
+
+    async def _execute(command, params):
+        return await execute(manager, command, params)
+
+    server = ControlServer(path, _execute, manager.as_dict)
+    await server.start()
+    loop = asyncio.get_event_loop()
+    await loop.run_in_executor(None, client_scenario, path)
+    await server.stop()
+    await manager.shutdown()
+
+
+def test_default_socket_path():
+    assert Client(port=8001).socket_path == default_socket_path(8001)
+    assert default_socket_path(8001) != default_socket_path(8000)
+    assert Client(host="10.0.0.1", port=8001).socket_path == ""
+
+
+@pytest.mark.parametrize("stale", [False, True])
+def test_client_http_fallback(tmp_path, stale):
+    path = str(tmp_path / "alwaysup.sock")
+    if stale:
+        # (socket file left by a killed daemon)
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        s.bind(path)
+        s.close()
+    client = Client(port=1, socket_path=path, timeout=1)
+    with pytest.raises(urllib.error.URLError):
+        client.request("scale_service", name="foo", workers=2)
@@ -0,0 +1,111 @@
+import pytest
+import os
+import asyncio
+import json
+from alwaysup.manager import Manager
+from alwaysup.commands import execute, CommandError, COMMANDS
+from alwaysup.control import ControlServer, ControlClient, ControlError, async_request
+from alwaysup.daemon import Daemon
+
+
+def client_scenario(path):
+    with ControlClient(path, timeout=10) as client:
+        name = client.request(
+            "add_service",
+            name="foo",
+            workers=2,
+            config={"program": "sleep", "args": ["10"]},
+        )
+        assert name == {"name": "foo"}
+        # pipelining
+        rid1 = client.send("scale_service", name="foo", workers=3)
+        rid2 = client.send("service", name="foo")
+        responses = [client.receive(), client.receive()]
+        assert sorted([x["id"] for x in responses]) == [rid1, rid2]
+        service = client.request("service", name="foo")
+        assert service["number_of_slots_running"] == 3
+        with pytest.raises(ControlError) as e:
+            client.request("service", name="bar")
+        assert e.value.status_code == 404
+        event = next(client.subscribe(interval=0.1))
+        assert "foo" in event["services"]
+
+
+@pytest.mark.asyncio
+async def test_control(tmp_path):
+    path = str(tmp_path / "alwaysup.sock")
+    manager = Manager()
+
+    async def _execute(command, params):
+        return await execute(manager, command, params)
+
+    server = ControlServer(path, _execute, manager.as_dict)
+    await server.start()
+    assert os.stat(path).st_mode & 0o777 == 0o600
+    assert server.is_used()
+    loop = asyncio.get_event_loop()
+    await loop.run_in_executor(None, client_scenario, path)
+    await server.stop()
+    assert not os.path.exists(path)
+    await manager.shutdown()
+
+
+@pytest.mark.asyncio
+async def test_control_bad_requests(tmp_path, mocker):
+    path = str(tmp_path / "alwaysup.sock")
+    snapshot = mocker.Mock(return_value={})
+
+    async def _execute(command, params):
+        return command
+
+    server = ControlServer(path, _execute, snapshot)
+    await server.start()
+    reader, writer = await asyncio.open_unix_connection(path)
+    # (oversized line)
+    writer.write(b"x" * 200000 + b"\n")
+    line = await asyncio.wait_for(reader.readline(), 5)
+    assert json.loads(line)["error"]["status_code"] == 400
+    # (the subscription interval is clamped)
+    writer.write(b'{"id": 1, "command": "subscribe", "params": {"interval": 0}}\n')
+    writer.write(b'{"id": 2, "command": "manager"}\n')
+    while True:
+        response = json.loads(await asyncio.wait_for(reader.readline(), 5))
+        if response.get("id") == 2:
+            break
+    assert response["result"] == "manager"
+    await asyncio.sleep(0.3)
+    assert snapshot.call_count <= 5
+    writer.close()
+    await server.stop()
+
+
+@pytest.mark.asyncio
+async def test_missing_parameter(mocker):
+    manager = Manager()
+    with pytest.raises(CommandError) as e:
+        await execute(manager, "scale_service", {"name": "foo"})
+    assert e.value.status_code == 400
+    assert e.value.detail == "missing parameter: workers"
+    # (a KeyError inside a command is a bug, not a client error)
+    command = mocker.AsyncMock(side_effect=KeyError("bug"))
+    mocker.patch.dict(COMMANDS, {"manager": command})
+    with pytest.raises(KeyError):
+        await execute(manager, "manager", {})
+    await manager.shutdown()
+
+
+@pytest.mark.asyncio
+async def test_daemon_control_loop(tmp_path):
+    path = str(tmp_path / "alwaysup.sock")
+    daemon = Daemon(log_configure_logger=False, socket_path=path)
+    daemon.start_manager_as_a_task()
+    for _ in range(0, 50):
+        if os.path.exists(path):
+            break
+        await asyncio.sleep(0.1)
+    # (the control server runs on the API loop, not on the supervision one)
+    assert daemon.control._server.get_loop() is asyncio.get_running_loop()
+    manager = await async_request(path, "manager")
+    assert manager["state"] == "RUNNING"
+    await daemon.shutdown_manager()
+    assert not os.path.exists(path)
@@ -0,0 +1,95 @@
+import pytest
+import asyncio
+import contextvars
+import sys
+import threading
+import time
+from alwaysup.debug import LoopMonitor, Histogram, tasks_as_dict, profile_loop
+
+
+def test_histogram():
+    h = Histogram([0.1, 1.0])
+    for value in (0.05, 0.5, 0.7, 3.0):
+        h.add(value)
+    d = h.as_dict()
+    assert d["buckets"] == {"0.1": 1, "1.0": 2, "+inf": 1}
+    assert d["count"] == 4
+    assert d["max"] == 3.0
+
+
+async def sleeper():
+    await asyncio.sleep(10)
+
+
+@pytest.mark.asyncio
+async def test_loop_monitor():
+    monitor = LoopMonitor(interval=0.05, slow_callback_threshold=0.1)
+    monitor.start()
+    tasks = [asyncio.create_task(sleeper()) for _ in range(0, 3)]
+    await asyncio.sleep(0.2)
+    time.sleep(0.3)  # blocking the loop
+    await asyncio.sleep(0.2)
+    d = monitor.as_dict()
+    assert d["slow_callbacks"] >= 1
+    assert d["lag"]["max"] >= 0.2
+    groups = {x["coroutine"]: x for x in tasks_as_dict()["coroutines"]}
+    assert groups["sleeper"]["count"] == 3
+    assert groups["sleeper"]["max_age"] >= 0.7
+    for task in tasks:
+        task.cancel()
+    await monitor.stop()
+
+
+def busy_function(duration):
+    before = time.monotonic()
+    while time.monotonic() - before < duration:
+        pass
+
+
+async def busy_coroutine():
+    await asyncio.sleep(0.05)
+    busy_function(0.3)
+
+
+@pytest.mark.asyncio
+async def test_profile_loop():
+    task = asyncio.create_task(busy_coroutine())
+    collapsed = await profile_loop(0.5, interval=0.002)
+    await task
+    lines = collapsed.splitlines()
+    assert len(lines) > 0
+    busy = [x for x in lines if "busy_function" in x]
+    assert len(busy) > 0
+    # root first
+    assert busy[0].split(";")[-1].startswith("busy_function")
+    assert sum(int(x.rsplit(" ", 1)[1]) for x in busy) > 10
+
+
+@pytest.mark.asyncio
+@pytest.mark.skipif(sys.version_info < (3, 11), reason="context since python 3.11")
+async def test_task_factory_context():
+    monitor = LoopMonitor(slow_callback_threshold=0)
+    monitor.start()
+    task = asyncio.create_task(sleeper(), context=contextvars.copy_context())
+    assert tasks_as_dict()["total"] >= 2
+    task.cancel()
+    await monitor.stop()
+
+
+def block_other_loop():
+    async def _main():
+        asyncio.get_running_loop().call_soon(time.sleep, 0.3)
+        await asyncio.sleep(0.4)
+
+    asyncio.run(_main())
+
+
+@pytest.mark.asyncio
+async def test_slow_callbacks_of_other_loops():
+    monitor = LoopMonitor(slow_callback_threshold=0.1)
+    monitor.start()
+    thread = threading.Thread(target=block_other_loop)
+    thread.start()
+    await asyncio.get_running_loop().run_in_executor(None, thread.join)
+    assert monitor.slow_callbacks == 0
+    await monitor.stop()
@@ -0,0 +1,83 @@
+import pytest
+import os
+import json
+import asyncio
+from alwaysup.cmd import Cmd, CmdConfiguration
+from alwaysup.jobs import (
+    JobQueue,
+    JobQueueFull,
+    JobQueueService,
+    JobQueueSettings,
+    JobState,
+)
+
+
+async def wait_for_jobs(jobs, timeout=10.0):
+    for _ in range(0, int(timeout * 10)):
+        if all(x.is_finished() for x in jobs):
+            return
+        await asyncio.sleep(0.1)
+    raise Exception("timeout")
+
+
+@pytest.mark.asyncio
+async def test_queue():
+    queue = JobQueue(JobQueueSettings(max_queue_length=3))
+    low = queue.submit(["true"])
+    high = queue.submit(["true"], priority=10)
+    other = queue.submit(["true"])
+    with pytest.raises(JobQueueFull):
+        queue.submit(["true"])
+    with pytest.raises(ValueError):
+        queue.submit([])
+    assert queue.as_dict()["rejected"] == 1
+    assert queue.as_dict()["full"]
+    assert await queue.get() is high
+    assert await queue.get() is low
+    assert await queue.get() is other
+    assert len(queue) == 0
+
+
+@pytest.mark.asyncio
+async def test_service():
+    cmd = Cmd(CmdConfiguration(program="", waiting_for_restart_delay=0))
+    a = JobQueueService("foo", 2, cmd)
+    await a.start()
+    ok = a.submit(["sh", "-c", "echo foo; echo bar >&2"])
+    ko = a.submit(["sh", "-c", "exit 3"])
+    env = a.submit(["sh", "-c", "echo $FOO"], env={"FOO": "bar"})
+    missing = a.submit(["/not/existing/program"])
+    await wait_for_jobs([ok, ko, env, missing])
+    assert ok.state == JobState.SUCCEEDED
+    assert ok.returncode == 0
+    assert list(ok.output) == ["foo", "bar"]
+    assert ko.state == JobState.FAILED
+    assert ko.returncode == 3
+    assert list(env.output) == ["bar"]
+    assert missing.state == JobState.FAILED
+    assert a.number_of_slots_running() == 2
+    d = a.as_dict()
+    assert d["job_queue"]["jobs_by_state"]["SUCCEEDED"] == 2
+    assert d["job_queue"]["jobs_by_state"]["FAILED"] == 2
+    await a.shutdown()
+    await a.wait()
+
+
+@pytest.mark.asyncio
+async def test_spool(tmpdir):
+    spool_dir = str(tmpdir)
+    with open(os.path.join(spool_dir, "1.json"), "w") as f:
+        f.write(json.dumps({"argv": ["echo", "foo"]}))
+    with open(os.path.join(spool_dir, "2.json"), "w") as f:
+        f.write("not json")
+    cmd = Cmd(CmdConfiguration(program="", waiting_for_restart_delay=0))
+    a = JobQueueService("foo", 1, cmd, JobQueueSettings(spool_dir=spool_dir))
+    await a.start()
+    await asyncio.sleep(0.5)
+    assert sorted(os.listdir(spool_dir)) == ["2.json.invalid"]
+    jobs = list(a.queue.jobs.values())
+    assert len(jobs) == 1
+    await wait_for_jobs(jobs)
+    assert list(jobs[0].output) == ["foo"]
+    await a.shutdown()
+    await a.wait()
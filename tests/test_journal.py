@@ -0,0 +1,95 @@
+import pytest
+import os
+import asyncio
+import subprocess
+from alwaysup.journal import Journal
+from alwaysup.service import Service
+from alwaysup.cmd import Cmd
+from alwaysup.daemon import Daemon
+
+DIR = os.path.dirname(os.path.realpath(__file__))
+
+
+@pytest.mark.asyncio
+async def test_replay(tmp_path):
+    path = str(tmp_path / "journal")
+    j = Journal(path, fsync_interval=0)
+    j.start()
+    j.record_service("foo", 2, {"program": "sleep", "args": ["10"]})
+    j.record_service("bar", 1, {"program": "sleep", "args": ["10"]})
+    j.record_slot("foo", 0, os.getpid())
+    j.record_slot("foo", 1, os.getpid())
+    j.record_slot("foo", 1, None)
+    j.record_service_removed("bar")
+    await j.close()
+    with open(path, "a") as f:
+        f.write('{"t": "slot", "serv')  # partial write during a crash
+    services = Journal(path).open()
+    assert list(services.keys()) == ["foo"]
+    assert services["foo"].slot_number == 2
+    assert list(services["foo"].slots.keys()) == [0]
+    assert services["foo"].slots[0].is_alive()
+    # the journal is compacted
+    with open(path, "r") as f:
+        assert len(f.readlines()) == 2
+    # (without readopt, the journal is reset)
+    assert Journal(path).open(replay=False) == {}
+    assert Journal(path).replay() == {}
+
+
+@pytest.mark.asyncio
+async def test_compaction(tmp_path):
+    path = str(tmp_path / "journal")
+    j = Journal(path, fsync_interval=0, compact_threshold=10)
+    j.open()
+    j.start()
+    j.record_service("foo", 1, {"program": "sleep", "args": ["10"]})
+    for _ in range(0, 50):
+        # (crash looping slot)
+        j.record_slot("foo", 0, None)
+        j.record_slot("foo", 0, os.getpid())
+        await asyncio.sleep(0)
+    await asyncio.sleep(0.1)
+    with open(path, "r") as f:
+        assert len(f.readlines()) < 20
+    await j.close()
+    services = Journal(path).open()
+    assert services["foo"].slots[0].pid == os.getpid()
+
+
+@pytest.mark.asyncio
+async def test_readopt(tmp_path):
+    path = str(tmp_path / "journal")
+    process = subprocess.Popen(["sleep", "10"])
+    j = Journal(path)
+    j.record_service("foo", 1, {"program": "sleep", "args": ["10"]})
+    j.record_slot("foo", 0, process.pid)
+    j.flush()
+    services = Journal(path).open()
+    a = Service("foo", 1, Cmd.make_from_shell_cmd("sleep 10"))
+    a.set_processes_to_adopt(services["foo"].slots)
+    await a.start()
+    assert a.slots[0].pid == process.pid
+    assert a.slots[0].as_dict()["adopted"]
+    await a.shutdown()
+    assert process.wait() == -15
+
+
+@pytest.mark.asyncio
+async def test_detach(tmp_path, mocker):
+    path = str(tmp_path / "journal")
+    daemon = Daemon(log_configure_logger=False, journal_path=path)
+    daemon.start_manager_as_a_task()
+    params = {"name": "foo", "workers": 2, "config": {"program": "sleep"}}
+    params["config"]["args"] = ["10"]
+    await daemon.execute("add_service", params)
+    journaled = []
+
+    def _exit(code):
+        # (everything must be written when the process exits)
+        journaled.append(Journal(path).open())
+
+    mocker.patch("alwaysup.daemon.os._exit", side_effect=_exit)
+    await daemon.execute("detach", {})
+    assert list(journaled[0]["foo"].slots.keys()) == [0, 1]
+    await daemon.shutdown_manager()
@@ -0,0 +1,101 @@
+import pytest
+import asyncio
+import gzip
+import json
+import socket
+import sys
+from alwaysup.logforward import LogForwarder, parse_line, HOSTNAME
+from alwaysup.service import Service
+from alwaysup.cmd import Cmd, CmdConfiguration
+
+
+def test_parse_line():
+    context = {"service": "foo", "slot": 1, "pid": 123}
+    record, parsed = parse_line(b'{"msg": "hello", "slot": "mine"}\n', context)
+    assert parsed
+    assert record == {"msg": "hello", "slot": "mine", "service": "foo", "pid": 123}
+    record, parsed = parse_line(b"not json\n", context)
+    assert not parsed
+    assert record == {"message": "not json", "service": "foo", "slot": 1, "pid": 123}
+    record, parsed = parse_line(b"[1, 2]\n", {})
+    assert not parsed
+    assert record == {"message": "[1, 2]"}
+
+
+@pytest.mark.asyncio
+async def test_batching(tmpdir):
+    path = str(tmpdir.join("sink.sock"))
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    server.bind(path)
+    server.setblocking(False)
+    forwarder = LogForwarder(f"unixgram:{path}", batch_size=3, batch_delay=0.3)
+    forwarder.start()
+    for i in range(0, 4):
+        forwarder.put({"i": i})
+    # (a full batch is written at once, the rest after batch_delay)
+    await asyncio.sleep(0.1)
+    assert forwarder.forwarded == 3
+    await asyncio.sleep(0.5)
+    assert forwarder.forwarded == 4
+    assert forwarder.batches == 2
+    await forwarder.close()
+    assert [json.loads(server.recv(1000)) for _ in range(0, 4)] == [
+        {"i": i} for i in range(0, 4)
+    ]
+    server.close()
+
+
+@pytest.mark.asyncio
+async def test_dropped(tmpdir):
+    forwarder = LogForwarder(f"unix:{tmpdir.join('missing.sock')}", queue_size=2)
+    forwarder.start()
+    for i in range(0, 5):
+        forwarder.put({"i": i})
+    await forwarder.close()
+    d = forwarder.as_dict()
+    assert d["received"] == 5
+    assert d["forwarded"] == 0
+    # (3 records with a full queue, 2 records with a sink error)
+    assert d["dropped"] == 5
+    assert d["errors"] == 1
+
+
+WORKER = """
+import json, sys
+print(json.dumps({"msg": "hello"}))
+print("raw line", file=sys.stderr)
+sys.stdout.flush()
+"""
+
+
+@pytest.mark.asyncio
+async def test_service(tmpdir):
+    path = str(tmpdir.join("logs.json.gz"))
+    config = CmdConfiguration(
+        program=sys.executable,
+        args=["-c", WORKER],
+        stderr="STDOUT",
+        autorespawn=False,
+        log_forward=f"gzip:{path}",
+        log_forward_batch_delay=0.1,
+    )
+    a = Service("foo", 2, Cmd(config))
+    await a.start()
+    await asyncio.sleep(1)
+    assert a.as_dict()["log_forward"]["forwarded"] == 4
+    await a.shutdown()
+    await a.wait()
+    with gzip.open(path, "rb") as f:
+        records = [json.loads(x) for x in f.read().splitlines()]
+    assert sorted((x["slot"], x.get("msg", x.get("message"))) for x in records) == [
+        (0, "hello"),
+        (0, "raw line"),
+        (1, "hello"),
+        (1, "raw line"),
+    ]
+    for record in records:
+        assert record["service"] == "foo"
+        assert record["host"] == HOSTNAME
+        assert record["pid"] > 0
+    assert a.log_forwarder is not None
+    assert a.log_forwarder.parsed == 2
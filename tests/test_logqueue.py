@@ -0,0 +1,81 @@
+import pytest
+import time
+from alwaysup.daemon import Daemon
+from alwaysup.logqueue import LogPipeline
+
+
+class FakeLogger:
+    def __init__(self):
+        self.records = []
+
+    def info(self, **event_dict):
+        self.records.append(event_dict)
+
+    def warning(self, **event_dict):
+        self.records.append(event_dict)
+
+    def critical(self, **event_dict):
+        self.records.append(event_dict)
+
+
+def record(event, id="foo.1"):
+    return {"event": event, "id": id, "level": "info"}
+
+
+def test_rate_limiting():
+    logger = FakeLogger()
+    pipeline = LogPipeline(rate=0.001, burst=2, aggregation_window=0.2)
+    for _ in range(0, 5):
+        pipeline.put(logger, "info", record("slot restarted"))
+    pipeline.put(logger, "info", record("slot restarted", id="foo.2"))
+    pipeline.put(logger, "critical", record("fatal"))
+    assert pipeline.suppressed == 3
+    pipeline.start()
+    time.sleep(0.5)
+    pipeline.stop()
+    events = [x["event"] for x in logger.records]
+    assert events == [
+        "slot restarted",
+        "slot restarted",
+        "slot restarted",
+        "fatal",
+        "slot restarted [repeated 3 times in 0.2s]",
+    ]
+    assert logger.records[-1]["repeated"] == 3
+    assert pipeline.as_dict()["written"] == 5
+
+
+def test_dropped():
+    logger = FakeLogger()
+    pipeline = LogPipeline(queue_size=2, rate=0)
+    pipeline._logger = logger
+    for i in range(0, 5):
+        pipeline.put(logger, "info", record(f"message {i}"))
+    assert pipeline.dropped == 3
+    pipeline.start()
+    pipeline.stop()
+    events = [x["event"] for x in logger.records]
+    assert events == [
+        "message 0",
+        "message 1",
+        "3 log records dropped (log queue full)",
+    ]
+    assert pipeline.as_dict()["enqueued"] == 2
+
+
+@pytest.mark.asyncio
+async def test_detach(tmp_path, mocker):
+    daemon = Daemon(log_configure_logger=False, journal_path=str(tmp_path / "j"))
+    daemon.journal.open()
+    pipeline = LogPipeline()
+    pipeline.start()
+    daemon.log_pipeline = pipeline
+    stopped = []
+
+    def _exit(code):
+        stopped.append(pipeline._thread is None)
+
+    mocker.patch("alwaysup.daemon.os._exit", side_effect=_exit)
+    await daemon.execute("detach", {})
+    # (the writer thread is stopped, so queued records are written, before exit)
+    assert stopped == [True]
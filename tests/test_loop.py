@@ -0,0 +1,34 @@
+import asyncio
+import pytest
+from alwaysup.loop import (
+    LoopBackend,
+    install_loop_policy,
+    resolve_loop_backend,
+    uvloop_is_available,
+)
+
+
+def test_resolve_loop_backend():
+    expected = LoopBackend.UVLOOP if uvloop_is_available() else LoopBackend.ASYNCIO
+    assert resolve_loop_backend(LoopBackend.AUTO) == expected
+    assert resolve_loop_backend(LoopBackend.ASYNCIO) == LoopBackend.ASYNCIO
+    if not uvloop_is_available():
+        with pytest.raises(Exception):
+            resolve_loop_backend(LoopBackend.UVLOOP)
+
+
+def test_install_loop_policy():
+    try:
+        assert install_loop_policy(LoopBackend.ASYNCIO) == LoopBackend.ASYNCIO
+        loop = asyncio.new_event_loop()
+        assert isinstance(loop, asyncio.BaseEventLoop)
+        loop.close()
+        if uvloop_is_available():
+            import uvloop
+
+            assert install_loop_policy(LoopBackend.UVLOOP) == LoopBackend.UVLOOP
+            loop = asyncio.new_event_loop()
+            assert isinstance(loop, uvloop.Loop)
+            loop.close()
+    finally:
+        asyncio.set_event_loop_policy(None)
@@ -23,3 +23,19 @@ async def test_basic():
     await x.wait()
     assert x.is_shutdown()
     assert a.is_shutdown()
+
+
+@pytest.mark.asyncio
+async def test_stop_all():
+    x = Manager()
+    a = Service("foo", 2, Cmd.make_from_shell_cmd("sleep 10"))
+    b = Service("bar", 1, Cmd.make_from_shell_cmd("sleep 10"))
+    await x.add_service(a)
+    await x.add_service(b)
+    await x.stop_all()
+    assert x.is_running()
+    for service in (a, b):
+        assert not service.is_running()
+        assert service.number_of_slots_running() == 0
+    await x.shutdown()
+    assert a.is_shutdown()
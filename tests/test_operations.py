@@ -0,0 +1,66 @@
+import pytest
+import asyncio
+from alwaysup.cmd import Cmd
+from alwaysup.commands import CommandError
+from alwaysup.daemon import Daemon
+from alwaysup.operations import (
+    Operations,
+    OperationState,
+    set_current_operation,
+)
+from alwaysup.service import Service
+
+
+def test_operations():
+    operations = Operations(max_finished=2)
+    ops = [operations.create("stop_service", {"name": "foo"}) for _ in range(0, 4)]
+    for op in ops[0:3]:
+        op.succeed()
+    operations.create("stop_service", {"name": "foo"})
+    # (running operations are never purged)
+    assert operations.get(ops[0].id) is None
+    assert operations.get(ops[3].id) is ops[3]
+    assert len(operations.as_list()) == 4
+
+
+@pytest.mark.asyncio
+async def test_operation_progress():
+    operation = Operations().create("start_service", {"name": "foo"})
+    service = Service("foo", 3, Cmd.make_from_shell_cmd("sleep 10"))
+
+    async def _start():
+        set_current_operation(operation)
+        await service.start()
+        await service.set_slot_number(1)
+
+    await asyncio.create_task(_start())
+    assert (operation.total, operation.done) == (5, 5)
+    await service.shutdown()
+
+
+@pytest.mark.asyncio
+async def test_daemon_operation():
+    daemon = Daemon(log_configure_logger=False, supervisor_thread=False)
+    params = {"name": "foo", "workers": 2, "config": {"program": "sleep"}}
+    params["config"]["args"] = ["10"]
+    await daemon.execute("add_service", params)
+    res = await daemon.execute(
+        "scale_service", {"name": "foo", "workers": 4, "wait": False}
+    )
+    assert res["state"] == "RUNNING"
+    operation = daemon.get_operation(res["id"])
+    while not operation.is_finished():
+        await asyncio.sleep(0.05)
+    d = await daemon.execute("operation", {"id": res["id"]})
+    assert d["state"] == "SUCCEEDED"
+    assert (d["total"], d["done"]) == (2, 2)
+    res = await daemon.execute("stop_service", {"name": "bar", "wait": False})
+    operation = daemon.get_operation(res["id"])
+    while not operation.is_finished():
+        await asyncio.sleep(0.05)
+    assert operation.state == OperationState.FAILED
+    assert operation.errors == ["service not found"]
+    assert len(await daemon.execute("operations", {})) == 2
+    with pytest.raises(CommandError):
+        await daemon.execute("operation", {"id": "unknown"})
+    await daemon.execute("shutdown", {})
@@ -0,0 +1,73 @@
+import pytest
+import os
+from alwaysup.cmd import Cmd, Placement
+from alwaysup.placement import CpuTopology, parse_cpu_list
+from alwaysup.service import Service
+
+
+def make_sys(tmp_path):
+    # 2 NUMA nodes x 2 cores x 2 hyperthreads (siblings: n and n+4)
+    cpu_path = tmp_path / "cpu"
+    (cpu_path).mkdir()
+    (cpu_path / "online").write_text("0-7\n")
+    for cpu in range(0, 8):
+        topology = cpu_path / f"cpu{cpu}" / "topology"
+        topology.mkdir(parents=True)
+        (topology / "physical_package_id").write_text(f"{(cpu % 4) // 2}\n")
+        (topology / "core_id").write_text(f"{cpu % 2}\n")
+    for node, cpulist in ((0, "0-1,4-5"), (1, "2-3,6-7")):
+        (tmp_path / "node" / f"node{node}").mkdir(parents=True)
+        (tmp_path / "node" / f"node{node}" / "cpulist").write_text(cpulist)
+    return str(cpu_path)
+
+
+def test_parse_cpu_list():
+    assert parse_cpu_list("0-3,8,10-11\n") == [0, 1, 2, 3, 8, 10, 11]
+
+
+def test_topology(tmp_path):
+    sys_path = make_sys(tmp_path)
+    topology = CpuTopology.read(range(0, 8), sys_path)
+    assert topology.cores == [[0, 4], [1, 5], [2, 6], [3, 7]]
+    assert topology.nodes == [[0, 1], [2, 3]]
+    # spread: one core per slot, alternating nodes
+    assert [topology.slot_cpus(Placement.SPREAD, i, 4) for i in range(0, 4)] == [
+        [0, 4],
+        [2, 6],
+        [1, 5],
+        [3, 7],
+    ]
+    # (less slots than cores => several cores per slot)
+    assert topology.slot_cpus(Placement.SPREAD, 0, 2) == [0, 1, 4, 5]
+    # pack: hyperthreads of a core first
+    assert [topology.slot_cpus(Placement.PACK, i, 3) for i in range(0, 3)] == [
+        [0],
+        [4],
+        [1],
+    ]
+    # numa: contiguous blocks of slots per node
+    assert [topology.slot_cpus(Placement.NUMA, i, 4)[0] for i in range(0, 4)] == [
+        0,
+        0,
+        2,
+        2,
+    ]
+    assert topology.slot_cpus(Placement.NO, 0, 4) == []
+    # restricted allowed cpus
+    assert CpuTopology.read([2, 3], sys_path).nodes == [[0, 1]]
+
+
+@pytest.mark.asyncio
+async def test_service_placement():
+    cpu = min(os.sched_getaffinity(0))
+    cmd = Cmd.make_from_shell_cmd(
+        "sleep 10", placement=Placement.PACK, cpu_affinity=[cpu]
+    )
+    service = Service("foo", 2, cmd)
+    await service.start()
+    for slot in service.slots.values():
+        assert slot.cpus == [cpu]
+        assert os.sched_getaffinity(slot.pid) == {cpu}
+    await service.set_slot_number(3)
+    assert service.slots[2].cpus == [cpu]
+    await service.shutdown()
@@ -1,7 +1,7 @@
 import pytest
 import os
 import asyncio
-from alwaysup.process import ManagedProcess, ManagedProcessState
+from alwaysup.process import ManagedProcess, ManagedProcessState, StopStats
 from alwaysup.cmd import Cmd
 
 DIR = os.path.dirname(os.path.realpath(__file__))
@@ -74,3 +74,55 @@ async def test_misc():
     await a.start()
     await a.wait()
     assert a.state == ManagedProcessState.DEAD
+
+
+@pytest.mark.asyncio
+async def test_smart_stop_steps():
+    stats = StopStats()
+    a = ManagedProcess(
+        "foo",
+        Cmd.make_from_shell_cmd(
+            f"{DIR}/smart_stop.py", smart_stop_steps=[(28, 1.0), (15, 5.0)]
+        ),
+        stop_stats=stats,
+    )
+    await a.start()
+    await asyncio.sleep(1)
+    await a.stop()
+    assert a.returncode == 3
+    assert a.stopped_by == "SIGTERM"
+    assert stats.as_dict()["SIGTERM"]["count"] == 1
+    assert stats.as_dict()["SIGTERM"]["average_duration"] >= 1.0
+
+
+@pytest.mark.asyncio
+async def test_env(tmp_path):
+    env_file = tmp_path / "env"
+    env_file.write_text("# comment\nexport FOO=bar\nBAZ='with space'\n")
+    output = tmp_path / "output"
+    cmd = Cmd.make_from_shell_cmd(
+        f"sh -c 'env > {output}'",
+        clean_env=True,
+        env_files=[str(env_file)],
+        extra_envs={"SLOT_ENV": "slot{{SLOT}}", "FOO": "overridden"},
+    )
+    slot_cmd = cmd.copy_and_add_to_context({"SLOT": 3})
+    a = ManagedProcess("foo", slot_cmd)
+    await a.start()
+    await a.wait()
+    lines = set(output.read_text().splitlines())
+    assert "FOO=overridden" in lines
+    assert "BAZ=with space" in lines
+    assert "SLOT_ENV=slot3" in lines
+    assert "HOME=%s" % os.environ.get("HOME") not in lines
+    # the environment block is built once (and reused for respawns)
+    assert slot_cmd.env is slot_cmd.env
+    assert cmd.copy_and_add_to_context({"SLOT": 4}).env["SLOT_ENV"] == "slot4"
+
+
+@pytest.mark.asyncio
+async def test_env_file_missing(tmp_path):
+    cmd = Cmd.make_from_shell_cmd("true", env_files=[str(tmp_path / "missing")])
+    a = ManagedProcess("foo", cmd)
+    await a.start()
+    assert a.state == ManagedProcessState.DEAD
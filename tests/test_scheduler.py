@@ -0,0 +1,89 @@
+import pytest
+import asyncio
+import time
+from alwaysup import scheduler as scheduler_module
+from alwaysup.scheduler import SpawnScheduler
+from alwaysup.manager import Manager
+from alwaysup.service import Service
+from alwaysup.cmd import Cmd
+
+
+@pytest.mark.asyncio
+async def test_rate_limit():
+    scheduler = SpawnScheduler(rate=20, burst=1)
+    before = time.monotonic()
+    for _ in range(0, 5):
+        assert await scheduler.acquire("foo")
+    assert time.monotonic() - before >= 0.15
+    d = scheduler.as_dict()
+    assert d["spawns"] == 5
+    assert d["queue_depth"] == 0
+    assert d["wait"]["max"] > 0
+
+
+@pytest.mark.asyncio
+async def test_priority_and_cancel():
+    scheduler = SpawnScheduler(rate=10, burst=1)
+    assert await scheduler.acquire("foo")
+    order = []
+
+    async def spawn(name, priority):
+        await scheduler.acquire(name, priority)
+        order.append(name)
+
+    low = asyncio.create_task(spawn("low", 0))
+    cancelled = asyncio.create_task(spawn("cancelled", 10))
+    high = asyncio.create_task(spawn("high", 5))
+    await asyncio.sleep(0.01)
+    assert scheduler.as_dict()["queued_by_service"] == {
+        "low": 1,
+        "cancelled": 1,
+        "high": 1,
+    }
+    cancelled.cancel()
+    await asyncio.wait([low, high, cancelled])
+    assert order == ["high", "low"]
+
+
+@pytest.mark.asyncio
+async def test_admission_control(monkeypatch):
+    pressure = {"cpu": 90.0}
+    monkeypatch.setattr(scheduler_module, "read_psi", lambda x: pressure.get(x))
+    scheduler = SpawnScheduler(psi_cpu_threshold=50, check_interval=0.05, max_defer=5)
+    task = asyncio.create_task(scheduler.acquire("foo"))
+    await asyncio.sleep(0.2)
+    assert not task.done()
+    assert scheduler.as_dict()["deferred"] > 0
+    pressure["cpu"] = 10.0
+    assert await asyncio.wait_for(task, 1.0)
+    # (too long deferred spawns are admitted anyway)
+    pressure["cpu"] = 90.0
+    scheduler.max_defer = 0.1
+    assert await asyncio.wait_for(scheduler.acquire("foo"), 1.0)
+
+
+@pytest.mark.asyncio
+async def test_close():
+    scheduler = SpawnScheduler(rate=0.1, burst=1)
+    assert await scheduler.acquire("foo")
+    task = asyncio.create_task(scheduler.acquire("foo"))
+    await asyncio.sleep(0.01)
+    scheduler.close()
+    assert not await task
+    assert not await scheduler.acquire("foo")
+
+
+@pytest.mark.asyncio
+async def test_respawn_storm():
+    scheduler = SpawnScheduler(rate=10, burst=2)
+    manager = Manager(spawn_scheduler=scheduler)
+    cmd = Cmd.make_from_shell_cmd("false", waiting_for_restart_delay=0.0)
+    before = time.monotonic()
+    await manager.add_service(Service("foo", 4, cmd))
+    await asyncio.sleep(1.0)
+    # burst + rate * elapsed
+    assert scheduler.spawns <= 2 + 10 * (time.monotonic() - before) + 1
+    assert scheduler.as_dict()["queue_depth"] > 0
+    before = time.monotonic()
+    await manager.shutdown()
+    assert time.monotonic() - before < 1.0
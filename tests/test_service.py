@@ -1,8 +1,10 @@
 import pytest
 import os
 import asyncio
+import time
+import sys
 from alwaysup.service import Service
-from alwaysup.cmd import Cmd
+from alwaysup.cmd import Cmd, CmdConfiguration, ScaleDownPolicy
 
 DIR = os.path.dirname(os.path.realpath(__file__))
 
@@ -49,3 +51,105 @@ async def test_scaling_down():
     await asyncio.sleep(1)
     await a.shutdown()
     await a.wait()
+
+
+@pytest.mark.asyncio
+async def test_stop_single_deadline():
+    a = Service(
+        "foo",
+        5,
+        Cmd.make_from_shell_cmd(f"{DIR}/smart_stop.py 60", smart_stop_timeout=2),
+    )
+    await a.start()
+    await asyncio.sleep(1)
+    pids = [x.pid for x in a.slots.values()]
+    before = time.monotonic()
+    await a.stop()
+    assert time.monotonic() - before < 4
+    assert a.number_of_slots_running() == 0
+    for pid in pids:
+        with pytest.raises(ProcessLookupError):
+            os.kill(pid, 0)
+    await a.shutdown()
+
+
+@pytest.mark.asyncio
+async def test_coalescing():
+    a = Service("foo", 1, Cmd.make_from_shell_cmd("sleep 10"))
+    await a.start()
+    tasks = [asyncio.create_task(a.set_slot_number(x)) for x in (5, 20, 8)]
+    await asyncio.gather(*tasks)
+    # (20 slots were never started, the latest target wins)
+    assert sorted(a.slots.keys()) == list(range(0, 8))
+    assert a.number_of_slots_running() == 8
+    assert a.coalesced == 2
+    await asyncio.gather(a.stop(), a.start(), a.stop())
+    assert not a.is_running()
+    await a.start()
+    assert a.number_of_slots_running() == 8
+    await a.shutdown()
+    assert a.is_shutdown()
+
+
+@pytest.mark.asyncio
+async def test_scale_down_policy():
+    cmd = Cmd.make_from_shell_cmd(
+        "sh -c 'if [ {{SLOT}} = 1 ]; then while :; do :; done; fi; sleep 30'",
+        scale_down_policy=ScaleDownPolicy.LEAST_CPU,
+    )
+    a = Service("foo", 3, cmd)
+    await a.start()
+    await asyncio.sleep(0.5)
+    busy = a.slots[1].pid
+    await a.set_slot_number(1)
+    # (the busy slot is kept, with its number)
+    assert list(a.slots.keys()) == [1]
+    assert a.slots[1].pid == busy
+    await a.set_slot_number(3)
+    assert sorted(a.slots.keys()) == [0, 1, 2]
+    await a.shutdown()
+
+
+WORKER = """
+import os, socket
+s = socket.socket(fileno=int(os.environ["ALWAYSUP_LISTEN_FD"]))
+while True:
+    c, _ = s.accept()
+    c.sendall(b"ok")
+    c.close()
+"""
+
+
+@pytest.mark.asyncio
+async def test_scale_to_zero(tmpdir, mocker):
+    mocker.patch("alwaysup.service.IDLE_CHECK_INTERVAL", 0.1)
+    path = str(tmpdir.join("activation.sock"))
+    config = CmdConfiguration(
+        program=sys.executable,
+        args=["-c", WORKER],
+        idle_timeout=1.0,
+        activation_socket=path,
+        waiting_for_restart_delay=0,
+    )
+    a = Service("foo", 2, Cmd(config))
+    await a.start()
+    assert a.number_of_slots_running() == 2
+    for _ in range(0, 30):
+        if len(a.slots) == 0:
+            break
+        await asyncio.sleep(0.1)
+    assert len(a.slots) == 0
+    assert a.is_running()
+    d = a.as_dict()
+    assert d["idle"]
+    assert d["idle_scale_downs"] == 1
+    assert d["in_flight"] == 0
+    # (the connection waits in the backlog until a slot accepts it)
+    reader, writer = await asyncio.open_unix_connection(path)
+    assert await asyncio.wait_for(reader.read(2), 10) == b"ok"
+    writer.close()
+    assert a.number_of_slots_running() == 2
+    assert not a.as_dict()["idle"]
+    await a.shutdown()
+    await a.wait()
+    assert not os.path.exists(path)
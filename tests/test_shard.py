@@ -0,0 +1,58 @@
+import pytest
+import os
+import signal
+import asyncio
+from alwaysup.manager import Manager
+from alwaysup.shard import ShardCoordinator, shard_of
+from alwaysup.commands import CommandError
+from alwaysup.operations import Operations, set_current_operation
+from alwaysup.utils import get_process_start_time
+
+
+def test_shard_of():
+    assert shard_of("foo", 4) == shard_of("foo", 4)
+    assert len(set([shard_of(f"foo{i}", 4) for i in range(0, 100)])) == 4
+
+
+@pytest.mark.asyncio
+async def test_coordinator(tmp_path):
+    manager = Manager()
+    coordinator = ShardCoordinator(manager, 2, str(tmp_path / "alwaysup.sock"))
+    await coordinator.start()
+    for i in range(0, 4):
+        params = {"name": f"foo{i}", "workers": 1, "config": {"program": "sleep"}}
+        params["config"]["args"] = ["30"]
+        assert await coordinator.execute("add_service", params) == {"name": f"foo{i}"}
+    snapshot = await coordinator.execute("manager", {})
+    assert sorted(snapshot["services"].keys()) == ["foo0", "foo1", "foo2", "foo3"]
+    for name, service in snapshot["services"].items():
+        assert service["shard"] == shard_of(name, 2)
+    await coordinator.execute("scale_service", {"name": "foo0", "workers": 2})
+    service = await coordinator.execute("service", {"name": "foo0"})
+    assert service["number_of_slots_running"] == 2
+    # (progress of operations is copied from shards)
+    operation = Operations().create("scale_service", {"name": "foo1"})
+
+    async def _scale():
+        set_current_operation(operation)
+        await coordinator.execute("scale_service", {"name": "foo1", "workers": 3})
+
+    await asyncio.create_task(_scale())
+    assert (operation.total, operation.done) == (2, 2)
+    with pytest.raises(CommandError) as e:
+        await coordinator.execute("service", {"name": "bar"})
+    assert e.value.status_code == 404
+    # a crashed shard is respawned and re-adopts its processes
+    shard = shard_of("foo0", 2)
+    pids = [x["pid"] for x in service["slots"].values()]
+    os.kill(snapshot["shards"][shard]["pid"], signal.SIGKILL)
+    await asyncio.sleep(1.0)
+    await coordinator._wait_for_shard(shard)
+    service = await coordinator.execute("service", {"name": "foo0"})
+    assert [x["pid"] for x in service["slots"].values()] == pids
+    assert all([x["adopted"] for x in service["slots"].values()])
+    await coordinator.execute("shutdown", {})
+    await coordinator.stop()
+    for pid in pids:
+        # (adopted processes are not our children, they can stay zombies)
+        assert get_process_start_time(pid) is None
@@ -0,0 +1,41 @@
+import pytest
+import os
+import resource
+import subprocess
+from alwaysup.cmd import Cmd
+from alwaysup.process import ManagedProcess
+from alwaysup.spawn import tune_process
+
+
+def test_tune_process():
+    process = subprocess.Popen(["sleep", "10"])
+    try:
+        errors = tune_process(
+            process.pid,
+            rlimit_nofile=256,
+            nice=5,
+            ionice_class="idle",
+            oom_score_adj=100,
+            cpu_affinity=[0],
+        )
+        assert errors == []
+        assert resource.prlimit(process.pid, resource.RLIMIT_NOFILE) == (256, 256)
+        assert os.getpriority(os.PRIO_PROCESS, process.pid) == 5
+        assert os.sched_getaffinity(process.pid) == {0}
+        with open(f"/proc/{process.pid}/oom_score_adj") as f:
+            assert f.read().strip() == "100"
+        errors = tune_process(process.pid, ionice_class="foo")
+        assert len(errors) == 1
+    finally:
+        process.kill()
+        process.wait()
+
+
+@pytest.mark.asyncio
+async def test_managed_process_settings():
+    cmd = Cmd.make_from_shell_cmd("sleep 10", rlimit_nofile=128, nice=3)
+    a = ManagedProcess("foo", cmd)
+    await a.start()
+    assert resource.prlimit(a.pid, resource.RLIMIT_NOFILE) == (128, 128)
+    assert os.getpriority(os.PRIO_PROCESS, a.pid) == 3
+    await a.stop()
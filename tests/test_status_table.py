@@ -0,0 +1,72 @@
+import pytest
+import asyncio
+import os
+from alwaysup.manager import Manager
+from alwaysup.service import Service
+from alwaysup.cmd import Cmd
+from alwaysup.slot import ProcessSlotState
+from alwaysup.status_table import (
+    StatusTable,
+    StatusTableReader,
+    read_status_table,
+    STATE_NAMES,
+)
+
+
+@pytest.mark.asyncio
+async def test_status_table(tmp_path):
+    path = str(tmp_path / "status")
+    table = StatusTable(path, capacity=4)
+    table.open()
+    table.start()
+    table.update("foo", 0, ProcessSlotState.RUNNING, os.getpid(), 2)
+    table.update("foo", 1, ProcessSlotState.STARTING, None, 0)
+    with StatusTableReader(path) as reader:
+        assert reader.capacity == 4
+        assert reader.writer_pid == os.getpid()
+        slots = {(x.service, x.slot_number): x for x in reader.read()}
+        assert len(slots) == 2
+        assert slots[("foo", 0)].state == "RUNNING"
+        assert slots[("foo", 0)].pid == os.getpid()
+        assert slots[("foo", 0)].restarts == 2
+        assert slots[("foo", 0)].rss > 0
+        assert slots[("foo", 1)].pid is None
+        # records are updated in place (and freed)
+        table.update("foo", 1, ProcessSlotState.RUNNING, os.getpid(), 0)
+        table.remove("foo", 0)
+        assert [(x.slot_number, x.state) for x in reader.read()] == [(1, "RUNNING")]
+    await table.close()
+    assert not os.path.exists(path)
+
+
+@pytest.mark.asyncio
+async def test_status_table_full(tmp_path):
+    path = str(tmp_path / "status")
+    table = StatusTable(path, capacity=1)
+    table.open()
+    table.update("foo", 0, ProcessSlotState.RUNNING, None, 0)
+    table.update("foo", 1, ProcessSlotState.RUNNING, None, 0)
+    assert len(read_status_table(path)) == 1
+    await table.close()
+
+
+@pytest.mark.asyncio
+async def test_status_table_with_manager(tmp_path):
+    path = str(tmp_path / "status")
+    table = StatusTable(path)
+    table.open()
+    manager = Manager(status_table=table)
+    cmd = Cmd.make_from_shell_cmd("sleep 0.3", waiting_for_restart_delay=0.1)
+    await manager.add_service(Service("foo", 2, cmd))
+    slots = read_status_table(path)
+    assert len(slots) == 2
+    assert all(x.state == "RUNNING" and x.pid is not None for x in slots)
+    await asyncio.sleep(1.0)
+    assert all(x.restarts > 0 for x in read_status_table(path))
+    await manager.shutdown()
+    assert read_status_table(path) == []
+    await table.close()
+
+
+def test_state_names():
+    assert STATE_NAMES == {x.value: x.name for x in ProcessSlotState}
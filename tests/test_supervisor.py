@@ -0,0 +1,31 @@
+import pytest
+import asyncio
+import threading
+from alwaysup.manager import Manager
+from alwaysup.commands import execute
+from alwaysup.supervisor import Supervisor
+
+
+@pytest.mark.asyncio
+async def test_supervisor():
+    manager = Manager()
+    supervisor = Supervisor(manager, manager.wait, snapshot_interval=0.1)
+    supervisor.start()
+    assert supervisor.is_alive()
+    params = {
+        "name": "foo",
+        "workers": 2,
+        "config": {"program": "sleep", "args": ["10"]},
+    }
+    await supervisor.call(execute(manager, "add_service", params))
+    # published after the command
+    assert supervisor.snapshot["services"]["foo"]["number_of_slots_running"] == 2
+
+    async def _thread_name():
+        return threading.current_thread().name
+
+    assert await supervisor.call(_thread_name()) == "alwaysup-supervisor"
+    await supervisor.call(manager.shutdown())
+    await asyncio.get_event_loop().run_in_executor(None, supervisor.join, 5.0)
+    assert not supervisor.is_alive()
+    assert supervisor.snapshot["state"] == "SHUTDOWN"
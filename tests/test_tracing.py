@@ -0,0 +1,60 @@
+import pytest
+import json
+from alwaysup.tracing import Tracer, TRACER, span
+from alwaysup.service import Service
+from alwaysup.cmd import Cmd
+
+
+def test_tracer(tmp_path):
+    tracer = Tracer()
+    path = str(tmp_path / "trace.jsonl")
+    tracer.set_export_path(path)
+    with tracer.span("root", "foo", bar=1) as root:
+        with tracer.span("child") as child:
+            pass
+    for _ in range(0, 9):
+        with tracer.span("root", "foo"):
+            pass
+    tracer.close()
+    assert child.service == "foo"
+    assert child.parent_id == root.span_id
+    assert child.trace_id == root.trace_id
+    with open(path) as f:
+        lines = [json.loads(x) for x in f.readlines()]
+    assert len(lines) == 11
+    assert lines[0]["name"] == "child"
+    assert lines[1]["attributes"] == {"bar": 1}
+    percentiles = tracer.percentiles("foo")
+    assert percentiles["root"]["count"] == 10
+    assert percentiles["root"]["p50"] <= percentiles["root"]["max"]
+    tracer.forget("foo")
+    assert tracer.percentiles("foo") == {}
+
+
+@pytest.mark.asyncio
+async def test_service_tracing(tmp_path):
+    path = str(tmp_path / "trace.jsonl")
+    TRACER.set_export_path(path)
+    a = Service("traced", 2, Cmd.make_from_shell_cmd("sleep 10"))
+    await a.start()
+    with span("test.stop", "traced"):
+        await a.slots[0].stop()
+    await a.shutdown()
+    TRACER.set_export_path(None)
+    latencies = a.as_dict()["latencies"]
+    for name in (
+        "service.start_slot",
+        "slot.create",
+        "slot.start",
+        "process.render",
+        "process.spawn",
+        "slot.stop",
+        "process.stop_step",
+        "slots.shutdown",
+    ):
+        assert latencies[name]["count"] >= 1, name
+    with open(path) as f:
+        spans = {x["span_id"]: x for x in [json.loads(y) for y in f.readlines()]}
+    spawn = [x for x in spans.values() if x["name"] == "process.spawn"][0]
+    assert spans[spawn["parent_id"]]["name"] == "slot.start"
+    TRACER.forget("traced")